@@ -0,0 +1,237 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+Thermometer calibrations
+
+last edited : October 2026
+
+Explanation:
+
+	A calibration converts a thermometer resistance to a temperature. The
+	curves are polynomials in log10(R), the polynomial gives log10(T):
+		log10(T) = c0 + c1*x + c2*x**2 + ...	x = log10(R) - factor
+	The coefficients are stored highest order first when the calibration
+	is made so a conversion is a single Horner loop with no powers of x.
+
+	Convert takes either one resistance, which is done in plain floats
+	since numpy is slow on tiny arrays, or an array of resistances, e.g.
+	a log of raw readings, which is converted in one vectorized pass.
+
+	Besides polynomials a sensor may be calibrated by a table of R and T,
+	interpolated linearly in log10(R) and log10(T), or by Chebyshev series
+	in log10(R) over several ranges of resistance, as supplied by
+	LakeShore.
+
+	The calibrations are read from files in the Calibrations directory,
+	one per sensor named e.g. SO703.cal. The first line gives the type and
+	the rest are numbers, lines starting with # are comments:
+		POLY factor		followed by c0 c1 c2 ...
+		TABLE			followed by a line "R T" per point
+		CHEBYSHEV		followed by a line "ZL ZU a0 a1 a2 ..." per range
+	A CalibrationRegistry reads a file when a sensor is asked for and
+	keeps the calibration it builds, keyed by the sensor and a hash of the
+	file, so asking again costs one file read and the calibration is only
+	rebuilt when the file has been changed.
+
+Classes:
+	PolyCalibration
+	TableCalibration
+	ChebyshevCalibration
+	CalibrationRegistry
+
+Methods written:
+	LoadCalibration
+
+"""
+
+import bisect
+import hashlib
+import math
+import os
+
+import numpy as np
+
+CALIBRATION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),"Calibrations")
+
+class PolyCalibration:
+
+	def __init__(self, Coefficients, Factor = 0.0):
+		# Coefficients lowest order first, as they are given with the
+		# sensor
+		self.Coefficients = [float(c) for c in Coefficients]
+		self.Horner = self.Coefficients[::-1]
+		self.Factor = Factor
+		return
+
+	def __call__(self, Resistance):
+		return self.Convert(Resistance)
+
+	def Convert(self, Resistance):
+		if np.ndim(Resistance) == 0:
+			return self.ConvertOne(float(Resistance))
+		x = np.log10(np.asarray(Resistance, dtype=np.float64))
+		if self.Factor:
+			x -= self.Factor
+		Sum = np.empty_like(x)
+		Sum.fill(self.Horner[0])
+		for c in self.Horner[1:]:
+			Sum *= x
+			Sum += c
+		return np.power(10.0, Sum, out=Sum)
+
+	def ConvertOne(self, Resistance):
+		if not Resistance > 0:
+			return float("nan")
+		x = math.log10(Resistance) - self.Factor
+		Sum = 0.0
+		for c in self.Horner:
+			Sum = Sum * x + c
+		try:
+			return 10.0 ** Sum
+		except OverflowError:
+			return float("inf")
+
+class TableCalibration:
+
+	def __init__(self, Resistance, Temperature):
+		Order = np.argsort(Resistance)
+		self.LogR = np.log10(np.asarray(Resistance, dtype=np.float64)[Order])
+		self.LogT = np.log10(np.asarray(Temperature, dtype=np.float64)[Order])
+		if len(self.LogR) < 2:
+			raise ValueError("A calibration table needs at least two points")
+		# Plain lists for the single conversions
+		self.LogRList = list(self.LogR)
+		self.LogTList = list(self.LogT)
+		return
+
+	def __call__(self, Resistance):
+		return self.Convert(Resistance)
+
+	def Convert(self, Resistance):
+		# Outside the table the temperature is nan rather than the end
+		# of the table
+		if np.ndim(Resistance) == 0:
+			return self.ConvertOne(float(Resistance))
+		x = np.log10(np.asarray(Resistance, dtype=np.float64))
+		T = np.power(10.0, np.interp(x, self.LogR, self.LogT))
+		T[(x < self.LogR[0]) | (x > self.LogR[-1])] = np.nan
+		return T
+
+	def ConvertOne(self, Resistance):
+		if not Resistance > 0:
+			return float("nan")
+		x = math.log10(Resistance)
+		i = bisect.bisect_right(self.LogRList, x)
+		if i == len(self.LogRList) and x == self.LogRList[-1]:
+			i = i - 1
+		if i == 0 or i == len(self.LogRList):
+			return float("nan")
+		x0 = self.LogRList[i-1]
+		x1 = self.LogRList[i]
+		y0 = self.LogTList[i-1]
+		y1 = self.LogTList[i]
+		return 10.0 ** (y0 + (y1 - y0) * (x - x0) / (x1 - x0))
+
+class ChebyshevCalibration:
+
+	def __init__(self, Ranges):
+		# Ranges is a list of (ZL, ZU, [a0, a1, ...]) where Z = log10(R),
+		# the first range containing Z is used
+		self.Ranges = [(float(ZL), float(ZU), [float(a) for a in Coefficients]) for ZL, ZU, Coefficients in Ranges]
+		if not self.Ranges:
+			raise ValueError("A Chebyshev calibration needs at least one range")
+		return
+
+	def __call__(self, Resistance):
+		return self.Convert(Resistance)
+
+	def Convert(self, Resistance):
+		if np.ndim(Resistance) == 0:
+			return self.ConvertOne(float(Resistance))
+		Z = np.log10(np.asarray(Resistance, dtype=np.float64))
+		T = np.empty_like(Z)
+		T.fill(np.nan)
+		Done = np.zeros(Z.shape, dtype=bool)
+		for ZL, ZU, Coefficients in self.Ranges:
+			In = (Z >= ZL) & (Z <= ZU) & ~Done
+			if In.any():
+				x = ((Z[In] - ZL) - (ZU - Z[In])) / (ZU - ZL)
+				T[In] = np.polynomial.chebyshev.chebval(x, Coefficients)
+				Done |= In
+		return T
+
+	def ConvertOne(self, Resistance):
+		if not Resistance > 0:
+			return float("nan")
+		Z = math.log10(Resistance)
+		for ZL, ZU, Coefficients in self.Ranges:
+			if ZL <= Z <= ZU:
+				x = ((Z - ZL) - (ZU - Z)) / (ZU - ZL)
+				# Clenshaw recurrence
+				b1 = 0.0
+				b2 = 0.0
+				for a in Coefficients[:0:-1]:
+					b1, b2 = 2.0 * x * b1 - b2 + a, b1
+				return x * b1 - b2 + Coefficients[0]
+		return float("nan")
+
+def LoadCalibration(Text, Name = "calibration"):
+	# Build a calibration from the text of a calibration file
+	Lines = []
+	for Line in Text.splitlines():
+		Line = Line.split("#",1)[0].split()
+		if Line:
+			Lines.append(Line)
+	if not Lines:
+		raise ValueError("%s is empty" % Name)
+	Kind = Lines[0][0].upper()
+	try:
+		Header = [float(v) for v in Lines[0][1:]]
+		Rows = [[float(v) for v in Line] for Line in Lines[1:]]
+	except ValueError:
+		raise ValueError("%s has a value that is not a number" % Name)
+	if Kind == "POLY":
+		Factor = 0.0
+		if Header:
+			Factor = Header[0]
+		Coefficients = [v for Row in Rows for v in Row]
+		if not Coefficients:
+			raise ValueError("%s has no coefficients" % Name)
+		return PolyCalibration(Coefficients, Factor)
+	elif Kind == "TABLE":
+		if any(len(Row) != 2 for Row in Rows):
+			raise ValueError("%s needs a resistance and a temperature on each line" % Name)
+		Rows = np.array(Rows)
+		return TableCalibration(Rows[:,0], Rows[:,1])
+	elif Kind == "CHEBYSHEV":
+		if any(len(Row) < 3 for Row in Rows):
+			raise ValueError("%s needs ZL ZU and coefficients on each line" % Name)
+		return ChebyshevCalibration([(Row[0], Row[1], Row[2:]) for Row in Rows])
+	raise ValueError("%s has unknown type %s" % (Name, Kind))
+
+class CalibrationRegistry:
+
+	def __init__(self, Directory = CALIBRATION_DIR):
+		self.Directory = Directory
+		self.Cache = {}
+		return
+
+	def Path(self, Sensor):
+		return os.path.join(self.Directory, "%s.cal" % Sensor)
+
+	def Sensors(self):
+		return sorted(f[:-4] for f in os.listdir(self.Directory) if f.endswith(".cal"))
+
+	def Get(self, Sensor):
+		# The calibration for Sensor, raises IOError if there is no file
+		# and ValueError if the file cannot be read
+		with open(self.Path(Sensor),"rb") as File:
+			Text = File.read()
+		Key = (Sensor, hashlib.md5(Text).hexdigest())
+		if Key not in self.Cache:
+			Calibration = LoadCalibration(Text, self.Path(Sensor))
+			Calibration.Sensor = Sensor
+			self.Cache[Key] = Calibration
+		return self.Cache[Key]
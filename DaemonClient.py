@@ -0,0 +1,229 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+Long lived client sessions for the temperature and magnet daemons
+
+last edited : October 2026
+
+Explanation:
+
+	A session connects to a daemon once and is then shared by all the
+	measurement routines, GetSession returns the same session for the
+	same daemon every time. If the daemon restarts the session reconnects
+	the next time it is used.
+
+	On connecting the daemon sends its status straight away, so the
+	session is ready as soon as that arrives instead of after a fixed
+	sleep. If the daemon runs on this host the readings come from shared
+	memory (see SharedTelemetry) and the socket only carries commands and
+	status changes.
+
+	Readings are returned as (value, status) with the status as a string
+	e.g. "0", "1", as the measurement code expects.
+
+Methods written:
+	GetSession
+	DaemonSession.Read
+	DaemonSession.Write
+	DaemonSession.WaitUntil
+	DaemonSession.WaitWhile
+	DaemonSession.ETA
+	DaemonSession.History
+	DaemonSession.Tracking
+
+"""
+
+import asyncore
+import socket
+import struct
+import time
+
+import SocketUtils as SocketUtils
+import SharedTelemetry
+import RingBuffer
+
+# Generic ports for the daemons
+TEMP_PORT = 18871
+MAGNET_PORT = 18861
+
+Sessions = {}
+
+def GetSession(Port, Topic, Host = "localhost"):
+	Key = (Host, Port)
+	if Key not in Sessions:
+		Sessions[Key] = DaemonSession(Port, Topic, Host)
+	return Sessions[Key]
+
+def TempSession():
+	return GetSession(TEMP_PORT, "TEMP")
+
+def MagnetSession():
+	return GetSession(MAGNET_PORT, "FIELD")
+
+class DaemonSession:
+
+	def __init__(self, Port, Topic, Host = "localhost", ConnectTimeout = 5.0):
+		self.Port = Port
+		self.Topic = Topic
+		self.Host = Host
+		self.ConnectTimeout = ConnectTimeout
+		self.Client = None
+		self.Shared = None
+		if Host in ("localhost","127.0.0.1"):
+			self.Shared = SharedTelemetry.TelemetryReader(Topic)
+		self.UseShared = False
+		self.Decoder = SocketUtils.TelemetryDecoder()
+		self.Value = 0.0
+		self.Status = None
+		self.Stamp = 0.0
+		self.Connect()
+		return
+
+	def Connected(self):
+		return self.Client is not None and (self.Client.connected or self.Client.connecting)
+
+	def Connect(self):
+		# Connect if we are not, returns True once the daemon has sent
+		# its status
+		if self.Connected() and self.Client.status is not None:
+			return True
+		if not self.Connected():
+			if self.Client is not None:
+				print "Reconnecting to daemon on port %d" % self.Port
+			try:
+				self.Client = SocketUtils.SockClient(self.Host, self.Port)
+			except socket.error:
+				self.Client = None
+				return False
+			# Decided once per connection, the socket queue is not read
+			# when the readings come from shared memory
+			self.UseShared = self.Shared is not None and self.Shared.Open()
+			if self.UseShared:
+				self.Client.subscribe("STATUS,ETA")
+		Ready = self.Client.wait_for(lambda: self.Client.status is not None, self.ConnectTimeout)
+		if Ready and self.Status is None:
+			self.Status = self.Client.status
+		return Ready
+
+	def Read(self):
+		if not self.Connect():
+			return self.Value, self.Status
+		if self.UseShared:
+			Frame = self.Shared.Read()
+			if Frame is not None:
+				self.Value = Frame.value
+				self.Status = "%d" % Frame.status
+				self.Stamp = Frame.stamp
+			return self.Value, self.Status
+		asyncore.loop(count=1,timeout=0.001)
+		# Every reading since the last call is queued, the newest wins
+		for Msg in self.Client.read_all():
+			Msg = Msg.split(" ",1)
+			if len(Msg) == 2 and Msg[0] == self.Topic:
+				try:
+					Frame = self.Decoder.decode(Msg[1])
+				except struct.error:
+					continue
+				self.Value = Frame.value
+				self.Status = "%d" % Frame.status
+				self.Stamp = Frame.stamp
+		return self.Value, self.Status
+
+	def Write(self, Msg, Timeout = 5.0):
+		# Send the command and wait for the daemon to accept it
+		if not self.Connect():
+			print "Not connected to daemon on port %d, \"%s\" not sent" % (self.Port, Msg)
+			return -1
+		Reply = self.Client.request(Msg,Timeout)
+		if Reply < 0 and not self.Connected() and self.Connect():
+			# The daemon restarted since we last used the session
+			Reply = self.Client.request(Msg,Timeout)
+		if Reply >= 0 and self.Client.status is not None:
+			# The daemon publishes its status before it answers, so once
+			# the answer is in this is the status after the command
+			self.Status = self.Client.status
+		if Reply == 0:
+			print "Daemon rejected \"%s\"" % Msg
+		elif Reply < 0:
+			print "No reply from daemon to \"%s\"" % Msg
+		return Reply
+
+	def History(self, Start, Stop = None, MaxPoints = 0, Timeout = 10.0):
+		# The daemon readings between Start and Stop (seconds since the
+		# epoch) as an array with rows of stamp, value, raw value and
+		# status, averaged down to MaxPoints rows if that is given.
+		# Returns None if the daemon did not answer
+		if Stop is None:
+			Stop = time.time()
+		if not self.Connect():
+			return None
+		Msg = "HIST %.6f %.6f %d" % (Start, Stop, MaxPoints)
+		Data = self.Client.query(Msg,Timeout)
+		if Data is None:
+			print "No history from daemon on port %d" % self.Port
+			return None
+		return RingBuffer.UnpackHistory(Data)
+
+	def ETA(self):
+		# Seconds until the daemon expects to be at its set point, -1 if
+		# it does not know
+		if not self.Connect():
+			return -1.0
+		asyncore.loop(count=1,timeout=0.001)
+		try:
+			return float(self.Client.eta)
+		except (TypeError, ValueError):
+			return -1.0
+
+	def Tracking(self, Timeout = 5.0):
+		# How well the running or last temperature sweep followed its set
+		# point, as (rms, max, mean) error in mK, the number of readings,
+		# the lag in seconds and the number of sweeps learned at that
+		# rate. None if there has been no sweep
+		if not self.Connect():
+			return None
+		Data = self.Client.query("TRACK",Timeout)
+		if not Data:
+			return None
+		Data = Data.split()
+		return tuple(float(v) for v in Data[:3]) + (int(Data[3]), float(Data[4]), int(Data[5]))
+
+	def WaitUntil(self, Status, Timeout = None):
+		return self.Wait(Status, Timeout, True)
+
+	def WaitWhile(self, Status, Timeout = None):
+		return self.Wait(Status, Timeout, False)
+
+	def Wait(self, Status, Timeout, Until):
+		# Wait on the status, reconnecting if the daemon goes away
+		if Timeout is not None:
+			End = time.time() + Timeout
+		while True:
+			Remaining = None
+			if Timeout is not None:
+				Remaining = End - time.time()
+				if Remaining <= 0:
+					return False
+			if not self.Connect():
+				time.sleep(1.0)
+				continue
+			if Until:
+				Done = self.Client.wait_until(Status, Remaining)
+			else:
+				Done = self.Client.wait_while(Status, Remaining)
+			if Done:
+				self.Status = self.Client.status
+				return True
+			if self.Connected():
+				# Timed out rather than lost the connection
+				return False
+
+	def Close(self):
+		if self.Client is not None:
+			self.Client.close()
+		if self.Shared is not None:
+			self.Shared.Close()
+		self.Client = None
+		return
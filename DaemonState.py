@@ -0,0 +1,86 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+Checkpoints of the daemon control state for a warm restart
+
+last edited : October 2026
+
+Explanation:
+
+	A daemon saves what it is doing (set point, sweep, loops, learned
+	gains etc.) to a Checkpoint every Period seconds as a dictionary, and
+	on starting loads it back, so after a crash or restart it carries on
+	where it was instead of starting from nothing. Only values that
+	json can write should be in the dictionary.
+
+	The file is written to a temporary file first and then renamed, so a
+	crash while saving leaves the last checkpoint as it was. A checkpoint
+	older than MaxAge seconds is not loaded, after a long stop the daemon
+	starts cold. The daemon should check what it restores against the
+	instruments where it can do that with one query.
+
+	The checkpoints are TDaemon.state etc. in the directory of this file.
+
+Classes:
+	Checkpoint
+
+"""
+
+import json
+import os
+import time
+
+STATE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class Checkpoint:
+
+	def __init__(self, Name, Directory = STATE_DIR, Period = 10.0, MaxAge = 3600.0):
+		self.Path = os.path.join(Directory, "%s.state" % Name)
+		self.Period = Period
+		self.MaxAge = MaxAge
+		self.LastSave = 0.0
+		return
+
+	def Due(self):
+		return time.time() - self.LastSave >= self.Period
+
+	def Save(self, State):
+		State = dict(State)
+		State["Saved"] = time.time()
+		Temp = "".join((self.Path, ".tmp"))
+		try:
+			File = open(Temp, "w")
+			json.dump(State, File)
+			File.close()
+			try:
+				os.rename(Temp, self.Path)
+			except OSError:
+				# Windows will not rename over a file
+				os.remove(self.Path)
+				os.rename(Temp, self.Path)
+		except (IOError, OSError, TypeError, ValueError) as e:
+			print "Checkpoint not saved: %s" % e
+		self.LastSave = time.time()
+		return
+
+	def Load(self):
+		# The saved state, None if there is none or it is too old
+		try:
+			File = open(self.Path)
+			State = json.load(File)
+			File.close()
+		except (IOError, ValueError):
+			return None
+		if not isinstance(State, dict):
+			print "Checkpoint %s is not a dictionary, starting cold" % self.Path
+			return None
+		try:
+			Age = time.time() - float(State.get("Saved", 0))
+		except (TypeError, ValueError):
+			Age = float("inf")
+		if Age > self.MaxAge or Age < 0:
+			print "Checkpoint %s is %.0f s old, starting cold" % (self.Path, Age)
+			return None
+		return State
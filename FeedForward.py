@@ -0,0 +1,237 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+Feed-forward of the heater current for temperature sweeps
+
+last edited : October 2026
+
+Explanation:
+
+	In a sweep the set point moves at a constant rate and the PID only
+	acts once the temperature has fallen behind it, so the temperature
+	lags the ramp. A SweepFeedForward gives the heater current the sweep
+	should need at each set point, TDaemon adds it to the PID output and
+	the PID only has to correct what is left.
+
+	The model is the current that holds the fridge at a temperature,
+	learned while it is at a set point (status 1), taken Lead seconds
+	ahead on the ramp: the mixing chamber relaxes to the temperature the
+	heater holds with a time constant, so to follow a ramp the heater has
+	to be set for where the ramp will be that long from now.
+
+	Each sweep that runs to its end is learned from, whether the
+	feed-forward was on or not. The heater current the PID ended up with
+	less the feed-forward (the residual) is averaged in bins of set point
+	1/Bins of a decade wide. The Lead of the sweep's direction and rate is
+	moved by the least squares change that explains the residual and what
+	is left is fitted with a quadratic in log10(set point), which is added
+	to the profile of that direction and rate. Both steps are scaled by
+	Learning. The fit keeps the feed-forward smooth, so the noise and any
+	ringing of one sweep are not learned. A new rate starts from the Lead
+	learned last.
+
+	The tracking error (set point - temperature) of the running sweep, or
+	of the last one, is reported as
+		rms max mean count lag learned
+	in mK, except the count of readings, the lag in seconds and the
+	number of sweeps learned at that rate. TDaemon answers the TRACK
+	command with it.
+
+	GetState and SetState give and take back what has been learned as
+	lists, for the daemon's checkpoint.
+
+Classes:
+	SweepFeedForward
+
+"""
+
+import math
+
+import numpy as np
+
+class SweepFeedForward:
+
+	def __init__(self, Bins = 100, Learning = 0.8, Smoothing = 0.1, MinPoints = 10):
+		self.Bins = Bins
+		self.Learning = Learning
+		self.Smoothing = Smoothing
+		self.MinPoints = MinPoints
+		# Current holding each temperature, by bin
+		self.Steady = {}
+		# Lead and quadratic (highest order first) of the sweeps in each
+		# direction at each rate, and how many there have been
+		self.Profiles = {}
+		self.Learned = {}
+		self.Lead = 0.0
+		# The sweep being recorded and the tracking of the last one
+		self.Run = None
+		self.Last = None
+		return
+
+	def Bin(self, Temperature):
+		return int(round(math.log10(Temperature) * self.Bins))
+
+	def Key(self, Rate, Direction):
+		if Direction < 0:
+			return (-1, float("%.4g" % abs(Rate)))
+		return (1, float("%.4g" % abs(Rate)))
+
+	def Profile(self, Rate, Direction):
+		Key = self.Key(Rate, Direction)
+		if Key in self.Profiles:
+			return self.Profiles[Key]
+		return {"Lead": self.Lead, "Fit": [0.0, 0.0, 0.0]}
+
+	def Interpolate(self, Table, Temperature):
+		# Linear in log10(temperature) between the nearest entries of
+		# Table, the end entry outside them
+		if not Table or not Temperature > 0:
+			return None
+		x = math.log10(Temperature) * self.Bins
+		Keys = sorted(Table)
+		if x <= Keys[0]:
+			return Table[Keys[0]]
+		if x >= Keys[-1]:
+			return Table[Keys[-1]]
+		i = 1
+		while Keys[i] < x:
+			i = i + 1
+		f = (x - Keys[i-1]) / (Keys[i] - Keys[i-1])
+		return Table[Keys[i-1]] + f * (Table[Keys[i]] - Table[Keys[i-1]])
+
+	def Model(self, Set, Rate, Direction, Lead):
+		Ahead = Set + Direction * abs(Rate) * Lead
+		return self.Interpolate(self.Steady, max(Ahead, Set / 2.0))
+
+	def Holding(self, Set):
+		# The current that holds the fridge at Set, None if not known
+		return self.Interpolate(self.Steady, Set)
+
+	def Current(self, Set, Rate, Direction):
+		# The feed-forward at set point Set, None if nothing is known
+		if not Set > 0:
+			return None
+		Profile = self.Profile(Rate, Direction)
+		Current = self.Model(Set, Rate, Direction, Profile["Lead"])
+		if Current is None:
+			if self.Key(Rate, Direction) not in self.Profiles:
+				return None
+			Current = 0.0
+		x = math.log10(Set)
+		Sum = 0.0
+		for c in Profile["Fit"]:
+			Sum = Sum * x + c
+		return Current + Sum
+
+	def Hold(self, Set, Current):
+		# Called with the heater current while at the set point
+		if not Set > 0:
+			return
+		b = self.Bin(Set)
+		if b in self.Steady:
+			self.Steady[b] = self.Steady[b] + self.Smoothing * (Current - self.Steady[b])
+		else:
+			self.Steady[b] = Current
+		return
+
+	def Start(self, Rate, Direction):
+		self.Run = {"Key": self.Key(Rate, Direction), "Rate": abs(Rate),
+			"Direction": Direction, "Bins": {}, "Count": 0, "Sum": 0.0,
+			"SumSq": 0.0, "Max": 0.0}
+		return
+
+	def Record(self, Set, Temperature, Current):
+		# Called with each reading of the sweep and the heater current
+		# worked out from it
+		if self.Run is None or not Set > 0:
+			return
+		Run = self.Run
+		Error = Set - Temperature
+		Run["Count"] = Run["Count"] + 1
+		Run["Sum"] = Run["Sum"] + Error
+		Run["SumSq"] = Run["SumSq"] + Error ** 2
+		Run["Max"] = max(Run["Max"], abs(Error))
+		Feed = self.Current(Set, Run["Rate"], Run["Direction"])
+		Bin = Run["Bins"].setdefault(self.Bin(Set), [0.0, 0])
+		Bin[0] = Bin[0] + Current - (Feed or 0.0)
+		Bin[1] = Bin[1] + 1
+		return
+
+	def Finish(self, Complete):
+		# Called when the sweep stops, it is only learned from if it ran
+		# to its end
+		Run = self.Run
+		self.Run = None
+		if Run is None:
+			return
+		self.Last = self.Tracking(Run)
+		if not Complete or Run["Count"] < self.MinPoints or len(Run["Bins"]) < 3:
+			return
+		Rate = Run["Rate"]
+		Direction = Run["Direction"]
+		Profile = self.Profile(Rate, Direction)
+		Bins = sorted(Run["Bins"])
+		Sets = np.array([10.0 ** (float(b) / self.Bins) for b in Bins])
+		Residual = np.array([Run["Bins"][b][0] / Run["Bins"][b][1] for b in Bins])
+		Weight = np.array([float(Run["Bins"][b][1]) for b in Bins])
+		Lead = Profile["Lead"]
+		if self.Steady and Rate > 0:
+			# Change of the model per second of lead
+			Slope = np.array([(self.Model(s, Rate, Direction, Lead + 1.0) - self.Model(s, Rate, Direction, Lead - 1.0)) / 2.0 for s in Sets])
+			Norm = np.sum(Weight * Slope ** 2)
+			if Norm > 0:
+				Step = self.Learning * np.sum(Weight * Slope * Residual) / Norm
+				Step = max(Step, -Lead)
+				Lead = Lead + Step
+				Residual = Residual - Step * Slope
+		Fit = np.polyfit(np.log10(Sets), Residual, 2, w=np.sqrt(Weight))
+		Fit = [a + self.Learning * b for a, b in zip(Profile["Fit"], Fit)]
+		self.Profiles[Run["Key"]] = {"Lead": Lead, "Fit": Fit}
+		self.Learned[Run["Key"]] = self.Learned.get(Run["Key"], 0) + 1
+		self.Lead = Lead
+		return
+
+	def Tracking(self, Run = None):
+		# rms, max and mean error, count, lag and sweeps learned
+		if Run is None:
+			Run = self.Run
+		if Run is None:
+			return self.Last
+		N = Run["Count"]
+		if N == 0:
+			return (0.0, 0.0, 0.0, 0, 0.0, self.Learned.get(Run["Key"], 0))
+		Mean = Run["Sum"] / N
+		RMS = math.sqrt(Run["SumSq"] / N)
+		Lag = 0.0
+		if Run["Rate"] > 0:
+			Lag = Run["Direction"] * Mean / Run["Rate"]
+		return (RMS, Run["Max"], Mean, N, Lag, self.Learned.get(Run["Key"], 0))
+
+	def Report(self):
+		Tracking = self.Tracking()
+		if Tracking is None:
+			return ""
+		return "%.4g %.4g %.4g %d %.4g %d" % Tracking
+
+	def GetState(self):
+		# What has been learned, as lists so json can write it
+		Profiles = []
+		for Key in sorted(self.Profiles):
+			Profile = self.Profiles[Key]
+			Profiles.append([Key[0], Key[1], float(Profile["Lead"]),
+				[float(c) for c in Profile["Fit"]], self.Learned.get(Key, 0)])
+		return {"Steady": [[b, float(c)] for b, c in sorted(self.Steady.items())],
+			"Profiles": Profiles, "Lead": float(self.Lead)}
+
+	def SetState(self, State):
+		self.Steady = dict((int(b), c) for b, c in State["Steady"])
+		self.Profiles = {}
+		self.Learned = {}
+		for Direction, Rate, Lead, Fit, Learned in State["Profiles"]:
+			Key = (int(Direction), Rate)
+			self.Profiles[Key] = {"Lead": Lead, "Fit": list(Fit)}
+			self.Learned[Key] = Learned
+		self.Lead = State["Lead"]
+		return
@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+Write-through cache of instrument settings
+
+last edited : October 2026
+
+Explanation:
+
+	A CachedInstrument wraps a visa instrument (or anything with write,
+	ask and close, e.g. the simulated instruments of SimPlant) and keeps
+	the last confirmed value of each setting, keyed by a name the driver
+	chooses e.g. ("DAC",2) or ":SOUR:VOLT". A driver changes a setting
+	with Set, which only talks to the instrument if the value is not the
+	one it already has, so the same source level or heater current sent
+	every loop costs nothing on the bus. The value is only kept once the
+	write has gone through, if it raises the setting is forgotten so the
+	next Set sends it again.
+
+	Reads are served from the cache with Get, or Query which asks the
+	instrument only when the setting is not known or is older than MaxAge
+	seconds. Settings the instrument reports in one answer (e.g. the TCS
+	STATUS?) are recorded with Update. Anything that changes settings
+	behind the cache's back (*RST, a recalled setup, the front panel)
+	should be followed by Invalidate.
+
+	write, ask and close go straight through to the instrument, as do its
+	other attributes (reading and setting e.g. timeout or stb), so the
+	wrapped instrument can be used as before.
+	Sent, Skipped and Served count the settings written, the writes
+	skipped and the reads served from the cache.
+
+Classes:
+	CachedInstrument
+
+"""
+
+import threading
+import time
+
+# Attributes of the cache, the others are the instrument's
+CACHE_ATTRIBUTES = ("Visa", "Clock", "State", "Lock", "Sent", "Skipped", "Served")
+
+class CachedInstrument:
+
+	def __init__(self, Visa, Clock = time):
+		self.Visa = Visa
+		self.Clock = Clock
+		# Setting -> (value, time it was confirmed)
+		self.State = {}
+		self.Lock = threading.RLock()
+		self.Sent = 0
+		self.Skipped = 0
+		self.Served = 0
+		return
+
+	def __getattr__(self, Name):
+		if Name == "Visa":
+			raise AttributeError(Name)
+		return getattr(self.Visa, Name)
+
+	def __setattr__(self, Name, Value):
+		if Name in CACHE_ATTRIBUTES:
+			self.__dict__[Name] = Value
+		else:
+			setattr(self.Visa, Name, Value)
+
+	def write(self, Command):
+		self.Visa.write(Command)
+		return
+
+	def ask(self, Command):
+		return self.Visa.ask(Command)
+
+	def close(self):
+		self.Visa.close()
+		return
+
+	def Set(self, Key, Value, Command, Ask = False):
+		# Send Command to set Key to Value unless it has that value
+		# already, with Ask the command is sent with ask (as the TCS
+		# answers every command). Returns whether it was sent
+		with self.Lock:
+			if Key in self.State and self.State[Key][0] == Value:
+				self.Skipped = self.Skipped + 1
+				return False
+			self.State.pop(Key, None)
+			if Ask:
+				self.Visa.ask(Command)
+			else:
+				self.Visa.write(Command)
+			self.State[Key] = (Value, self.Clock.time())
+			self.Sent = self.Sent + 1
+		return True
+
+	def Update(self, Key, Value):
+		# Record a value read back from the instrument
+		with self.Lock:
+			self.State[Key] = (Value, self.Clock.time())
+		return
+
+	def Age(self, Key):
+		# Seconds since Key was confirmed, inf if it is not known
+		with self.Lock:
+			if Key not in self.State:
+				return float("inf")
+			return self.Clock.time() - self.State[Key][1]
+
+	def Get(self, Key, MaxAge = None):
+		# The cached value of Key, None if it is not known or too old
+		with self.Lock:
+			if Key not in self.State:
+				return None
+			Value, Stamp = self.State[Key]
+			if MaxAge is not None and self.Clock.time() - Stamp > MaxAge:
+				return None
+			self.Served = self.Served + 1
+			return Value
+
+	def Query(self, Key, Command, Parse = float, MaxAge = None):
+		# The value of Key, asked for with Command and converted with Parse
+		# if the cache cannot answer
+		with self.Lock:
+			Value = self.Get(Key, MaxAge)
+			if Value is None:
+				Value = Parse(self.Visa.ask(Command))
+				self.Update(Key, Value)
+		return Value
+
+	def Invalidate(self, Key = None):
+		# Forget Key, or every setting
+		with self.Lock:
+			if Key is None:
+				self.State.clear()
+			else:
+				self.State.pop(Key, None)
+		return
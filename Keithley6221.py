@@ -24,6 +24,7 @@ Classes for:
 import rpyc
 import visa as visa
 import VisaSubs as VisaSubs
+import InstrumentCache
 import string as string
 import re as re
 from collections import namedtuple
@@ -36,6 +37,9 @@ import Queue
 ######################################################
 # At the moment each of the instruments we use is a
 # seperate class
+#
+# The settings go through an InstrumentCache so the
+# same value is not sent to the instrument twice
 #####################################################
 
 
@@ -45,7 +49,7 @@ class k6221:
 		# The setup option sets the setup that we use if doSetup is True 
 
 		self.Address = address
-		self.Visa = VisaSubs.InitializeGPIB(address,0,term_chars = "\\n")
+		self.Visa = InstrumentCache.CachedInstrument(VisaSubs.InitializeGPIB(address,0,term_chars = "\\n"))
 		# Other 6430 properties
 		self.Compliance = compliance
 		self.AnalogFilter = analogFilter
@@ -62,6 +66,7 @@ class k6221:
 		if doSetup:
 			self.Visa.write("*RST")
 			self.Visa.write("".join(("SYST:POS ",setupOption)))
+			self.Visa.Invalidate()
 
 
 	######################################
@@ -146,10 +151,9 @@ class k6221:
 	################################################
 
 	def ReadWave(self):
-		Reply = self.Visa.ask("SOUR:WAVE:FREQ?")
-		self.Frequency = float(Reply)
-		Reply = self.Visa.ask("SOUR:WAVE:AMPL?")
-		self.Amplitude = float(Reply)
+		# Only asks the source for what was not set from here
+		self.Frequency = self.Visa.Query("SOUR:WAVE:FREQ","SOUR:WAVE:FREQ?")
+		self.Amplitude = self.Visa.Query("SOUR:WAVE:AMPL","SOUR:WAVE:AMPL?")
 		pass
 	
 
@@ -158,8 +162,8 @@ class k6221:
 	##################################################
 
 	def SetWave(self,Amp,Freq):
-		self.Visa.write("SOUR:WAVE:CURR %.4e" % Amp)
-		self.Visa.write("SOUR:WAVE:FREQ %.4e" % Amp)		
+		self.Visa.Set("SOUR:WAVE:AMPL",float("%.4e" % Amp),"SOUR:WAVE:AMPL %.4e" % Amp)
+		self.Visa.Set("SOUR:WAVE:FREQ",float("%.4e" % Freq),"SOUR:WAVE:FREQ %.4e" % Freq)
 		pass
 
 	#################################################
@@ -168,7 +172,7 @@ class k6221:
 
 	def SwitchOutput(self):
 		self.Output = not self.Output		
-		self.Visa.write("".join((":OUTP:STAT ","%d" % self.Output)))
+		self.Visa.Set(":OUTP:STAT",int(self.Output),"".join((":OUTP:STAT ","%d" % self.Output)))
 		pass
 
 	#################################################
@@ -24,6 +24,7 @@ Classes for:
 import rpyc
 import visa as visa
 import VisaSubs as VisaSubs
+import InstrumentCache
 import string as string
 import re as re
 from collections import namedtuple
@@ -36,6 +37,9 @@ import Queue
 ######################################################
 # At the moment each of the instruments we use is a
 # seperate class
+#
+# The settings go through an InstrumentCache so the
+# same value is not sent to the instrument twice
 #####################################################
 
 
@@ -43,7 +47,7 @@ import Queue
 class k6430:
 	def __init__(self,address, compliance = 105e-9, median = 0,repetition =1, integration = 1,source = "VOLT",delay = 0.1, trigger = 0):
 		self.Address = address
-		self.Visa = VisaSubs.InitializeGPIB(address,0,term_chars = "\\n")
+		self.Visa = InstrumentCache.CachedInstrument(VisaSubs.InitializeGPIB(address,0,term_chars = "\\n"))
 		# Other 6430 properties
 		self.Compliance = compliance
 		self.Source = source
@@ -53,7 +57,7 @@ class k6430:
 		self.Delay = delay # Defaults to 0 (second)
 		self.Trigger = trigger # Trigger delay (defaults to 0)
 		self.Output = False
-		self.Visa.write(":OUTP 0")
+		self.Visa.Set(":OUTP:STAT",0,":OUTP 0")
 		self.Data = [0 ,0]
 		self.Sense = []
 
@@ -64,8 +68,8 @@ class k6430:
 	def Initialize(self,SkipCompliance = False,SkipMath = False):
 
 		# A bunch of commands to configure the 6430
-		self.Visa.write("*RST")
-		time.sleep(.1)
+		VisaSubs.Complete(self.Visa,"*RST")
+		self.Visa.Invalidate()
 		self.Visa.write("".join((":SOUR:FUNC:MODE ",self.Source)))
 		# Configure the auto zero (reference)
 		self.Visa.write(":SYST:AZER:STAT ON")
@@ -106,12 +110,14 @@ class k6430:
 	def SetRangeCompliance(self, Range = 105, Compliance = 105):
 
 		self.Compliance = Compliance
-		self.Visa.write("".join((":SENS:",self.Sense,":PROT:LEV %.3e" % self.Compliance)))
+		Key = "".join((":SENS:",self.Sense,":PROT:LEV"))
+		self.Visa.Set(Key,"%.3e" % self.Compliance,"".join((Key," %.3e" % self.Compliance)))
 		
+		Key = "".join((":SENS:",self.Sense,":RANG"))
 		if Range:
-			self.Visa.write("".join((":SENS:",self.Sense,":RANG ","%.2e" % Range)))
+			self.Visa.Set(Key,"%.2e" % Range,"".join((Key," %.2e" % Range)))
 		else:
-			self.Visa.write("".join((":SENS:",self.Sense,":RANG:AUTO 1")))
+			self.Visa.Set(Key,"AUTO","".join((Key,":AUTO 1")))
 		
 		pass
 
@@ -130,7 +136,8 @@ class k6430:
 	##################################################
 
 	def SetSource(self,Level):
-		self.Visa.write("".join((":SOUR:",self.Source," %.4e" % Level)))
+		Key = "".join((":SOUR:",self.Source))
+		self.Visa.Set(Key,"%.4e" % Level,"".join((Key," %.4e" % Level)))
 		pass
 
 	#################################################
@@ -139,7 +146,7 @@ class k6430:
 
 	def SwitchOutput(self):
 		self.Output = not self.Output		
-		self.Visa.write("".join((":OUTP:STAT ","%d" % self.Output)))
+		self.Visa.Set(":OUTP:STAT",int(self.Output),"".join((":OUTP:STAT ","%d" % self.Output)))
 		pass
 	
 	#################################################
@@ -221,9 +228,15 @@ class k6430:
 	#########################################
 	
 	def Ramp(self,Finish):
-		if self.Output:
-			self.ReadData()
-		VStart = self.Data[0]
+		# Start from the level last set if it is known rather than
+		# measuring it
+		Level = self.Visa.Get("".join((":SOUR:",self.Source)))
+		if Level is not None:
+			VStart = float(Level)
+		else:
+			if self.Output:
+				self.ReadData()
+			VStart = self.Data[0]
 		N = max(100,int(abs(Finish-VStart)/0.1))
 		VSweep = np.linspace(VStart,Finish,num=N+1)
 
@@ -22,6 +22,13 @@ last edited :  Feb 2014
 	By definition the magnet is in persistent mode if the switch heater is off
 	including if the magnet is at zero and the source is at zero
 
+	The job (targets, mode, the step it is at and the heater lock) and the
+	magnet constants are checkpointed whenever they change (see
+	DaemonState). Started within an hour of the checkpoint the daemon only
+	reads the switch heater, and if it is as it was the constants are not
+	asked for again and the job carries on from the step it was at, the
+	steps only ramp the source if the magnet is not already ramping.
+
 """
 
 import SocketUtils as SocketUtils
@@ -34,6 +41,9 @@ import time
 import numpy as np
 import asyncore
 from datetime import datetime
+import SharedTelemetry
+import RingBuffer
+import DaemonState
 
 class MControl():
 
@@ -55,6 +65,10 @@ class MControl():
 		# Open the socket
 		address = ('localhost',18861)
 		self.Server = SocketUtils.SockServer(address)
+		self.Encoder = SocketUtils.TelemetryEncoder()
+		self.Shared = SharedTelemetry.TelemetryWriter("FIELD")
+		# Field, magnet current and status
+		self.History = RingBuffer.RingBuffer(3)
 		# Define some important parameters for the magnet
 		self.Field = 0.0
 		self.Current = 0.0
@@ -75,7 +89,10 @@ class MControl():
 
 		self.SweepNow = False
 		self.Busy = False
+		self.HeaterBusy = False
 		self.Mode = 0 # 0 = Set mode, 1 = Sweep mode
+		# The job is checkpointed for a warm restart
+		self.Checkpoint = DaemonState.Checkpoint("MDaemon")
 		return
 
 	#!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
@@ -262,13 +279,21 @@ class MControl():
 	# On start get parameters
 	##########################################################
 
-	def MagnetOnStartUp(self):
+	def MagnetOnStartUp(self, State = None):
 
 		self.MagnetReadHeater()
-		self.AToB = self.MagnetReadConfNumeric("ATOB")
+		if State is not None and bool(State["Heater"]) != bool(self.Heater):
+			# The heater was switched while the daemon was down
+			print "Switch heater is not as checkpointed, starting cold"
+			State = None
+		if State is None:
+			self.AToB = self.MagnetReadConfNumeric("ATOB")
+			self.CurrentLimit = self.MagnetReadConfNumeric("CLIM")
+		else:
+			self.SetState(State)
 		self.MagnetReadField()
-		self.CurrentLimit = self.MagnetReadConfNumeric("CLIM")
-		self.TargetCurrent = self.Field * self.AToB
+		if State is None:
+			self.TargetCurrent = self.Field * self.AToB
 
 		if self.Heater:
 			HeaterString = "ON"
@@ -279,6 +304,34 @@ class MControl():
 
 		return
 
+	##########################################################
+	# The job for the checkpoint and back
+	##########################################################
+
+	def GetState(self):
+		LockTime = 0.0
+		if self.Lock:
+			LockTime = time.mktime(self.LockTime.timetuple())
+		return {"AToB": self.AToB, "CurrentLimit": self.CurrentLimit,
+			"Heater": bool(self.Heater), "Lock": self.Lock, "LockTime": LockTime,
+			"DelayedAction": self.DelayedAction, "TargetCurrent": self.TargetCurrent,
+			"TargetSweep": self.TargetSweep, "TargetRate": self.TargetRate,
+			"TargetHeater": self.TargetHeater, "SweepNow": self.SweepNow,
+			"Busy": self.Busy, "HeaterBusy": self.HeaterBusy, "Mode": self.Mode}
+
+	def SetState(self, State):
+		Names = ("AToB", "CurrentLimit", "Lock", "DelayedAction",
+			"TargetCurrent", "TargetSweep", "TargetRate", "TargetHeater",
+			"SweepNow", "Busy", "HeaterBusy", "Mode")
+		# All read before any is set, a bad checkpoint changes nothing
+		Values = [State[Name] for Name in Names]
+		for Name, Value in zip(Names, Values):
+			setattr(self, Name, Value)
+		if self.Lock:
+			self.LockTime = datetime.fromtimestamp(State["LockTime"])
+		print "Restored the job of %.0f s ago" % (time.time() - State["Saved"])
+		return
+
 	##########################################################
 	# Set the leads current, ignore the switch heater state, busy etc
 	##########################################################
@@ -321,14 +374,17 @@ class MControl():
 			
 		return Status
 
-	# Interpret a message from the socket
+	# Interpret a message from the socket, returns whether there is a new
+	# action and whether the message was a valid command
 	def ReadMsg(self,Msg):
 		Msg = Msg.split(" ")
 		GotAction = False
+		Valid = False
 		if Msg[0] == "SET":
 			try:
 				NewTarget = float(Msg[1])
 				FinalHeater = int(Msg[2])
+				Valid = True
 				self.TargetHeater = bool(FinalHeater)
 				NewTargetI = NewTarget * self.AToB
 				if abs(self.TargetCurrent-NewTargetI) > 0.05:
@@ -337,7 +393,7 @@ class MControl():
 					self.Mode = 0
 					self.TargetCurrent = NewTargetI
 					self.TargetRate = self.MaxRate
-					print "Got new set point from socket %.2f T" % self.TargetCurrent/self.AToB
+					print "Got new set point from socket %.2f T" % (self.TargetCurrent/self.AToB)
 			
 			except:
 				pass
@@ -349,6 +405,7 @@ class MControl():
 				SweepTarget = float(Msg[2])
 				SweepRate = float(Msg[3])
 				FinalHeater = int(Msg[4])
+				Valid = True
 				self.TargetHeater = bool(FinalHeater)
 				NewTargetI = NewTarget * self.AToB
 				SweepTargetI = SweepTarget * self.AToB
@@ -358,7 +415,7 @@ class MControl():
 					self.TargetCurrent = NewTargetI
 					self.TargetSweep = SweepTargetI
 					self.TargetRate = SweepRate
-					print "Got new sweep point from socket from %.2f to " % (self.TargetCurrent/self.AToB,self.TargetSweep/self.AToB,self.TargetRate)
+					print "Got new sweep point from socket from %.2f to %.2f at %.4f" % (self.TargetCurrent/self.AToB,self.TargetSweep/self.AToB,self.TargetRate)
 			
 			except:
 				pass
@@ -366,26 +423,62 @@ class MControl():
 			if self.Busy and GotAction:
 				print "Warning... Busy, but got action request... Executing new action"
 
-		return GotAction
+		return GotAction, Valid
 
 if __name__ == '__main__':
 
 	# Initialize a daemon
 	control = MControl()
-	control.MagnetOnStartUp()
-	HeaterBusy = False
+	State = control.Checkpoint.Load()
+	try:
+		control.MagnetOnStartUp(State)
+	except KeyError as e:
+		print "Checkpoint not restored: %s" % e
+		control.MagnetOnStartUp()
+	Saved = None
 	
 	while 1:
 		
+		# Read the commands from the clients, the answers are held back
+		# until the status is published so a client always sees the status
+		# change before the answer to its command
+		GotAction = False
+		Replies = []
+		Queries = []
+		for j in control.Server.handlers:
+			for MsgId, SocketMsg in j.read_requests():
+				if SocketMsg.startswith("HIST"):
+					# Answered once this reading is in the history
+					Queries.append((j, MsgId, SocketMsg))
+					continue
+				NewAction, Valid = control.ReadMsg(SocketMsg)
+				Replies.append((j, MsgId, Valid))
+				if NewAction:
+					GotAction = True
+		if GotAction:
+			control.Busy = True
+
 		# Read the field and update status
 		control.MagnetReadField()
 		StatusMsg = control.UpdateStatus()
-		# Push the reading to clients
-		for j in control.Server.handlers:
-			j.to_send = ",%.5f %d" % (control.Field, StatusMsg)
-			SocketMsg = j.received_data
-			if SocketMsg and SocketMsg != "-":
-				GotAction = control.ReadMsg(SocketMsg)
+		# Publish the reading to subscribers and add it to the history
+		# The raw value is the current in the magnet as read, the persistent
+		# current while the heater is off
+		Stamp = time.time()
+		if control.Heater:
+			Current = control.Current
+		else:
+			Current = control.PersistentCurrent
+		Frame = control.Encoder.encode(control.Field, StatusMsg, Current, Stamp)
+		control.Shared.Write(Frame)
+		control.History.Append(Stamp, [control.Field, Current, StatusMsg])
+		control.Server.publish("FIELD", Frame)
+		control.Server.publish_state("STATUS", "%d" % StatusMsg)
+		for j, MsgId, Valid in Replies:
+			j.reply(MsgId, Valid)
+		for j, MsgId, Query in Queries:
+			Data = control.History.Query(Query)
+			j.reply(MsgId, Data is not None, Data)
 		asyncore.loop(count=1,timeout=0.001)
 		if not control.Server.handlers:
 			GotAction = False
@@ -416,7 +509,7 @@ if __name__ == '__main__':
 			# Now there are a lot of possible scenarios that need to be handled
 			# 1. The heater is off  => set the source to the persistent current so it
 			# can be switched on
-			if not control.Heater and not HeaterBusy:
+			if not control.Heater and not control.HeaterBusy:
 				if (control.MagnetReadAction() != "RTOS"):
 					# Set the source to the persistent current
 					control.SourceGoSet(control.PersistentCurrent,control.MaxRate)
@@ -425,7 +518,7 @@ if __name__ == '__main__':
 					control.MagnetSetHeater(1)
 			# The heater is on
 
-			elif control.Mode == 0 and not HeaterBusy:
+			elif control.Mode == 0 and not control.HeaterBusy:
 				# We are in constant set mode
 				if abs(control.Current - control.TargetCurrent) > abs(control.TargetCurrent) * 0.005:
 					# We are not at the target
@@ -440,9 +533,9 @@ if __name__ == '__main__':
 						control.Busy = False
 						print "Task completed!\n"
 					else:
-						HeaterBusy = True
+						control.HeaterBusy = True
 
-			elif control.Mode == 1 and not HeaterBusy:
+			elif control.Mode == 1 and not control.HeaterBusy:
 				# We are in sweep mode
 				if control.SweepNow:
 					# We are now sweeping, check if the sweep is finished
@@ -455,7 +548,7 @@ if __name__ == '__main__':
 							control.Busy = False
 							print "Task completed!\n"
 						else:
-							HeaterBusy = True
+							control.HeaterBusy = True
 				else:
 					# We are not sweeping yet
 					if abs(control.Current - control.TargetCurrent) > abs(control.TargetCurrent) * 0.005:
@@ -466,10 +559,10 @@ if __name__ == '__main__':
 					else:
 						# We are at the initial target so start the sweep
 						control.MagnetSetAction("HOLD")
-						control.SourceGoSet(control.TargetSweep,control.SweepRate)
-						self.SweepNow = True
+						control.SourceGoSet(control.TargetSweep,control.TargetRate)
+						control.SweepNow = True
 
-			elif HeaterBusy:
+			elif control.HeaterBusy:
 				# The sweep is done but the heater should be switched off
 				if control.MagnetCheckSwitchable() and control.Heater:
 					# Switch the heater off
@@ -477,10 +570,17 @@ if __name__ == '__main__':
 				elif not control.Heater:
 					# Ramp the source to zero
 					control.SourceGoSet(0.0,control.MaxRate)
-					HeaterBusy = False
+					control.HeaterBusy = False
 					control.Busy = False
 					print "Task completed!"
 
+		# Checkpoint the job as soon as it changes, so a restart never
+		# takes up an earlier step
+		State = control.GetState()
+		if State != Saved or control.Checkpoint.Due():
+			control.Checkpoint.Save(State)
+			Saved = State
+
 		time.sleep(0.4)
 
 
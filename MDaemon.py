@@ -34,6 +34,7 @@ import time
 import numpy as np
 import asyncore
 import PIDControl
+import Calibration
 
 class MControl():
 
@@ -47,6 +48,7 @@ class MControl():
 		self.TCSVisa = VisaSubs.InitializeSerial("ASRL5",idn="ID?",term_chars="\\n")
 		address = ('localhost',18871)
 		self.Server = SocketUtils.SockServer(address)
+		self.Encoder = SocketUtils.TelemetryEncoder()
 		self.ResThermometer = 1
 		self.Temperature = 0
 		self.PicoChannel = 0
@@ -409,13 +411,9 @@ class MControl():
 			self.TCSCurrent[i] = int(Current[i])*TMP[int(Range[i])-1]
 		return
 
-	def CalcTemperature(self,Calibration,factor=0):
-		logR = np.log10(self.ResThermometer)-factor
-		RPoly = np.ones((len(Calibration),))
+	def CalcTemperature(self,Calibration):
 		OldT = self.Temperature
-		for i in range(1,len(RPoly)):
-			RPoly[i] = logR * RPoly[i-1]
-		self.Temperature = np.power(10,(np.sum(np.multiply(RPoly,Calibration))))
+		self.Temperature = Calibration.Convert(self.ResThermometer)
 		self.DeltaTemp = abs(self.Temperature - OldT)
 		return
 
@@ -432,13 +430,16 @@ class MControl():
 			self.Status = 0
 		return
 
-	# Interpret a message from the socket
+	# Interpret a message from the socket, returns whether there is a new
+	# set point and whether the message was a valid command
 	def ReadMsg(self,Msg):
 		Msg = Msg.split(" ")
 		GotSet = False
+		Valid = False
 		if Msg[0] == "SET":
 			try:
 				NewSet = float(Msg[1])
+				Valid = True
 				if abs(self.SetTemp-NewSet) > 5:
 					if NewSet <= self.MaxTemp:
 						self.SetTemp = NewSet
@@ -452,15 +453,17 @@ class MControl():
 		if Msg[0] == "T_ERROR":
 			try:
 				self.ErrorTemp = float(Msg[1])
+				Valid = True
 			except:
 				pass
 		if Msg[0] == "DT_ERROR":
 			try:
 				self.ErrorDeltaTemp = float(Msg[1])
+				Valid = True
 			except:
 				pass
 	
-		return GotSet
+		return GotSet, Valid
 
 	def TCSSwitchHeater(self,Heater):
 		CommandVec = np.zeros((12,))
@@ -475,8 +478,9 @@ class MControl():
 
 
 ##################### Calibrations
-SO703 = [7318.782092,-13274.53584,10276.68481,-4398.202411,1123.561007,-171.3095557,14.43456504,-0.518534965]
-SO914 = [5795.148097375,-11068.032226486,9072.821104899,-4133.466851312,1129.955799406,-185.318021359,16.881907269,-0.658939155]
+Registry = Calibration.CalibrationRegistry()
+SO703 = Registry.Get("SO703")
+SO914 = Registry.Get("SO914")
 
 if __name__ == '__main__':
 
@@ -495,12 +499,12 @@ if __name__ == '__main__':
 		# Read the picowatt and calculate the temperature
 		control.ReadPico()
 		control.CalcTemperature(SO703)
-		# Push the reading to clients
+		# Publish the reading to subscribers and read their commands
+		control.Server.publish("TEMP", control.Encoder.encode(control.Temperature, control.Status, control.ResThermometer))
 		for j in control.Server.handlers:
-			j.to_send = ",%.3f %d" % (control.Temperature, control.Status)
-			SocketMsg = j.received_data
-			if SocketMsg:
-				GotSet = control.ReadMsg(SocketMsg)
+			for MsgId, SocketMsg in j.read_requests():
+				GotSet, Valid = control.ReadMsg(SocketMsg)
+				j.reply(MsgId, Valid)
 				if GotSet:
 					pid.setPoint(control.SetTemp)
 		asyncore.loop(count=1,timeout=0.001)
@@ -63,27 +63,28 @@ from itertools import cycle
 
 def TempSocketRead(Client,OldTemp,Status):
 	asyncore.loop(count=1,timeout=0.001)
-	TString = Client.received_data
 	Temp = OldTemp
-	if TString:
-		TString = TString.split(",")[-1]
-		TString = TString.split(" ")
-		if len(TString)==2:
-			NewTemp = TString[0]
-			Status = TString[1]
+	# Every reading since the last call is queued, the newest wins
+	for TString in Client.read_all():
+		TString = TString.split(" ",1)
+		if len(TString)==2 and TString[0]=="TEMP":
 			try:
-				Temp = float(NewTemp)
+				Frame = SocketUtils.decode_telemetry(TString[1])
+				Temp = Frame.value
+				Status = "%d" % Frame.status
 			except:
 				pass
 
 	return Temp, Status
 
-def TempSocketWrite(Client,Msg):
-	Client.to_send = Msg
-	asyncore.loop(count=1,timeout=0.001)
-	time.sleep(2)
-	Client.to_send = "-"
-	asyncore.loop(count=1,timeout=0.001)
+def TempSocketWrite(Client,Msg,Timeout=5.0):
+	# Send the command and wait for the daemon to accept it
+	Reply = Client.request(Msg,Timeout)
+	if Reply == 0:
+		print "Daemon rejected \"%s\"" % Msg
+	elif Reply < 0:
+		print "No reply from daemon to \"%s\"" % Msg
+	return Reply
 
 
 def OpenCSVFile(FileName,StartTime,Lockins,Kths,comment = "No comment!\n"):
@@ -57,51 +57,32 @@ import VisaSubs as VisaSubs
 import SrsLia as LIA
 import Keithleys as keithley
 import SocketUtils as SocketUtils
+import DaemonClient
 
 from itertools import cycle
 
 
-def TempSocketRead(Client,OldTemp,Status):
-	asyncore.loop(count=1,timeout=0.001)
-	TString = Client.received_data
-	Temp = OldTemp
-	if TString:
-		TString = TString.split(",")[-1]
-		TString = TString.split(" ")
-		if len(TString)==2:
-			NewTemp = TString[0]
-			Status = TString[1]
-			try:
-				Temp = float(NewTemp)
-			except:
-				pass
-
-	return Temp, Status
-
-def MagSocketRead(Client,OldField,Status):
-	asyncore.loop(count=1,timeout=0.001)
-	MString = Client.received_data
-	Field = OldField
-	if MString:
-		MString = MString.split(",")[-1]
-		MString = MString.split(" ")
-		if len(MString)==2:
-			NewField = MString[0]
-			Status = MString[1]
-			try:
-				Field = float(NewField)
-			except:
-				pass
-
-	return Field, Status
-
-def SocketWrite(Client,Msg):
-	Client.to_send = Msg
-	asyncore.loop(count=1,timeout=0.001)
-	time.sleep(2)
-	Client.to_send = "-"
-	asyncore.loop(count=1,timeout=0.001)
+def WaitForMagnet(Client):
+	# Returns as soon as the magnet daemon reports it is idle, the status
+	# is waited on even if it was idle at the last reading as it may be
+	# from before the last command
+	if Client.Status != "0":
+		print "Waiting for magnet!"
+	Client.WaitUntil("0")
 
+def WaitForTemp(Client,SetTime,Timeout,Stable=True):
+	# Wait until Timeout minutes after SetTime for the temperature to
+	# be at the set point, or if Stable is False to stop going to set
+	Remaining = Timeout*60.0 - float((datetime.now()-SetTime).seconds)
+	if Remaining > 0:
+		print "Waiting for temperature ... time remaining = %.2f minutes" % (Remaining/60.0)
+		ETA = Client.ETA()
+		if Stable and ETA >= 0:
+			print "Daemon expects to be at set point in %.2f minutes" % (ETA/60.0)
+		if Stable:
+			Client.WaitUntil("1",Remaining)
+		else:
+			Client.WaitWhile("0",Remaining)
 
 def OpenCSVFile(FileName,StartTime,Lockins,Kths,comment = "No comment!\n"):
 	
@@ -152,7 +133,9 @@ def OpenCSVFile(FileName,StartTime,Lockins,Kths,comment = "No comment!\n"):
 		csvfile.write(k.Description())
 		ColumnString = "".join((ColumnString,", X, Y, R, Theta"))
 
-	ColumnString = "".join((ColumnString,"\n"))
+	# Each row ends with the time it was taken (seconds since the epoch),
+	# so it can be matched to the raw thermometer log (see Recalibrate)
+	ColumnString = "".join((ColumnString,", t (s)\n"))
 	csvfile.write(comment)
 	csvfile.write("\n")
 	csvfile.write(ColumnString)
@@ -173,18 +156,12 @@ def DoVgSweep(GraphProc,rpg,DataFile, Lias, Kthly,
 		Wait = 0.0, IgnoreMagnet = False,
 		ReadKeithley = False, **kwargs):
 
-	# Bind to the Temperature socket 
-	TClient = SocketUtils.SockClient('localhost', 18871)
-	TCurrent = "0"
-	TStatus = "-1" # Unset
-	# Bind to the Magnet socket 
-	MClient = SocketUtils.SockClient('localhost', 18861)
-	Field = "0"
-	MStatus = "1" # Busy
-	# Wait for the connection
-	TCurrent, TStatus = TempSocketRead(TClient, TCurrent, TStatus)
-	Field, MStatus = MagSocketRead(MClient, Field, MStatus)
-	time.sleep(5)
+	# Sessions with the temperature and magnet daemons, these stay
+	# connected between sweeps
+	TClient = DaemonClient.TempSession()
+	MClient = DaemonClient.MagnetSession()
+	TCurrent, TStatus = TClient.Read()
+	Field, MStatus = MClient.Read()
 
 	# Set the source voltages
 
@@ -197,31 +174,17 @@ def DoVgSweep(GraphProc,rpg,DataFile, Lias, Kthly,
 
 	# Go to the set temperature and magnetic field and finish in persistent mode
 	if SetTemp > 0:
-		SocketWrite(TClient," ".join(("SET","%.2f" % SetTemp)))
+		TClient.Write(" ".join(("SET","%.2f" % SetTemp)))
 		print "Wrote message to temperature socket \"SET %.2f\"" % SetTemp
 	if not IgnoreMagnet:
-		SocketWrite(MClient," ".join(("SET","%.3f" % SetField,"%d" % int(not Persist))))
+		MClient.Write(" ".join(("SET","%.3f" % SetField,"%d" % int(not Persist))))
 		print "Wrote message to Magnet socket \"SET %.3f %d\"" % (SetField, int(not Persist))
-	time.sleep(5)
 
 	# give precedence to the magnet and wait for the timeout
-	TCurrent, TStatus = TempSocketRead(TClient, TCurrent, TStatus)
-	Field, MStatus = MagSocketRead(MClient, Field, MStatus)
-	while MStatus != "0":
-		print "Waiting for magnet!"
-		time.sleep(15)
-		TCurrent, TStatus = TempSocketRead(TClient, TCurrent, TStatus)
-		Field, MStatus = MagSocketRead(MClient, Field, MStatus)	
-	
-	NowTime = datetime.now()
-	Remaining = Timeout*60.0 - float((NowTime-SetTime).seconds)
-	while (TStatus != "1") and (Remaining > 0):
-		NowTime = datetime.now()
-		Remaining = Timeout*60.0 - float((NowTime-SetTime).seconds)
-		print "Waiting for temperature ... time remaining = %.2f minutes" % (Remaining/60.0)
-		TCurrent, TStatus = TempSocketRead(TClient, TCurrent, TStatus)
-		Field, MStatus = MagSocketRead(MClient, Field, MStatus)		
-		time.sleep(15)
+	WaitForMagnet(MClient)
+	WaitForTemp(TClient,SetTime,Timeout)
+	TCurrent, TStatus = TClient.Read()
+	Field, MStatus = MClient.Read()
 	
 	time.sleep(Wait*60.0)
 
@@ -260,7 +223,7 @@ def DoVgSweep(GraphProc,rpg,DataFile, Lias, Kthly,
 	# This is the main measurement loop
 	
 	for i in xrange(len(Source)):
-		DataList = np.zeros((Samples,4+NLias*4))
+		DataList = np.zeros((Samples,5+NLias*4))
 		
 		# Set the Keithley
 		Kthly.SetSource(Source[i])
@@ -276,19 +239,20 @@ def DoVgSweep(GraphProc,rpg,DataFile, Lias, Kthly,
 			
 			# Read the magnet
 			if not IgnoreMagnet:
-				Field, MStatus = MagSocketRead(MClient, Field, MStatus)
+				Field, MStatus = MClient.Read()
 			else:
 				Field = 0.0
 			DataList[j,2] = Field
 
 			# Read the temperature
-			TCurrent, TStatus = TempSocketRead(TClient, TCurrent, TStatus)
+			TCurrent, TStatus = TClient.Read()
 			DataList[j,3] = TCurrent
 			
 			# Read the Lockins
 			for k,inst in enumerate(Lias):
 				inst.ReadData()
 				DataList[j,((k+1)*4):((k+2)*4)] = inst.Data
+			DataList[j,-1] = time.time()
 
 			# Sleep
 			time.sleep(Delay)
@@ -312,8 +276,6 @@ def DoVgSweep(GraphProc,rpg,DataFile, Lias, Kthly,
 		
 	# We are finished, now ramp the Keithley to the finish voltage
 	GraphWin.close()
-	MClient.close()
-	TClient.close()
 
 	if Stop != Finish:
 		Kthly.Ramp(Finish)
@@ -354,50 +316,30 @@ def DoTempSweep(GraphProc,rpg,DataFile,
 		Timeout = -1,
 		comment = "No comment!",
 		Persist = True, IgnoreMagnet = False,
-		ReadKeithley=False,**kwargs):
-
-	# Bind to the Temperature socket 
-	TClient = SocketUtils.SockClient('localhost', 18871)
-	TCurrent = "0"
-	TStatus = "-1" # Unset
-	# Bind to the Magnet socket 
-	MClient = SocketUtils.SockClient('localhost', 18861)
-	Field = "0"
-	MStatus = "1" # Busy
-	# Wait for the connection
-	TCurrent, TStatus = TempSocketRead(TClient, TCurrent, TStatus)
-	Field, MStatus = MagSocketRead(MClient, Field, MStatus)
-	time.sleep(5)
+		ReadKeithley=False, FeedForward = False, **kwargs):
+
+	# Sessions with the temperature and magnet daemons, these stay
+	# connected between sweeps
+	TClient = DaemonClient.TempSession()
+	MClient = DaemonClient.MagnetSession()
+	TCurrent, TStatus = TClient.Read()
+	Field, MStatus = MClient.Read()
 		
 	SetTime = datetime.now()
 
 	# Go to the specified field and finish in persistent mode
 
-	SocketWrite(TClient," ".join(("SET","%.2f" % TempStart)))
+	TClient.Write(" ".join(("SET","%.2f" % TempStart)))
 	print "Wrote message to temperature socket \"SET %.2f\"" % TempStart
 	if not IgnoreMagnet:
-		SocketWrite(MClient," ".join(("SET","%.3f" % SetField,"%d" % int(not Persist))))
+		MClient.Write(" ".join(("SET","%.3f" % SetField,"%d" % int(not Persist))))
 		print "Wrote message to Magnet socket \"SET %.3f %d\"" % (SetField, int(not Persist))
-	time.sleep(5)
 
 	# give precedence to the magnet and wait for the timeout
-	TCurrent, TStatus = TempSocketRead(TClient, TCurrent, TStatus)
-	Field, MStatus = MagSocketRead(MClient, Field, MStatus)
-	while MStatus != "0":
-		print "Waiting for magnet!"
-		time.sleep(15)
-		TCurrent, TStatus = TempSocketRead(TClient, TCurrent, TStatus)
-		Field, MStatus = MagSocketRead(MClient, Field, MStatus)	
-	
-	NowTime = datetime.now()
-	Remaining = Timeout*60.0 - float((NowTime-SetTime).seconds)
-	while (TStatus != "1") and (Remaining > 0):
-		NowTime = datetime.now()
-		Remaining = Timeout*60.0 - float((NowTime-SetTime).seconds)
-		print "Waiting for temperature ... time remaining = %.2f minutes" % (Remaining/60.0)
-		TCurrent, TStatus = TempSocketRead(TClient, TCurrent, TStatus)
-		Field, MStatus = MagSocketRead(MClient, Field, MStatus)		
-		time.sleep(15)
+	WaitForMagnet(MClient)
+	WaitForTemp(TClient,SetTime,Timeout)
+	TCurrent, TStatus = TClient.Read()
+	Field, MStatus = MClient.Read()
 
 	# Setup L plot windows
 	NLias = len(Lias)
@@ -430,13 +372,17 @@ def DoTempSweep(GraphProc,rpg,DataFile,
 	time.sleep(60)
 	print "Starting measurement!"
 
-	TempSocketWrite(TClient," ".join(("SWP","%.2f" % TempStart,"%.2f" % TempFinish,"%.4f" % (TempRate/60.0))))
+	# With FeedForward the daemon adds the heater current learned from
+	# earlier sweeps at this rate to its PID
+	SweepMsg = " ".join(("SWP","%.2f" % TempStart,"%.2f" % TempFinish,"%.4f" % (TempRate/60.0)))
+	if FeedForward:
+		SweepMsg = " ".join((SweepMsg,"FF"))
+	TClient.Write(SweepMsg)
 	TStatus = "2"
-	time.sleep(2)
 	# This is the main measurement loop
 	
 	while TStatus == "2":
-		DataList = np.zeros((4+NLias*4,))
+		DataList = np.zeros((5+NLias*4,))
 		
 		# Read the Keithley
 		if ReadKeithley:
@@ -445,19 +391,20 @@ def DoTempSweep(GraphProc,rpg,DataFile,
 			
 		# Read the magnet
 		if not IgnoreMagnet:
-			Field, MStatus = MagSocketRead(MClient, Field, MStatus)
+			Field, MStatus = MClient.Read()
 		else:
 			Field = 0.0
 		DataList[j,2] = Field
 
 		# Read the temperature
-		TCurrent, TStatus = TempSocketRead(TClient, TCurrent, TStatus)
+		TCurrent, TStatus = TClient.Read()
 		DataList[3] = TCurrent
 			
 		# Read the Lockins
 		for k,inst in enumerate(Lias):
 			inst.ReadData()
 			DataList[((k+1)*4):((k+2)*4)] = inst.Data
+		DataList[-1] = time.time()
 
 		# Save the data
 		Writer.writerow(DataList)
@@ -476,19 +423,21 @@ def DoTempSweep(GraphProc,rpg,DataFile,
 		time.sleep(Delay)
 	
 	
+	Tracking = TClient.Tracking()
+	if Tracking is not None:
+		print "Sweep tracking error %.2f mK rms, %.2f mK max, lag %.1f s" % (Tracking[0], Tracking[1], Tracking[4])
+
 	Kthly.Ramp(FinishGate)
 
 	if Kthly.Output and FinishGate == 0.0:
 		Kthly.SwitchOutput()
 
-	TempSocketWrite(TClient," ".join(("SET","%.2f" % TempFinal)))
+	TClient.Write(" ".join(("SET","%.2f" % TempFinal)))
 	# Copy the file to the network
 	time.sleep(5)
 	
 	# We are finished, now ramp the Keithley to the finish voltage
 	GraphWin.close()
-	MClient.close()
-	TClient.close()
 	
 	try:
 		shutil.copy(FilePath,NetDir)
@@ -510,49 +459,30 @@ def DoBSweep(GraphProc,rpg,DataFile,
 		FinishGate = 0.0, ReadKeithley = False,
 		comment = "No comment!"):
 	
-	# Bind to the Temperature socket 
-	TClient = SocketUtils.SockClient('localhost', 18871)
-	TCurrent = "0"
-	TStatus = "-1" # Unset
-	# Bind to the Magnet socket 
-	MClient = SocketUtils.SockClient('localhost', 18861)
-	Field = "0"
-	MStatus = "1" # Busy
-	# Wait for the connection
-	TCurrent, TStatus = TempSocketRead(TClient, TCurrent, TStatus)
-	Field, MStatus = MagSocketRead(MClient, Field, MStatus)
-	time.sleep(5)
+	# Sessions with the temperature and magnet daemons, these stay
+	# connected between sweeps
+	TClient = DaemonClient.TempSession()
+	MClient = DaemonClient.MagnetSession()
+	TCurrent, TStatus = TClient.Read()
+	Field, MStatus = MClient.Read()
 	
 	# Tell the magnet daemon to go to the inital field and set the temperature
 	if SetTemp > 0:
-		SocketWrite(TClient," ".join(("SET","%.2f" % SetTemp)))
+		TClient.Write(" ".join(("SET","%.2f" % SetTemp)))
 		print "Wrote message to temperature socket \"SET %.2f\"" % SetTemp
 	if HeaterConst:
-		TempSocketWrite(TClient," ".join(("CST","%.2f" % HeaterConst)))	
-	SocketWrite(MClient," ".join(("SET","%.3f" % Start,"1")))
+		TClient.Write(" ".join(("CST","%.2f" % HeaterConst)))	
+	MClient.Write(" ".join(("SET","%.3f" % Start,"1")))
 	print "Wrote message to Magnet socket \"SET %.3f 1\"" % Start
-	time.sleep(5)
 	SetTime = datetime.now()
 
 	# Wait for the temperature timeout
-	NowTime = datetime.now()
-	Remaining = Timeout*60.0 - (NowTime-SetTime).seconds
-	TCurrent, TStatus = TempSocketRead(TClient, TCurrent, TStatus)
-	Field, MStatus = MagSocketRead(MClient, Field, MStatus)		
-	while TStatus == "0" and Remaining > 0:
-		NowTime = datetime.now()
-		Remaining = Timeout*60.0 - (NowTime-SetTime).seconds*1.0
-		print "Time remaining = %.2f minutes" % (Remaining/60.0)
-		TCurrent, TStatus = TempSocketRead(TClient, TCurrent, TStatus)
-		Field, MStatus = MagSocketRead(MClient, Field, MStatus)
-		time.sleep(15)
+	WaitForTemp(TClient,SetTime,Timeout,Stable=False)
 	
 	# Wait more for the magnet if necessary
-	while MStatus != "0":
-		print "Waiting for magnet!"
-		time.sleep(15)
-		TCurrent, TStatus = TempSocketRead(TClient, TCurrent, TStatus)
-		Field, MStatus = MagSocketRead(MClient, Field, MStatus)	
+	WaitForMagnet(MClient)
+	TCurrent, TStatus = TClient.Read()
+	Field, MStatus = MClient.Read()
 
 	# Turn on the Keithley and then wait for a bit
 	#Kthly.SetSource(0)
@@ -589,16 +519,15 @@ def DoBSweep(GraphProc,rpg,DataFile,
 	Writer, FilePath, NetDir = OpenCSVFile(DataFile,StartTime,Lias,[Kthly],comment = comment)
 
 	# Start the sweep
-	SocketWrite(MClient," ".join(("SWP","%.3f" % Start,"%.3f" % Stop,"%d" % FinishHeater)))
+	MClient.Write(" ".join(("SWP","%.3f" % Start,"%.3f" % Stop,"%.4f" % Rate,"%d" % FinishHeater)))
 
-	while MStatus != "2":
-		time.sleep(1)
-		TCurrent, TStatus = TempSocketRead(TClient, TCurrent, TStatus)
-		Field, MStatus = MagSocketRead(MClient, Field, MStatus)	
+	MClient.WaitUntil("2")
+	TCurrent, TStatus = TClient.Read()
+	Field, MStatus = MClient.Read()
 	
 	#print Field
 	while MStatus == "2":
-		DataList = np.zeros((4+NLias*4,))
+		DataList = np.zeros((5+NLias*4,))
 		
 		# Read the Keithley
 		if ReadKeithley:
@@ -606,17 +535,18 @@ def DoBSweep(GraphProc,rpg,DataFile,
 		DataList[0:2] = Kthly.Data
 			
 		# Read the magnet
-		Field, MStatus = MagSocketRead(MClient, Field, MStatus)		
+		Field, MStatus = MClient.Read()		
 		DataList[2] = Field
 
 		# Read the temperature
-		TCurrent, TStatus = TempSocketRead(TClient, TCurrent, TStatus)
+		TCurrent, TStatus = TClient.Read()
 		DataList[3] = TCurrent
 			
 		# Read the Lockins
 		for k,inst in enumerate(Lias):
 			inst.ReadData()
 			DataList[((k+1)*4):((k+2)*4)] = inst.Data
+		DataList[-1] = time.time()
 
 		# Save the data
 		Writer.writerow(DataList)
@@ -651,8 +581,6 @@ def DoBSweep(GraphProc,rpg,DataFile,
 	
 	# We are finished
 	GraphWin.close()
-	MClient.close()
-	TClient.close()
 
 	# Copy the file to the network
 	time.sleep(5)
@@ -801,11 +729,7 @@ def DoBSeq(GraphProc,rpg,DataFile,
 				FinishGate = Source[i+1], comment = comment)
 		BLim = BLim[::-1]
 
-	MClient = SocketUtils.SockClient('localhost', 18861)
-	time.sleep(5)
-	SocketWrite(MClient,"SET 0.0 0")
-	time.sleep(5)
-	MClient.close()
+	DaemonClient.MagnetSession().Write("SET 0.0 0")
 	
 
 	return
@@ -818,12 +742,9 @@ def DoVISweep(GraphProc, rpg, DataFile, Magnet, KthMeas, KthGate,
 		VGate=0, SetTemp=-1, ReturnData = False, Delay = 0,
 		Samples = 1, Timeout = -1, comment = "No comment!", **kwargs):
 
-	# Bind to the Temperature socket 
-	TClient = SocketUtils.SockClient('localhost', 18871)
-	TCurrent = "0.0"
-	TStatus = "-1"
-	# Wait for the connection
-	time.sleep(5)
+	# Session with the temperature daemon
+	TClient = DaemonClient.TempSession()
+	TCurrent, TStatus = TClient.Read()
 
 	# Set the source voltages
 	
@@ -838,19 +759,12 @@ def DoVISweep(GraphProc, rpg, DataFile, Magnet, KthMeas, KthGate,
 
 	# Go to the specified field and finish in persistent mode
 	if SetTemp > 0:
-		TempSocketWrite(TClient," ".join(("SET","%.2f" % SetTemp)))
+		TClient.Write(" ".join(("SET","%.2f" % SetTemp)))
 	Magnet.root.MagnetGoToSet(Field, int(not Persist), rate = 2.2)
 
 	# Wait for the timeout
-	NowTime = datetime.now()
-	Remaining = Timeout*60.0 - (NowTime-SetTime).seconds
-	TCurrent, TStatus = TempSocketRead(TClient, TCurrent, TStatus)
-	while TStatus == "0" and Remaining > 0:
-		NowTime = datetime.now()
-		Remaining = Timeout*60.0 - float((NowTime-SetTime).seconds)
-		print "Time remaining = %.2f minutes" % (Remaining/60.0)
-		TCurrent, TStatus = TempSocketRead(TClient, TCurrent, TStatus)
-		time.sleep(10)
+	WaitForTemp(TClient,SetTime,Timeout,Stable=False)
+	TCurrent, TStatus = TClient.Read()
 	
 	# Setup plot windows
 	GraphWin = rpg.GraphicsWindow(title="Vg Sweep")
@@ -900,12 +814,12 @@ def DoVISweep(GraphProc, rpg, DataFile, Magnet, KthMeas, KthGate,
 			DataList = np.hstack([DataList,Field])
 
 			# Read the temperature
-			TCurrent, TStatus = TempSocketRead(TClient, TCurrent, TStatus)
+			TCurrent, TStatus = TClient.Read()
 			DataList = np.hstack([DataList,TCurrent])
 			
 			# Read the Keithley
 			KthMeas.ReadData()
-			DataList = np.hstack([DataList,KthMeas.Data])
+			DataList = np.hstack([DataList,KthMeas.Data,time.time()])
 
 			# Sleep
 			time.sleep(Delay)
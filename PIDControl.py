@@ -15,6 +15,11 @@
 #
 #
 
+import math
+import os
+
+import numpy as np
+
 
 class PID:
 	"""
@@ -58,13 +63,38 @@ class PID:
 
 		return PID
 
-	def setPoint(self,set_point):
+	def setPoint(self,set_point,bumpless=False):
 		"""
-		Initilize the setpoint of PID
+		Initilize the setpoint of PID, bumpless keeps the integral term
+		and moves the derivator with the set point so the output does not
+		jump
 		"""
+		if bumpless:
+			self.Derivator = self.Derivator + set_point - self.set_point
+		else:
+			self.Integrator=0
+			self.Derivator=0
 		self.set_point = set_point
-		self.Integrator=0
-		self.Derivator=0
+
+	def setGains(self,P,I,D,I_min=None,I_max=None):
+		"""
+		Change the gains without a jump in the output: the integrator is
+		rescaled so the integral term stays the same. I_min and I_max
+		limit the integral term (not the integrator)
+		"""
+		if I > 0 and self.Ki > 0:
+			if I_min is None:
+				I_min = self.Integrator_min * self.Ki
+			if I_max is None:
+				I_max = self.Integrator_max * self.Ki
+			self.Integrator = self.Integrator * self.Ki / I
+		if I > 0 and I_min is not None and I_max is not None:
+			self.Integrator_min = I_min / I
+			self.Integrator_max = I_max / I
+			self.Integrator = min(max(self.Integrator,self.Integrator_min),self.Integrator_max)
+		self.Kp=P
+		self.Ki=I
+		self.Kd=D
 
 	def setIntegrator(self, Integrator):
 		self.Integrator = Integrator
@@ -93,3 +123,445 @@ class PID:
 	def getDerivator(self):
 		return self.Derivator
 
+
+#######	Bank of PIDs	#########
+#
+# PIDBank runs N time aware PIDs (see TimedPID below) in numpy arrays,
+# one update works out all the outputs at once. Each controller has its
+# own set point, gains and limits. update takes an array of measurements
+# with nan where there is no new measurement, and a mask of the
+# controllers to run, the others keep their last output and are not
+# integrated. A controller that is not active forgets its last
+# measurement, so when it is run again it does not integrate the time it
+# was off. channel(i) gives an object to set up and read controller i.
+# A feed-forward can be added to the output of each controller with
+# setFeedforward, it is inside the output limits so the anti-windup
+# still works.
+#
+# b=PIDBank(3,P=10,I=2.5,Output_min=0,Output_max=25000)
+# b.channel(2).setPoint(100.0)
+# while True:
+#     outputs = b.update(measurements,time.time(),active)
+#
+
+class PIDBank:
+	"""
+	N continuous time PIDs updated together
+	"""
+
+	def __init__(self, Count, P=2.0, I=0.0, D=0.0, Integrator_max=500, Integrator_min=-500, Output_min=None, Output_max=None, N=10.0, Max_dt=10.0):
+
+		self.Count=Count
+		Full=lambda v: np.ones((Count,))*v
+		self.Kp=Full(P)
+		self.Ki=Full(I)
+		self.Kd=Full(D)
+		self.Integrator=np.zeros((Count,))
+		self.Integrator_max=Full(Integrator_max)
+		self.Integrator_min=Full(Integrator_min)
+		if Output_min is None:
+			Output_min=-np.inf
+		if Output_max is None:
+			Output_max=np.inf
+		self.Output_min=Full(Output_min)
+		self.Output_max=Full(Output_max)
+		self.N=N
+		self.Max_dt=Full(Max_dt)
+		self.set_point=np.zeros((Count,))
+		self.error=np.zeros((Count,))
+		self.Output=np.zeros((Count,))
+		self.Feedforward=np.zeros((Count,))
+		self.D_value=np.zeros((Count,))
+		self.Last_time=Full(np.nan)
+		self.Last_value=Full(np.nan)
+
+	def update(self,current_values,now,active=None):
+		"""
+		Outputs of all the controllers, those without a measurement or
+		not active keep their last output
+		"""
+
+		Values=np.asarray(current_values,dtype=np.float64)
+		Run=np.isfinite(Values)
+		if active is not None:
+			Idle=~np.asarray(active,dtype=bool)
+			self.Last_time[Idle]=np.nan
+			self.Last_value[Idle]=np.nan
+			self.D_value[Idle]=0.0
+			Run&=~Idle
+		if not Run.any():
+			return self.Output.copy()
+		y=Values[Run]
+		Kp=self.Kp[Run]
+		Ki=self.Ki[Run]
+		Kd=self.Kd[Run]
+
+		error=self.set_point[Run]-y
+		self.error[Run]=error
+		dt=np.clip(np.nan_to_num(now-self.Last_time[Run]),0.0,self.Max_dt[Run])
+
+		# Filtered derivative of the measurement, none on the first update
+		Last=self.Last_value[Run]
+		Tf=Kd/(self.N*np.maximum(Kp,1e-12))
+		D=self.D_value[Run]
+		Have=np.isfinite(Last)&(Kd != 0)&(Tf+dt > 0)
+		D[Have]=(Tf[Have]*D[Have]-Kd[Have]*(y[Have]-Last[Have]))/(Tf[Have]+dt[Have])
+		D[~Have]=0.0
+		self.D_value[Run]=D
+		self.Last_time[Run]=now
+		self.Last_value[Run]=y
+
+		Integrator=self.Integrator[Run]
+		Value=Kp*error+Ki*Integrator+D+self.Feedforward[Run]
+		Output=np.clip(Value,self.Output_min[Run],self.Output_max[Run])
+
+		# Back calculation anti-windup as TimedPID
+		Integrating=Ki > 0
+		Ti=np.where(Integrating,Kp/np.where(Integrating,Ki,1.0),0.0)
+		Tt=np.where((Kd > 0)&(Kp > 0),np.sqrt(Ti*Kd/np.maximum(Kp,1e-12)),Ti)
+		Wind=np.where(Tt > 0,(Output-Value)/np.where(Tt > 0,Tt*np.where(Integrating,Ki,1.0),1.0),0.0)
+		Integrator=np.where(Integrating,Integrator+(error+Wind)*dt,Integrator)
+		self.Integrator[Run]=np.clip(Integrator,self.Integrator_min[Run],self.Integrator_max[Run])
+
+		self.Output[Run]=Output
+		return self.Output.copy()
+
+	def channel(self,i):
+		return BankChannel(self,i)
+
+class BankChannel:
+	"""
+	One controller of a PIDBank
+	"""
+
+	def __init__(self,Bank,i):
+		self.Bank=Bank
+		self.i=i
+
+	def setPoint(self,set_point,bumpless=False):
+		b=self.Bank
+		if not bumpless:
+			b.Integrator[self.i]=0
+			self.resume()
+		b.set_point[self.i]=set_point
+
+	def resume(self):
+		# Forget the last measurement, the next update does not integrate
+		b=self.Bank
+		b.Last_time[self.i]=np.nan
+		b.Last_value[self.i]=np.nan
+		b.D_value[self.i]=0.0
+
+	def setGains(self,P,I,D,I_min=None,I_max=None):
+		b=self.Bank
+		i=self.i
+		Ki=b.Ki[i]
+		if I > 0 and Ki > 0:
+			if I_min is None:
+				I_min=b.Integrator_min[i]*Ki
+			if I_max is None:
+				I_max=b.Integrator_max[i]*Ki
+			b.Integrator[i]=b.Integrator[i]*Ki/I
+		if I > 0 and I_min is not None and I_max is not None:
+			b.Integrator_min[i]=I_min/I
+			b.Integrator_max[i]=I_max/I
+			b.Integrator[i]=min(max(b.Integrator[i],b.Integrator_min[i]),b.Integrator_max[i])
+		b.Kp[i]=P
+		b.Ki[i]=I
+		b.Kd[i]=D
+
+	def setIntegral(self,I_value):
+		# Integrator for an integral term of I_value
+		b=self.Bank
+		if b.Ki[self.i] > 0:
+			b.Integrator[self.i]=I_value/b.Ki[self.i]
+
+	def setIntegrator(self,Integrator):
+		self.Bank.Integrator[self.i]=Integrator
+
+	def setOutput(self,Output,current_value=None):
+		# Integral term so the next update at current_value gives Output,
+		# to take over a heater without a step. Without current_value
+		# the P term is left out
+		b=self.Bank
+		i=self.i
+		P_value=0.0
+		if current_value is not None:
+			P_value=b.Kp[i]*(b.set_point[i]-current_value)
+		self.setIntegral(Output-b.Feedforward[i]-P_value)
+
+	def setFeedforward(self,F_value,bumpless=False):
+		# Added to the output, bumpless moves the integral term by the
+		# change so the output carries on from where it was
+		b=self.Bank
+		i=self.i
+		if bumpless and b.Ki[i] > 0:
+			Integrator=b.Integrator[i]-(F_value-b.Feedforward[i])/b.Ki[i]
+			b.Integrator[i]=min(max(Integrator,b.Integrator_min[i]),b.Integrator_max[i])
+		b.Feedforward[i]=F_value
+
+	def getFeedforward(self):
+		return self.Bank.Feedforward[self.i]
+
+	def getPoint(self):
+		return self.Bank.set_point[self.i]
+
+	def getError(self):
+		return self.Bank.error[self.i]
+
+	def getIntegrator(self):
+		return self.Bank.Integrator[self.i]
+
+
+#######	Time aware PID	#########
+#
+# TimedPID takes the time of each measurement and integrates over the
+# actual interval, so the gains are per second (Ki in 1/s, Kd in s) and
+# do not depend on how fast or regularly the loop runs. The output is
+# clamped to Output_min..Output_max and the integrator is wound back by
+# the amount the output was clamped (back calculation, with tracking
+# time Tt = sqrt(Ti*Td), or Ti without D) so it does not wind up while
+# the heater is saturated. The derivative is of the measurement, not the
+# error, so a new set point gives no kick, and it is low pass filtered
+# with time constant Td/N.
+#
+# The interval integrated over is at most Max_dt, and there is none at
+# all for the first measurement after a new set point (not bumpless) or
+# after resume, so a loop that has not been updated for a while (heater
+# off, tuning) does not integrate the whole time it was idle. Call
+# resume when updates start again after a pause.
+#
+# p=TimedPID(3.0,0.4,1.2,Output_min=0,Output_max=25000)
+# p.setPoint(5.0)
+# while True:
+#     pid = p.update(measurement_value,time.time())
+#
+
+class TimedPID(BankChannel):
+	"""
+	Continuous time PID with anti-windup and a filtered derivative, a
+	PIDBank of one
+	"""
+
+	def __init__(self, P=2.0, I=0.0, D=0.0, Integrator=0, Integrator_max=500, Integrator_min=-500, Output_min=None, Output_max=None, N=10.0, Max_dt=10.0):
+
+		Bank=PIDBank(1,P=P,I=I,D=D,Integrator_max=Integrator_max,Integrator_min=Integrator_min,Output_min=Output_min,Output_max=Output_max,N=N,Max_dt=Max_dt)
+		BankChannel.__init__(self,Bank,0)
+		self.setIntegrator(Integrator)
+
+	def update(self,current_value,now):
+		"""
+		Calculate PID output value for the measurement taken at time now
+		"""
+		return self.Bank.update([current_value],now)[0]
+
+
+#######	Autotuning	#########
+#
+# RelayTuner finds gains by relay feedback (Astrom and Hagglund): the
+# output is switched between Bias+Amplitude and Bias-Amplitude each time
+# the measurement crosses the set point, which makes the plant oscillate
+# at its ultimate period Pu with an amplitude a. The ultimate gain is then
+#     Ku = 4*d / (pi*sqrt(a**2 - h**2))
+# for a relay of half height d and hysteresis h, and the gains follow the
+# Tyreus-Luyben rules, which overshoot less than Ziegler-Nichols:
+#     Kp = Ku/2.2    Ti = 2.2*Pu    Td = Pu/6.3
+# The gains are per second (Ki = Kp/Ti, Kd = Kp*Td) as TimedPID uses,
+# PID works per sample so scale them with perSample for it.
+#
+# If the measurement has not crossed the set point often enough MaxTime
+# seconds after the first update (the relay is too small to move it
+# past the hysteresis, or the output is clamped) the tuner gives up:
+# Failed is set and the output stays at Bias.
+#
+# t=RelayTuner(100.0,Bias=2000,Amplitude=1000)
+# while not t.Done:
+#     output = t.update(measurement_value,time.time())
+# Kp,Ki,Kd = t.Gains
+#
+# The gains found at each set point are kept in a file, one line of
+# "set_point Kp Ki Kd" per set point, with saveGains and loadGains. A line
+# may also give the limits of the integral term, "set_point Kp Ki Kd
+# I_min I_max". GainSchedule interpolates the table between set points.
+#
+
+GAINS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),"PIDGains.dat")
+
+class RelayTuner:
+	"""
+	Relay feedback autotuning
+	"""
+
+	def __init__(self, set_point, Bias, Amplitude, Hysteresis=1.0, Cycles=3, Output_min=0, Output_max=None, MaxTime=None):
+
+		self.set_point=set_point
+		self.Hysteresis=Hysteresis
+		self.Cycles=Cycles
+		self.MaxTime=MaxTime
+		self.Bias=Bias
+		self.High=Bias+Amplitude
+		self.Low=Bias-Amplitude
+		if Output_max is not None:
+			self.High=min(self.High,Output_max)
+		self.Low=max(self.Low,Output_min)
+
+		self.State=0
+		self.Crossings=[]
+		self.Peaks=[]
+		self.Max=None
+		self.Min=None
+		self.Samples=0
+		self.First=None
+		self.Last=None
+
+		self.Done=False
+		self.Failed=False
+		self.Gains=None
+		self.Ku=None
+		self.Pu=None
+		self.SamplePeriod=None
+
+	def update(self,current_value,now):
+		"""
+		Relay output for the measurement at time now
+		"""
+
+		if self.First is None:
+			self.First=now
+		self.Last=now
+		self.Samples=self.Samples+1
+
+		if self.Failed or (self.MaxTime is not None and now-self.First > self.MaxTime):
+			self.Failed=True
+			return self.Bias
+
+		if self.State == 0:
+			if current_value < self.set_point:
+				self.State=1
+			else:
+				self.State=-1
+
+		if self.Max is None or current_value > self.Max:
+			self.Max=current_value
+		if self.Min is None or current_value < self.Min:
+			self.Min=current_value
+
+		if self.State == 1 and current_value > self.set_point + self.Hysteresis:
+			# Rising through the set point, one period since the last
+			self.State=-1
+			if self.Crossings:
+				self.Peaks.append((self.Max,self.Min))
+			self.Crossings.append(now)
+			self.Max=current_value
+			self.Min=current_value
+			if len(self.Peaks) > self.Cycles:
+				self.finish()
+		elif self.State == -1 and current_value < self.set_point - self.Hysteresis:
+			self.State=1
+
+		if self.State == 1:
+			return self.High
+		return self.Low
+
+	def finish(self):
+		# The first period starts from wherever the plant was, leave it out
+		Peaks=self.Peaks[1:]
+		Periods=[b-a for a,b in zip(self.Crossings[1:-1],self.Crossings[2:])]
+		self.Pu=sum(Periods)/len(Periods)
+		a=sum((p[0]-p[1])/2.0 for p in Peaks)/len(Peaks)
+		d=(self.High-self.Low)/2.0
+		a=math.sqrt(max(a**2-self.Hysteresis**2,(a/10.0)**2))
+		self.Ku=4*d/(math.pi*a)
+		Kp=self.Ku/2.2
+		Ti=2.2*self.Pu
+		Td=self.Pu/6.3
+		self.Gains=(Kp,Kp/Ti,Kp*Td)
+		self.SamplePeriod=(self.Last-self.First)/max(self.Samples-1,1)
+		self.Done=True
+
+def perSample(Gains, SamplePeriod):
+	"""
+	Per second gains to the per sample gains used by PID
+	"""
+	Kp,Ki,Kd=Gains
+	return Kp,Ki*SamplePeriod,Kd/SamplePeriod
+
+def loadGains(Path=GAINS_FILE):
+	"""
+	Tuned gains as a list of (set_point,Kp,Ki,Kd) sorted by set point
+	"""
+	Gains=[]
+	if not os.path.exists(Path):
+		return Gains
+	for Line in open(Path):
+		Line=Line.split("#",1)[0].split()
+		if len(Line) in (4,6):
+			Gains.append(tuple(float(v) for v in Line))
+	Gains.sort()
+	return Gains
+
+def saveGains(set_point, Gains, Path=GAINS_FILE):
+	"""
+	Store the gains (Kp,Ki,Kd) or (Kp,Ki,Kd,I_min,I_max) for set_point,
+	replacing any there were. The limits stay if only gains are given
+	"""
+	Gains=tuple(Gains)
+	Table=[]
+	for g in loadGains(Path):
+		if g[0] != set_point:
+			Table.append(g)
+		elif len(Gains) == 3 and len(g) == 6:
+			Gains=Gains+g[4:]
+	Table.append((set_point,)+Gains)
+	Table.sort()
+	File=open(Path,"w")
+	File.write("# set_point Kp Ki Kd [I_min I_max], gains per second\n")
+	for g in Table:
+		File.write(" ".join("%.6g" % v for v in g)+"\n")
+	File.close()
+
+class GainSchedule:
+	"""
+	Gains interpolated between set points
+	"""
+
+	def __init__(self, Table, I_min=None, I_max=None):
+
+		# Table as from loadGains, the limits of the integral term are
+		# I_min and I_max where a line does not give them
+		self.Table=[g for g in Table if g[0] > 0]
+		self.Table.sort()
+		self.LogSet=[math.log(g[0]) for g in self.Table]
+		self.I_min=I_min
+		self.I_max=I_max
+
+	def row(self, i):
+		g=self.Table[i]
+		if len(g) == 6:
+			return list(g[1:])
+		return list(g[1:])+[self.I_min,self.I_max]
+
+	def gains(self, set_point):
+		"""
+		(Kp,Ki,Kd,I_min,I_max) at set_point, linear in log(set_point)
+		between the lines of the table and those of the nearest line
+		outside it. None if the table is empty
+		"""
+		if not self.Table or set_point <= 0:
+			return None
+		x=math.log(set_point)
+		if x <= self.LogSet[0]:
+			return tuple(self.row(0))
+		if x >= self.LogSet[-1]:
+			return tuple(self.row(-1))
+		i=1
+		while self.LogSet[i] < x:
+			i=i+1
+		f=(x-self.LogSet[i-1])/(self.LogSet[i]-self.LogSet[i-1])
+		Result=[]
+		for a,b in zip(self.row(i-1),self.row(i)):
+			if a is None or b is None:
+				Result.append(None)
+			else:
+				Result.append(a+f*(b-a))
+		return tuple(Result)
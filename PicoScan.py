@@ -0,0 +1,158 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+Scheduling of the PicoWatt multiplexer channels
+
+last edited : October 2026
+
+Explanation:
+
+	The PicoWatt reads one thermometer at a time through its multiplexer.
+	A ScanScheduler decides which channel to read next, TDaemon does the
+	switching and reading and passes each resistance to Update.
+
+	After a switch the bridge takes a while to settle. Instead of waiting
+	a fixed time the readings are taken straight away and the channel is
+	settled once the relative change between two readings is within the
+	noise of that channel (or Tolerance, whichever is larger), but not
+	before MinDwell and at the latest after MaxDwell. Readings taken while
+	settling are thrown away. The noise of each channel is learned as it
+	is read, so a quiet channel is used as soon as it settles and a noisy
+	one is read more times per visit, Samples grows with the square of
+	its noise.
+
+	Without control the channels are read in turn. While the PID is
+	controlling the control channel (the mixing chamber) is read all the
+	time and each of the other channels only gets a visit once it has not
+	been read for Revisit seconds, so the PID is held up as little as
+	possible.
+
+	A daemon that finds the multiplexer already on a channel when it
+	starts calls Resume, its readings are used without waiting to settle.
+
+Classes:
+	ScanChannel
+	ScanScheduler
+
+"""
+
+import math
+
+class ScanChannel:
+
+	def __init__(self, Mux, Calibration, MinDwell = 1.0, MaxDwell = 13.0):
+		self.Mux = Mux
+		self.Calibration = Calibration
+		self.MinDwell = MinDwell
+		self.MaxDwell = MaxDwell
+		# Relative change between settled readings, averaged
+		self.Noise = 0.0
+		self.LastVisit = 0.0
+		return
+
+	def Samples(self, Tolerance, MinSamples = 3, MaxSamples = 20):
+		# Readings to take per visit
+		Samples = int(math.ceil(MinSamples * (self.Noise / Tolerance) ** 2))
+		return max(MinSamples, min(MaxSamples, Samples))
+
+class ScanScheduler:
+
+	def __init__(self, Control, Tolerance = 1e-3, Revisit = 60.0, Smoothing = 0.2):
+		self.Control = Control
+		self.Tolerance = Tolerance
+		self.Revisit = Revisit
+		self.Smoothing = Smoothing
+		# The calibration of the control channel is kept by the daemon
+		self.Channels = [ScanChannel(Control, None)]
+		# The channel being read, when it was switched to, whether it has
+		# settled and how many settled readings it has had
+		self.Current = None
+		self.SwitchTime = 0.0
+		self.Settled = False
+		self.Count = 0
+		self.Previous = None
+		return
+
+	def Get(self, Mux):
+		for Channel in self.Channels:
+			if Channel.Mux == Mux:
+				return Channel
+		return None
+
+	def Add(self, Mux, Calibration):
+		Channel = self.Get(Mux)
+		if Channel is None:
+			self.Channels.append(ScanChannel(Mux, Calibration))
+		else:
+			Channel.Calibration = Calibration
+		return
+
+	def Clear(self):
+		# Only read the control channel
+		self.Channels = [self.Get(self.Control)]
+		return
+
+	def Next(self, Now, Controlling):
+		# The channel to read next
+		if self.Current is not None and self.Get(self.Current) is None:
+			# Taken out of the scan
+			self.Current = None
+		if self.Current is None:
+			return self.Control
+		Channel = self.Get(self.Current)
+		if not self.Settled or self.Count < Channel.Samples(self.Tolerance):
+			return self.Current
+		if len(self.Channels) == 1:
+			return self.Current
+		if Controlling:
+			if self.Current != self.Control:
+				return self.Control
+			Due = [c for c in self.Channels if c.Mux != self.Control and Now - c.LastVisit >= self.Revisit]
+			if not Due:
+				return self.Control
+			return min(Due, key=lambda c: c.LastVisit).Mux
+		i = self.Channels.index(Channel)
+		return self.Channels[(i + 1) % len(self.Channels)].Mux
+
+	def Switched(self, Mux, Now):
+		# Called when the multiplexer has been switched to Mux
+		self.Current = Mux
+		self.SwitchTime = Now
+		self.Settled = False
+		self.Count = 0
+		self.Previous = None
+		return
+
+	def Resume(self, Mux, Now):
+		# Called when the multiplexer is found already on Mux and settled
+		self.Switched(Mux, Now)
+		self.Settled = True
+		return
+
+	def Update(self, Now, Resistance):
+		# Called with each reading of the current channel, returns True
+		# if the reading is settled and should be used
+		Channel = self.Get(self.Current)
+		if Channel is None:
+			return False
+		Change = None
+		if self.Previous:
+			Change = abs(Resistance - self.Previous) / abs(self.Previous)
+		self.Previous = Resistance
+		if self.Settled:
+			if Change is not None:
+				a = self.Smoothing
+				Channel.Noise = (1 - a) * Channel.Noise + a * Change
+			self.Count = self.Count + 1
+			Channel.LastVisit = Now
+			return True
+		Elapsed = Now - self.SwitchTime
+		Threshold = max(self.Tolerance, 3 * Channel.Noise)
+		if Elapsed >= Channel.MaxDwell or (Elapsed >= Channel.MinDwell and Change is not None and Change <= Threshold):
+			self.Settled = True
+			self.Count = 1
+			Channel.LastVisit = Now
+			return True
+		return False
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+Append only log of the raw thermometer readings
+
+last edited : October 2026
+
+Explanation:
+
+	TDaemon writes every reading it uses to a RawLogWriter as it was
+	taken from the bridge: time stamp, multiplexer channel, bridge range
+	and resistance. As long as the log is kept a wrong calibration can
+	be put right afterwards, see Recalibrate.
+
+	The log is a file per day (UTC) named e.g. 20261017.raw in the RawLog
+	directory, each reading a record of RECORD (20 bytes, big endian), with
+	nothing else in the file so it can only be appended to and is read in
+	one go by numpy. The writer holds the readings back for up to Flush
+	seconds so the disk is not written on every reading.
+
+	ReadRawLog returns the readings between two times, in time order, as
+	a numpy record array with the fields Stamp, Channel, Range and
+	Resistance. A record cut short (the daemon stopped while writing) is
+	left out, and cut off the file when the writer opens it again so the
+	records after it line up.
+
+Classes:
+	RawLogWriter
+
+Methods written:
+	ReadRawLog
+
+"""
+
+import calendar
+import os
+import struct
+import time
+
+import numpy as np
+
+RAW_LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),"RawLog")
+
+RECORD = struct.Struct("!dHhd")
+RECORD_DTYPE = np.dtype([("Stamp",">f8"),("Channel",">u2"),("Range",">i2"),("Resistance",">f8")])
+
+DAY = 86400
+
+def LogName(Day):
+	# The file for the day containing Day (seconds since the epoch)
+	return "%s.raw" % time.strftime("%Y%m%d", time.gmtime(Day))
+
+class RawLogWriter:
+
+	def __init__(self, Directory = RAW_LOG_DIR, Flush = 1.0):
+		self.Directory = Directory
+		self.Flush = Flush
+		self.File = None
+		self.Day = None
+		self.Pending = []
+		self.LastFlush = time.time()
+		return
+
+	def Append(self, Stamp, Channel, Range, Resistance):
+		Day = int(Stamp // DAY)
+		if Day != self.Day:
+			self.Write()
+			self.Open(Day)
+		self.Pending.append(RECORD.pack(Stamp, Channel, Range, Resistance))
+		if time.time() - self.LastFlush >= self.Flush:
+			self.Write()
+		return
+
+	def Open(self, Day):
+		if self.File is not None:
+			self.File.close()
+		if not os.path.isdir(self.Directory):
+			os.makedirs(self.Directory)
+		Path = os.path.join(self.Directory, LogName(Day * DAY))
+		if os.path.exists(Path):
+			Size = os.path.getsize(Path)
+			if Size % RECORD.size:
+				# Left by a crash while writing
+				with open(Path, "r+b") as File:
+					File.truncate(Size - Size % RECORD.size)
+		self.File = open(Path, "ab")
+		self.Day = Day
+		return
+
+	def Write(self):
+		if self.Pending and self.File is not None:
+			self.File.write("".join(self.Pending))
+			self.File.flush()
+		self.Pending = []
+		self.LastFlush = time.time()
+		return
+
+	def Close(self):
+		self.Write()
+		if self.File is not None:
+			self.File.close()
+			self.File = None
+		return
+
+def ReadRawLog(Start, Stop, Directory = RAW_LOG_DIR, Channel = None):
+	# The readings with Start <= stamp <= Stop, of one channel if Channel
+	# is given, in time order
+	Pieces = []
+	if not os.path.isdir(Directory):
+		return np.zeros((0,), dtype=RECORD_DTYPE)
+	for Name in sorted(os.listdir(Directory)):
+		try:
+			Day = calendar.timegm(time.strptime(Name, "%Y%m%d.raw"))
+		except ValueError:
+			continue
+		if Day + DAY <= Start or Day > Stop:
+			continue
+		Path = os.path.join(Directory, Name)
+		Count = os.path.getsize(Path) // RECORD.size
+		Data = np.fromfile(Path, dtype=RECORD_DTYPE, count=Count)
+		Keep = (Data["Stamp"] >= Start) & (Data["Stamp"] <= Stop)
+		if Channel is not None:
+			Keep &= Data["Channel"] == Channel
+		Pieces.append(Data[Keep])
+	if not Pieces:
+		return np.zeros((0,), dtype=RECORD_DTYPE)
+	# The stamps are only out of order if the clock was set back
+	Data = np.concatenate(Pieces)
+	return Data[np.argsort(Data["Stamp"], kind="mergesort")]
@@ -0,0 +1,128 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+Temperatures from the raw log under a new calibration
+
+last edited : October 2026
+
+Explanation:
+
+	Recalibrate converts the resistances TDaemon logged (see RawLog) for
+	a channel and time range with any calibration, in one vectorized pass.
+
+	JoinFile adds the new temperature to a data file as an extra column.
+	The file needs a column of time stamps (seconds since the epoch), by
+	default the last, where MeasurementSubsMDaemon writes it. The
+	temperature at each stamp is interpolated between the logged readings
+	either side, or nan if there is no reading within MaxGap seconds.
+	Lines that are not numbers (the header) are copied as they are, the
+	column is added with the file's own delimiter.
+
+	From the command line
+		python Recalibrate.py sensor start stop [channel]
+	prints the stamps, resistances and temperatures, and
+		python Recalibrate.py sensor --join file [time_column] [channel]
+	writes file with the new column to file-recal, sensor is the name of
+	a calibration in Calibrations or the path of a .cal file.
+
+Methods written:
+	GetCalibration
+	Recalibrate
+	JoinFile
+
+"""
+
+import os
+import sys
+
+import numpy as np
+
+import Calibration
+import RawLog
+
+def GetCalibration(Sensor):
+	if os.path.exists(Sensor):
+		with open(Sensor, "rb") as File:
+			return Calibration.LoadCalibration(File.read(), Sensor)
+	return Calibration.CalibrationRegistry().Get(Sensor)
+
+def Recalibrate(Cal, Start, Stop, Channel = 3, Directory = RawLog.RAW_LOG_DIR):
+	# Stamps, resistances and temperatures of Channel from Start to Stop
+	Data = RawLog.ReadRawLog(Start, Stop, Directory, Channel)
+	Stamps = Data["Stamp"].astype(np.float64)
+	Resistance = Data["Resistance"].astype(np.float64)
+	with np.errstate(invalid="ignore", divide="ignore", over="ignore"):
+		Temperature = np.asarray(Cal.Convert(Resistance), dtype=np.float64)
+	return Stamps, Resistance, Temperature
+
+def SplitLine(Line):
+	if "," in Line:
+		return [v.strip() for v in Line.split(",")], ","
+	return Line.split(), " "
+
+def JoinFile(Path, Cal, TimeColumn = -1, Channel = 3, OutPath = None,
+		Directory = RawLog.RAW_LOG_DIR, MaxGap = 10.0):
+	# Write Path with the recalibrated temperature added to each row,
+	# returns the number of rows that got a temperature
+	if OutPath is None:
+		OutPath = "".join((Path, "-recal"))
+	Lines = open(Path).read().splitlines()
+	Rows = []
+	Stamps = []
+	for i, Line in enumerate(Lines):
+		Values, Delimiter = SplitLine(Line)
+		try:
+			Stamps.append(float(Values[TimeColumn]))
+			Rows.append(i)
+		except (IndexError, ValueError):
+			pass
+	Stamps = np.array(Stamps)
+	Joined = np.empty(Stamps.shape)
+	Joined.fill(np.nan)
+	if len(Stamps):
+		Log, Resistance, Temperature = Recalibrate(Cal, Stamps.min() - MaxGap, Stamps.max() + MaxGap, Channel, Directory)
+		Good = np.isfinite(Temperature)
+		Log = Log[Good]
+		Temperature = Temperature[Good]
+		if len(Log):
+			Joined = np.interp(Stamps, Log, Temperature)
+			# Distance to the nearest logged reading
+			After = np.clip(np.searchsorted(Log, Stamps), 0, len(Log) - 1)
+			Before = np.clip(After - 1, 0, len(Log) - 1)
+			Gap = np.minimum(np.abs(Log[After] - Stamps), np.abs(Stamps - Log[Before]))
+			Joined[Gap > MaxGap] = np.nan
+	Out = open(OutPath, "w")
+	j = 0
+	for i, Line in enumerate(Lines):
+		if j < len(Rows) and Rows[j] == i:
+			Values, Delimiter = SplitLine(Line)
+			Line = "".join((Line.rstrip(), Delimiter, "%.6g" % Joined[j]))
+			j = j + 1
+		Out.write("".join((Line, "\n")))
+	Out.close()
+	return int(np.sum(np.isfinite(Joined)))
+
+if __name__ == '__main__':
+
+	if len(sys.argv) < 4:
+		print __doc__
+		sys.exit(1)
+	Cal = GetCalibration(sys.argv[1])
+	if sys.argv[2] == "--join":
+		TimeColumn = -1
+		Channel = 3
+		if len(sys.argv) > 4:
+			TimeColumn = int(sys.argv[4])
+		if len(sys.argv) > 5:
+			Channel = int(sys.argv[5])
+		Count = JoinFile(sys.argv[3], Cal, TimeColumn, Channel)
+		print "%d rows of %s recalibrated" % (Count, sys.argv[3])
+	else:
+		Channel = 3
+		if len(sys.argv) > 4:
+			Channel = int(sys.argv[4])
+		Stamps, Resistance, Temperature = Recalibrate(Cal, float(sys.argv[2]), float(sys.argv[3]), Channel)
+		for Row in zip(Stamps, Resistance, Temperature):
+			print "%.3f\t%.6g\t%.6g" % Row
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+History of the daemon readings kept in memory
+
+last edited : October 2026
+
+Explanation:
+
+	A RingBuffer holds the last Capacity readings of a daemon, each a time
+	stamp and a fixed number of values (e.g. temperature, resistance and
+	status), in preallocated numpy arrays. Appending overwrites the oldest
+	reading once the buffer is full so the memory used never grows. The
+	default capacity of 2**17 readings is several hours of the daemon loop.
+
+	Range returns the readings between two times. The stamps are in time
+	order in at most two pieces of the array so the ends of the range are
+	found with a binary search rather than a scan. If MaxPoints is given
+	the readings are averaged in equal bins down to at most that many.
+
+	Clients ask a daemon for its history with the command
+		HIST start stop maxpoints
+	(times in seconds since the epoch, maxpoints 0 for every reading), the
+	daemon answers with the readings packed by PackHistory and the client
+	unpacks them with UnpackHistory.
+
+Classes:
+	RingBuffer
+
+Methods written:
+	PackHistory
+	UnpackHistory
+
+"""
+
+import struct
+
+import numpy as np
+
+HISTORY_HEADER = struct.Struct("!II")
+
+def PackHistory(Data):
+	# Data is an array with one row per reading, the stamp first
+	Data = np.asarray(Data, dtype=">f8")
+	return HISTORY_HEADER.pack(Data.shape[0], Data.shape[1]) + Data.tostring()
+
+def UnpackHistory(Payload):
+	Rows, Columns = HISTORY_HEADER.unpack_from(Payload, 0)
+	Data = np.fromstring(Payload[HISTORY_HEADER.size:], dtype=">f8")
+	return Data.reshape((Rows, Columns)).astype(np.float64)
+
+class RingBuffer:
+
+	def __init__(self, NColumns, Capacity = 2**17):
+		self.Capacity = Capacity
+		self.NColumns = NColumns
+		self.Stamp = np.zeros((Capacity,))
+		self.Data = np.zeros((Capacity, NColumns))
+		# Next row to write and the number of rows in use
+		self.Head = 0
+		self.Count = 0
+		return
+
+	def Append(self, Stamp, Values):
+		self.Stamp[self.Head] = Stamp
+		self.Data[self.Head,:] = Values
+		self.Head = (self.Head + 1) % self.Capacity
+		if self.Count < self.Capacity:
+			self.Count = self.Count + 1
+		return
+
+	def Segments(self):
+		# The rows in use as at most two slices, oldest first
+		if self.Count < self.Capacity:
+			return [slice(0, self.Count)]
+		if self.Head == 0:
+			return [slice(0, self.Capacity)]
+		return [slice(self.Head, self.Capacity), slice(0, self.Head)]
+
+	def Latest(self, N = 1):
+		# The last N readings, stamp first
+		N = min(N, self.Count)
+		Rows = (self.Head - N + np.arange(N)) % self.Capacity
+		return np.column_stack((self.Stamp[Rows], self.Data[Rows,:]))
+
+	def Range(self, Start, Stop, MaxPoints = 0):
+		# Readings with Start <= stamp <= Stop as an array with one row per
+		# reading, the stamp first
+		Pieces = []
+		for Segment in self.Segments():
+			Stamps = self.Stamp[Segment]
+			First = np.searchsorted(Stamps, Start, side="left")
+			Last = np.searchsorted(Stamps, Stop, side="right")
+			if Last > First:
+				Rows = slice(Segment.start + First, Segment.start + Last)
+				Pieces.append(np.column_stack((self.Stamp[Rows], self.Data[Rows,:])))
+		if not Pieces:
+			return np.zeros((0, self.NColumns + 1))
+		Result = np.concatenate(Pieces)
+		if MaxPoints > 0 and Result.shape[0] > MaxPoints:
+			Result = self.Downsample(Result, MaxPoints)
+		return Result
+
+	def Downsample(self, Result, MaxPoints):
+		# Average consecutive readings in bins of equal size, the last bin
+		# may be shorter
+		BinSize = -(-Result.shape[0] // MaxPoints)
+		Starts = np.arange(0, Result.shape[0], BinSize)
+		Sums = np.add.reduceat(Result, Starts, axis=0)
+		Sizes = np.diff(np.append(Starts, Result.shape[0]))
+		return Sums / Sizes[:,np.newaxis]
+
+	def Query(self, Msg):
+		# Answer a "HIST start stop maxpoints" command, returns the packed
+		# readings or None if the command is not valid
+		Msg = Msg.split(" ")
+		if Msg[0] != "HIST":
+			return None
+		try:
+			Start = float(Msg[1])
+			Stop = float(Msg[2])
+			MaxPoints = 0
+			if len(Msg) > 3:
+				MaxPoints = int(Msg[3])
+		except (IndexError, ValueError):
+			return None
+		return PackHistory(self.Range(Start, Stop, MaxPoints))
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+Shared memory copy of the latest daemon reading
+
+last edited : October 2026
+
+Explanation:
+
+	Each daemon keeps its latest telemetry frame (see SocketUtils) in a
+	small memory mapped file in the temp directory. Processes on the same
+	host can then read the temperature and field without going through
+	the socket. The socket is still there for remote readers and for
+	sending commands.
+
+	The region is a 4 byte sequence counter followed by the frame. The
+	writer makes the counter odd while it writes and even again when it
+	is done (a seqlock), a reader retries if the counter was odd or
+	changed while it was reading. The frame is unpacked directly from
+	the map so nothing is copied.
+
+Classes:
+	TelemetryWriter
+	TelemetryReader
+
+"""
+
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+import SocketUtils as SocketUtils
+
+SEQ = struct.Struct("!I")
+REGION_SIZE = SEQ.size + SocketUtils.TELEMETRY.size
+
+def SharedPath(Name):
+	return os.path.join(tempfile.gettempdir(),"FridgeTelemetry-%s.dat" % Name)
+
+class TelemetryWriter:
+
+	def __init__(self, Name):
+		Path = SharedPath(Name)
+		# Reuse an existing file so readers that still have it mapped
+		# carry on working when the daemon restarts
+		if os.path.exists(Path) and os.path.getsize(Path) == REGION_SIZE:
+			self.File = open(Path,"r+b")
+		else:
+			self.File = open(Path,"w+b")
+			self.File.write("\x00" * REGION_SIZE)
+			self.File.flush()
+		self.Map = mmap.mmap(self.File.fileno(), REGION_SIZE, access=mmap.ACCESS_WRITE)
+		self.Seq = SEQ.unpack_from(self.Map,0)[0] & ~1
+		return
+
+	def Write(self, Frame):
+		# Frame is a packed telemetry frame from SocketUtils.TelemetryEncoder
+		self.Seq = (self.Seq + 1) & 0xFFFFFFFF
+		SEQ.pack_into(self.Map,0,self.Seq)
+		self.Map[SEQ.size:REGION_SIZE] = Frame
+		self.Seq = (self.Seq + 1) & 0xFFFFFFFF
+		SEQ.pack_into(self.Map,0,self.Seq)
+		return
+
+	def Close(self):
+		self.Map.close()
+		self.File.close()
+		return
+
+class TelemetryReader:
+
+	def __init__(self, Name):
+		self.Path = SharedPath(Name)
+		self.File = None
+		self.Map = None
+		return
+
+	def Open(self):
+		# Returns False if the daemon is not running on this host
+		if self.Map is not None:
+			return True
+		if not os.path.exists(self.Path) or os.path.getsize(self.Path) != REGION_SIZE:
+			return False
+		self.File = open(self.Path,"rb")
+		self.Map = mmap.mmap(self.File.fileno(), REGION_SIZE, access=mmap.ACCESS_READ)
+		return True
+
+	def Read(self, MaxAge = 5.0, Retries = 1000):
+		# Latest frame as a SocketUtils.Telemetry, or None if there is no
+		# daemon or its last reading is older than MaxAge seconds
+		if not self.Open():
+			return None
+		for i in xrange(Retries):
+			Before = SEQ.unpack_from(self.Map,0)[0]
+			if Before == 0:
+				return None
+			if Before & 1:
+				continue
+			Frame = SocketUtils.TELEMETRY.unpack_from(self.Map,SEQ.size)
+			if SEQ.unpack_from(self.Map,0)[0] == Before:
+				Frame = SocketUtils.Telemetry._make(Frame)
+				if MaxAge and time.time() - Frame.stamp > MaxAge:
+					return None
+				return Frame
+		return None
+
+	def Close(self):
+		if self.Map is not None:
+			self.Map.close()
+			self.File.close()
+		self.Map = None
+		self.File = None
+		return
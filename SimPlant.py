@@ -0,0 +1,245 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+Simulated PicoWatt bridge and Leiden TCS for running TDaemon without the fridge
+
+last edited : October 2026
+
+Explanation:
+
+	The mixing chamber is a lumped thermal model: heated by the current in
+	the TCS heater it relaxes towards
+		Base + Gain * current**2	(mK, current in micro amps)
+	with time constant Tau, and the thermometer follows the mixing
+	chamber with time constant TauSensor. The other thermometers sit at
+	fixed temperatures.
+
+	SimPicoWatt and SimTCS answer the same commands as the instruments
+	(write, ask and close, as visa instruments) so TDaemon runs unchanged
+	against them. The bridge turns the temperature into a resistance with
+	the inverse of the channel's calibration, adds noise and, after a
+	change of multiplexer channel, a decaying offset as the real bridge
+	settles. A conversion started with ADC takes Conversion seconds, the
+	status byte (stb) has bit 16 set once it is ready. That is only a
+	model for trying TDaemon.PicoReady, it is not known that the real
+	bridge does it.
+
+	Everything runs on a VirtualClock, which has time and sleep like the
+	time module but runs Speed times faster than real time, so a run of
+	hours takes minutes. Time stamps from it start at the real time.
+
+	To run TDaemon against the simulation 100 times faster than real time
+		python TDaemon.py --sim 100
+
+Classes:
+	VirtualClock
+	ThermalPlant
+	SimPicoWatt
+	SimTCS
+	SimFridge
+
+"""
+
+import math
+import random
+import threading
+import time
+
+import numpy as np
+
+import Calibration
+
+class VirtualClock:
+
+	def __init__(self, Speed = 1.0):
+		self.Speed = float(Speed)
+		self.Start = time.time()
+		return
+
+	def time(self):
+		return self.Start + (time.time() - self.Start) * self.Speed
+
+	def sleep(self, Seconds):
+		time.sleep(Seconds / self.Speed)
+		return
+
+class ThermalPlant:
+
+	def __init__(self, Clock, Base = 20.0, Gain = 4e-5, Tau = 120.0, TauSensor = 5.0, Fixed = None):
+		self.Clock = Clock
+		self.Base = Base
+		self.Gain = Gain
+		self.Tau = Tau
+		self.TauSensor = TauSensor
+		# Temperatures of the thermometers on the other channels
+		if Fixed is None:
+			Fixed = {1: 700.0, 2: 4000.0}
+		self.Fixed = Fixed
+		self.Current = 0.0
+		self.MC = Base
+		self.Sensor = Base
+		self.Last = Clock.time()
+		self.Lock = threading.Lock()
+		return
+
+	def Update(self):
+		# Step the model to the present, the heater current is constant
+		# since the last step so the mixing chamber is solved exactly
+		Now = self.Clock.time()
+		dt = Now - self.Last
+		self.Last = Now
+		if dt <= 0:
+			return
+		Steady = self.Base + self.Gain * self.Current ** 2
+		Old = self.MC
+		self.MC = Steady + (self.MC - Steady) * math.exp(-dt / self.Tau)
+		# Thermometer lag, following the mean of the step
+		Mean = 0.5 * (Old + self.MC)
+		self.Sensor = Mean + (self.Sensor - Mean) * math.exp(-dt / self.TauSensor)
+		return
+
+	def SetCurrent(self, Current):
+		with self.Lock:
+			self.Update()
+			self.Current = float(Current)
+		return
+
+	def Temperature(self, Channel = None):
+		# The control thermometer if Channel is None
+		if Channel is not None:
+			return self.Fixed.get(Channel)
+		with self.Lock:
+			self.Update()
+			return self.Sensor
+
+class SimPicoWatt:
+
+	def __init__(self, Plant, Calibrations, Control = 3, Noise = 2e-4, Settle = 0.7, Conversion = 0.25):
+		self.Plant = Plant
+		self.Clock = Plant.Clock
+		self.Control = Control
+		self.Noise = Noise
+		self.Settle = Settle
+		self.Conversion = Conversion
+		self.ADCTime = None
+		# Inverse of each channel's calibration, log10(R) against log10(T)
+		self.Inverse = {}
+		for Channel, Cal in Calibrations.items():
+			LogR = np.linspace(1.0, 6.0, 4001)
+			with np.errstate(over="ignore", under="ignore"):
+				T = Cal.Convert(10.0 ** LogR)
+			Good = np.isfinite(T) & (T > 0)
+			LogT = np.log10(T[Good])
+			Order = np.argsort(LogT)
+			self.Inverse[Channel] = (LogT[Order], LogR[Good][Order])
+		self.Mux = Control
+		self.SwitchTime = self.Clock.time()
+		self.Reads = 0
+		self.Last = 0.0
+		return
+
+	def Resistance(self):
+		if self.Mux == self.Control:
+			T = self.Plant.Temperature()
+		else:
+			T = self.Plant.Temperature(self.Mux)
+		if T is None or self.Mux not in self.Inverse:
+			# Nothing connected
+			return 0.0
+		LogT, LogR = self.Inverse[self.Mux]
+		R = 10.0 ** np.interp(math.log10(T), LogT, LogR)
+		Settling = 0.2 * math.exp(-(self.Clock.time() - self.SwitchTime) / self.Settle)
+		return R * (1 + Settling) * (1 + random.gauss(0, self.Noise))
+
+	def write(self, Command):
+		Command = Command.split(" ")
+		if Command[0] == "MUX":
+			self.Mux = int(Command[1])
+			self.SwitchTime = self.Clock.time()
+		elif Command[0] == "ADC":
+			self.ADCTime = self.Clock.time()
+		return
+
+	@property
+	def stb(self):
+		if self.ADCTime is not None and self.Clock.time() - self.ADCTime >= self.Conversion:
+			return 16
+		return 0
+
+	def ask(self, Command):
+		if Command.startswith("RES"):
+			self.Reads = self.Reads + 1
+			self.Last = self.Resistance()
+			return "%.6e\n" % self.Last
+		if Command.startswith("RAN"):
+			# 1 is the 2 Ohm range ... 7 the 2 MOhm range
+			Range = 1
+			if self.Last > 0:
+				Range = min(max(int(math.floor(math.log10(self.Last / 2.0))) + 2, 1), 7)
+			return "%d\n" % Range
+		if Command.startswith("MUX"):
+			return "%d\n" % self.Mux
+		return "\n"
+
+	def close(self):
+		return
+
+class SimTCS:
+
+	def __init__(self, Plant, Heater = 2):
+		self.Plant = Plant
+		self.Heater = Heater
+		self.Heaters = [0,0,0]
+		self.Currents = [0,0,0]
+		return
+
+	def SetPlant(self):
+		Current = 0.0
+		if self.Heaters[self.Heater]:
+			Current = self.Currents[self.Heater]
+		self.Plant.SetCurrent(Current)
+		return
+
+	def ask(self, Command):
+		Command = Command.split(" ")
+		if Command[0] == "SETDAC":
+			self.Currents[int(Command[1])-1] = int(Command[3])
+			self.SetPlant()
+		elif Command[0] == "SETUP":
+			# A 1 in the switch field of a source toggles its heater
+			Vector = Command[1].split(",")
+			for i in range(3):
+				if int(Vector[2+i*4]):
+					self.Heaters[i] = 1 - self.Heaters[i]
+			self.SetPlant()
+		elif Command[0] == "STATUS?":
+			# Source, range, current and heater for each source, the
+			# currents are reported on range 1 (micro amps)
+			Fields = []
+			for i in range(3):
+				Fields.append("%d,1,%d,%d" % (i+1, self.Currents[i], self.Heaters[i]))
+			return "STATUS\t%s" % ",".join(Fields)
+		elif Command[0] == "ID?":
+			return "Simulated TCS"
+		return "OK"
+
+	def write(self, Command):
+		self.ask(Command)
+		return
+
+	def close(self):
+		return
+
+class SimFridge:
+
+	def __init__(self, Speed = 1.0, Registry = None, **PlantOptions):
+		if Registry is None:
+			Registry = Calibration.CalibrationRegistry()
+		self.Clock = VirtualClock(Speed)
+		self.Plant = ThermalPlant(self.Clock, **PlantOptions)
+		Calibrations = {3: Registry.Get("SO703"), 1: Registry.Get("SO914"), 2: Registry.Get("MATS56")}
+		self.Bridge = SimPicoWatt(self.Plant, Calibrations)
+		self.TCS = SimTCS(self.Plant)
+		return
@@ -54,8 +54,8 @@ TClient = SocketUtils.SockClient('localhost', 18871)
 while 1:
     for i in range(8):
         asyncore.loop(count=1,timeout=0.001)
-        TString = TClient.received_data
-        print TString
+        for TString in TClient.read_all():
+            print SocketUtils.decode_telemetry(TString.split(" ",1)[1])
         time.sleep(2)
     time.sleep(8)
 
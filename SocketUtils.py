@@ -11,6 +11,56 @@ last edited : August 2013
 
 This file contains some utilities to create a socket server, handler and client
 
+Messages on the socket are framed: each message is preceded by a 4 byte
+big-endian length header. Every connection keeps a bounded queue of the
+complete messages it has received, which are taken off one at a time with
+read_msg or all at once with read_all. Messages are sent with send_msg.
+
+The server is a publisher: the daemon calls publish(topic, payload) and
+every connected subscriber that wants the topic gets "topic payload".
+A client chooses its topics and the minimum interval between messages on
+a topic by sending
+	SUB topic1,topic2 interval
+or "SUB *" for everything (the default) or "SUB -" for nothing, e.g. for
+a client that only sends commands. Subscriptions are handled by the
+server, they never reach the daemon. Any number of clients may connect.
+
+Commands that need confirming are sent as "REQ id command", the daemon
+answers each with "ACK id 1" if it accepted the command or "ACK id 0" if
+not. SockClient.request sends a command and waits for its answer. An
+answer may carry data after the code, "ACK id 1 data", which is returned
+by SockClient.query, e.g. for the daemon history (see RingBuffer).
+
+Topics published with publish_state (e.g. the daemon STATUS) are only
+sent when they change and the last value is retained, a new subscriber
+gets it straight away. SockClient keeps the latest STATUS and wait_until
+or wait_while block on the socket until the status is what we want, so
+they return as soon as the daemon reports the change. It also keeps the
+latest ETA, the seconds until TDaemon expects to be at its set point.
+A SockClient always reads its socket, so answers and status changes get
+through however long the readings have been left unread: only the last
+queue_size readings are kept, the oldest are dropped and counted in
+dropped.
+
+Outgoing messages wait in a queue per connection. Published readings are
+only queued up to max_out messages, what happens to a subscriber that
+does not keep up depends on the server's overflow policy:
+	COALESCE	keep only the newest reading of each topic
+	DROP_OLDEST	drop the oldest reading
+	DISCONNECT	close the connection
+The number of readings dropped is counted in each handler's dropped.
+Command answers and status changes are never dropped.
+
+Where the OS has Unix domain sockets the server also listens on a socket
+file next to the TCP port (see unix_path), and a SockClient connecting to
+localhost uses the file if it exists. TCP stays for remote clients.
+
+Readings are published as binary telemetry frames rather than text, see
+TelemetryEncoder and decode_telemetry. A frame holds the time of the
+reading (seconds since the epoch, so it lines up with data taken in other
+processes), a sequence number, the value, the raw sensor value and the
+daemon status.
+
 """
 
 #######################################
@@ -19,32 +69,287 @@ This file contains some utilities to create a socket server, handler and client
 
 import asyncore
 import logging
+import os
 import socket
 import struct
+import tempfile
+import time
+from collections import deque, namedtuple
+
+# Length header placed in front of every message
+FRAME_HEADER = struct.Struct("!I")
+# Largest message we accept, anything longer means the stream is corrupt
+MAX_FRAME = 16*1024*1024
+
+# What to do when a subscriber's outgoing queue is full
+COALESCE = "coalesce"
+DROP_OLDEST = "drop_oldest"
+DISCONNECT = "disconnect"
+
+def unix_path(port):
+	# Socket file used alongside the TCP port, None if the OS has no
+	# Unix domain sockets
+	if not hasattr(socket, "AF_UNIX"):
+		return None
+	return os.path.join(tempfile.gettempdir(),"FridgeSocket-%d" % port)
+
+def pack_frame(msg):
+	return "".join((FRAME_HEADER.pack(len(msg)),msg))
+
+#######################################
+# Split an incoming byte stream into messages
+#######################################
+
+class FrameReader:
+
+	def __init__(self, max_frame = MAX_FRAME):
+		self.max_frame = max_frame
+		# Data received but not yet parsed, only joined once there is
+		# enough for a whole frame so a large frame is not copied for
+		# every chunk that arrives
+		self.chunks = []
+		self.size = 0
+		self.needed = FRAME_HEADER.size
+
+	def feed(self, data):
+		# Add data to the buffer and return a list of the complete messages.
+		# The buffer is only sliced once per call so the cost is per message
+		# rather than per byte received
+		self.chunks.append(data)
+		self.size = self.size + len(data)
+		if self.size < self.needed:
+			return []
+		buffer = "".join(self.chunks)
+		frames = []
+		offset = 0
+		header_size = FRAME_HEADER.size
+		end = len(buffer)
+		self.needed = header_size
+		while end - offset >= header_size:
+			length = FRAME_HEADER.unpack_from(buffer,offset)[0]
+			if length > self.max_frame:
+				raise ValueError("Frame of %d bytes exceeds limit" % length)
+			if end - offset - header_size < length:
+				self.needed = header_size + length
+				break
+			offset = offset + header_size
+			frames.append(buffer[offset:offset+length])
+			offset = offset + length
+		if offset:
+			buffer = buffer[offset:]
+		self.chunks = [buffer]
+		self.size = len(buffer)
+		return frames
+
+#######################################
+# Binary telemetry frames
+#######################################
+
+# time, sequence number, value, raw sensor value, status
+TELEMETRY = struct.Struct("!dIddh")
+
+Telemetry = namedtuple("Telemetry", ["stamp", "seq", "value", "raw", "status"])
+
+class TelemetryEncoder:
+
+	def __init__(self):
+		self.seq = 0
+
+	def encode(self, value, status, raw = 0.0, stamp = None):
+		if stamp is None:
+			stamp = time.time()
+		self.seq = (self.seq + 1) & 0xFFFFFFFF
+		return TELEMETRY.pack(stamp, self.seq, value, raw, status)
+
+def decode_telemetry(payload):
+	return Telemetry._make(TELEMETRY.unpack(payload))
+
+class TelemetryDecoder:
+
+	# Decode frames from one publisher and count the readings we missed,
+	# a subscriber with a min_interval will of course skip some
+	def __init__(self):
+		self.last = None
+		self.missed = 0
+
+	def decode(self, payload):
+		frame = decode_telemetry(payload)
+		if self.last is not None:
+			gap = (frame.seq - self.last.seq) & 0xFFFFFFFF
+			if gap > 1:
+				self.missed = self.missed + gap - 1
+		self.last = frame
+		return frame
+
+#######################################
+# Framed send and receive shared by the handler and the client
+#######################################
+
+class FramedChannel:
+
+	def init_channel(self, chunk_size, queue_size, max_out = 0, policy = DROP_OLDEST):
+		self.chunk_size = chunk_size
+		self.queue_size = queue_size
+		# Outgoing frames as (topic, frame), topic is None for messages
+		# that must not be dropped. to_send holds the bytes being sent
+		self.outbox = deque()
+		self.out_count = 0
+		self.max_out = max_out
+		self.policy = policy
+		self.dropped = 0
+		self.to_send = ""
+		self.received = deque()
+		self.reader = FrameReader()
+
+	def send_msg(self, msg, topic = None):
+		# Only messages with a topic count towards max_out
+		if topic is not None and self.max_out:
+			if self.out_count >= self.max_out and not self.make_room(topic):
+				return
+			self.out_count = self.out_count + 1
+		self.outbox.append((topic,pack_frame(msg)))
+
+	def make_room(self, topic):
+		# Apply the overflow policy, returns False if the new message
+		# should not be queued
+		if self.policy == DISCONNECT:
+			logging.warning("Subscriber too slow, disconnecting")
+			self.dropped = self.dropped + self.out_count
+			self.handle_close()
+			return False
+		if self.policy == COALESCE:
+			# The newest reading replaces all the queued ones of its topic
+			kept = deque(item for item in self.outbox if item[0] != topic)
+			removed = len(self.outbox) - len(kept)
+			if removed:
+				self.outbox = kept
+				self.out_count = self.out_count - removed
+				self.dropped = self.dropped + removed
+				return True
+		drop = None
+		for i, item in enumerate(self.outbox):
+			if item[0] is not None:
+				drop = i
+				break
+		if drop is None:
+			return False
+		del self.outbox[drop]
+		self.out_count = self.out_count - 1
+		self.dropped = self.dropped + 1
+		return True
+
+	def read_msg(self):
+		# Oldest message in the queue or None
+		if self.received:
+			return self.received.popleft()
+		return None
+
+	def read_all(self):
+		msgs = list(self.received)
+		self.received.clear()
+		return msgs
+
+	def readable(self):
+		# Stop reading once the queue is full, the socket buffer then
+		# pushes back on the sender instead of us dropping messages
+		return len(self.received) < self.queue_size
+
+	def writable(self):
+		return bool(self.to_send) or bool(self.outbox)
+
+	def handle_write(self):
+		# Send whole frames until the socket would block
+		while True:
+			if not self.to_send:
+				if not self.outbox:
+					return
+				frames = []
+				size = 0
+				while self.outbox and size < self.chunk_size:
+					topic, frame = self.outbox.popleft()
+					if topic is not None and self.max_out:
+						self.out_count = self.out_count - 1
+					frames.append(frame)
+					size = size + len(frame)
+				self.to_send = "".join(frames)
+			sent = self.send(self.to_send)
+			self.to_send = self.to_send[sent:]
+			if self.to_send:
+				return
+
+	def handle_read(self):
+		data = self.recv(self.chunk_size)
+		if not data:
+			return
+		try:
+			frames = self.reader.feed(data)
+		except ValueError:
+			logging.warning("Bad frame on socket, closing")
+			self.handle_close()
+			return
+		self.handle_frames(frames)
+
+	def handle_frames(self, frames):
+		self.received.extend(frames)
 
 class SockServer(asyncore.dispatcher):
 
-	def __init__(self, address):
+	def __init__(self, address, backlog = 16, max_out = 64, policy = COALESCE, local = True):
 		#self.logger = logging.getLogger('EchoServer')
+		self.max_out = max_out
+		self.policy = policy
 		asyncore.dispatcher.__init__(self)
 		self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
 		self.socket.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
 		self.bind(address)
 		self.address = self.socket.getsockname()
 		#self.logger.debug('binding to %s', self.address)
-		self.listen(1)
+		self.listen(backlog)
 		self.handlers = []
+		self.retained = {}
+		# Serve same host clients on a Unix domain socket as well
+		self.local = None
+		if local and unix_path(self.address[1]):
+			self.local = UnixListener(unix_path(self.address[1]), self, backlog)
 		return
 
 	def handle_accept(self):
 		# Called when a client connects to our socket
 		client_info = self.accept()
+		if client_info is None:
+			return
 		#self.logger.debug('handle_accept() -> %s', client_info[1])
-		handler = SockHandler(client_info[0], self)
+		client_info[0].setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+		self.add_handler(client_info[0])
+		return
+
+	def add_handler(self, sock):
+		handler = SockHandler(sock, self)
 		print "Got listener!"
-		if len(self.handlers)>2:
-			self.remove_channel(self.handlers[-1])
 		self.handlers.append(handler)
+		handler.send_retained()
+		return handler
+
+	def publish(self, topic, payload):
+		# Queue a message for every subscriber of the topic, this only
+		# appends to buffers, the sending is done by the asyncore loop
+		now = time.time()
+		msg = " ".join((topic,payload))
+		# A slow subscriber may be disconnected so go through a copy
+		for j in list(self.handlers):
+			if j.wants(topic, now):
+				j.send_msg(msg, topic)
+		return
+
+	def publish_state(self, topic, payload):
+		# Publish only if the state changed, regardless of rate limits
+		if self.retained.get(topic) == payload:
+			return
+		self.retained[topic] = payload
+		msg = " ".join((topic,payload))
+		for j in self.handlers:
+			if j.topics is None or topic in j.topics:
+				j.send_msg(msg)
 		return
 
 	def remove_channel(self,sock):
@@ -54,38 +359,110 @@ class SockServer(asyncore.dispatcher):
 
 	def handle_close(self):
 		#self.logger.debug('handle_close()')
+		if self.local is not None:
+			self.local.handle_close()
 		self.close()
 		return
 
-class SockHandler(asyncore.dispatcher):
+class UnixListener(asyncore.dispatcher):
 
-	def __init__(self, sock, server, chunk_size = 256):
-		self.chunk_size = chunk_size
+	# Accepts connections on a socket file and gives them to the server
+	def __init__(self, path, server, backlog = 16):
+		asyncore.dispatcher.__init__(self)
+		self.path = path
+		self.server = server
+		if os.path.exists(path):
+			# Left over from a daemon that did not shut down cleanly
+			os.remove(path)
+		self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.bind(path)
+		self.listen(backlog)
+		return
+
+	def handle_accept(self):
+		client_info = self.accept()
+		if client_info is None:
+			return
+		self.server.add_handler(client_info[0])
+		return
+
+	def handle_close(self):
+		self.close()
+		if os.path.exists(self.path):
+			os.remove(self.path)
+		return
+
+class SockHandler(FramedChannel, asyncore.dispatcher):
+
+	def __init__(self, sock, server, chunk_size = 4096, queue_size = 256):
+		self.init_channel(chunk_size, queue_size, server.max_out, server.policy)
 		#self.logger = logging.getLogger('EchoHandler%s' % str(sock.getsockname()))
 		asyncore.dispatcher.__init__(self, sock=sock)
-		self.socket.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)	
-		self.to_send = []
-		self.received_data = []
+		self.socket.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
 		self.server = server
+		# Subscription, None means all topics
+		self.topics = None
+		self.min_interval = 0.0
+		self.last_sent = {}
 		return
 
-	def writable(self):
-		#self.logger.debug('writable() -> %s', bool(self.to_send))
-		return bool(self.to_send)
+	def wants(self, topic, now):
+		if self.topics is not None and topic not in self.topics:
+			return False
+		if self.min_interval > 0:
+			if now - self.last_sent.get(topic,0.0) < self.min_interval:
+				return False
+			self.last_sent[topic] = now
+		return True
 
-	def handle_write(self):
-		if len(self.to_send) > self.chunk_size:
-			# if the buffer is too long bin some
-			sent = self.send(self.to_send[-self.chunk_size:])	
-			self.to_send = []
-		else:
-			sent = self.send(self.to_send[:self.chunk_size])
-			self.to_send = self.to_send[sent:]
+	def subscribe(self, msg):
+		# msg is "SUB topic1,topic2 interval"
+		msg = msg.split(" ")
+		try:
+			if len(msg) < 2 or msg[1] == "*":
+				self.topics = None
+			elif msg[1] == "-":
+				self.topics = set()
+			else:
+				self.topics = set(msg[1].split(","))
+			if len(msg) > 2:
+				self.min_interval = abs(float(msg[2]))
+			self.last_sent = {}
+		except ValueError:
+			logging.warning("Bad subscription %s", " ".join(msg))
+		self.send_retained()
+		return
 
-	def handle_read(self):
-		data = self.recv(self.chunk_size)
-		#self.logger.debug('handle_read() -> (%d) "%s"', len(data), data)
-		self.received_data = data
+	def send_retained(self):
+		for topic, payload in self.server.retained.items():
+			if self.topics is None or topic in self.topics:
+				self.send_msg(" ".join((topic,payload)))
+
+	def handle_frames(self, frames):
+		# Subscriptions are for the server, pass the rest to the daemon
+		# as (id, command), the id is None if no answer is expected
+		for msg in frames:
+			if msg.startswith("SUB "):
+				self.subscribe(msg)
+			elif msg.startswith("REQ "):
+				msg = msg.split(" ",2)
+				if len(msg) == 3:
+					self.received.append((msg[1],msg[2]))
+			else:
+				self.received.append((None,msg))
+
+	def read_requests(self):
+		return FramedChannel.read_all(self)
+
+	def read_all(self):
+		return [msg for msg_id, msg in self.read_requests()]
+
+	def reply(self, msg_id, accepted, data = None):
+		if msg_id is not None:
+			if data is None:
+				self.send_msg("ACK %s %d" % (msg_id, bool(accepted)))
+			else:
+				self.send_msg("ACK %s %d %s" % (msg_id, bool(accepted), data))
 
 	def handle_close(self):
 		#self.logger.debug('handle_close()')
@@ -93,45 +470,113 @@ class SockHandler(asyncore.dispatcher):
 		self.close()
 
 
-class SockClient(asyncore.dispatcher):
+class SockClient(FramedChannel, asyncore.dispatcher):
 
-	def __init__(self, host, port, chunk_size=256):
+	def __init__(self, host, port, chunk_size = 4096, queue_size = 256, local = True):
 		#self.message = message
-		self.to_send = []
-		self.received_data = []
-		self.chunk_size = chunk_size
+		self.init_channel(chunk_size, queue_size)
+		self.request_id = 0
+		self.acks = {}
+		self.status = None
+		self.eta = None
 		#self.logger = logging.getLogger('EchoClient')
 		asyncore.dispatcher.__init__(self)
+		path = unix_path(port)
+		if local and host in ("localhost","127.0.0.1") and path and os.path.exists(path):
+			# Same host, use the daemon's Unix domain socket
+			self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			self.connect(path)
+			return
 		self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
 		self.socket.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+		self.socket.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
 		#self.logger.debug('connecting to %s', (host, port))
 		self.connect((host, port))
 		return
 
-	def handle_close(self):
-		#self.logger.debug('handle_close()')
-		self.close()
-		pass
+	def handle_frames(self, frames):
+		for msg in frames:
+			if msg.startswith("ACK "):
+				msg = msg.split(" ",3)
+				data = None
+				if len(msg) > 3:
+					data = msg[3]
+				self.acks[msg[1]] = (int(msg[2]), data)
+			elif msg.startswith("STATUS "):
+				self.status = msg[7:]
+			elif msg.startswith("ETA "):
+				self.eta = msg[4:]
+			else:
+				if len(self.received) >= self.queue_size:
+					self.received.popleft()
+					self.dropped = self.dropped + 1
+				self.received.append(msg)
 
-	def writable(self):
-		#self.logger.debug('writable() -> %s', bool(self.to_send))
-		return bool(self.to_send)
+	def readable(self):
+		# Always read, the answers to requests come after the readings
+		return True
 
-	def handle_write(self):
-		#self.logger.debug('handle_write() -> (%d) "%s"', sent, self.to_send[:sent])
-		if len(self.to_send) > self.chunk_size:
-			# if the buffer is too long bin some
-			sent = self.send(self.to_send[-self.chunk_size:])	
-			self.to_send = []
-		else:
-			sent = self.send(self.to_send[:self.chunk_size])
-			self.to_send = self.to_send[sent:]
+	def request(self, msg, timeout = 5.0):
+		# Send a command and wait for the daemon to answer, returns
+		# 1 if it was accepted, 0 if it was rejected and -1 if there was
+		# no answer before the timeout
+		return self.exchange(msg, timeout)[0]
 
-	def handle_read(self):
-		data = self.recv(self.chunk_size)
-		#self.logger.debug('handle_read() -> (%d) "%s"', len(data), data)
-		self.received_data = data
+	def query(self, msg, timeout = 5.0):
+		# As request but returns the data sent with the answer, None if
+		# the daemon rejected the command or did not answer
+		accepted, data = self.exchange(msg, timeout)
+		if accepted != 1:
+			return None
+		return data
+
+	def exchange(self, msg, timeout):
+		self.request_id = self.request_id + 1
+		msg_id = "%d" % self.request_id
+		self.send_msg(" ".join(("REQ",msg_id,msg)))
+		end = time.time() + timeout
+		while time.time() < end:
+			asyncore.loop(count=1,timeout=0.01)
+			if msg_id in self.acks:
+				return self.acks.pop(msg_id)
+			if not self.connected and not self.connecting:
+				break
+		return -1, None
 
+	def wait_until(self, status, timeout = None):
+		# Block until the daemon status is status (or one of a list of
+		# them), returns False on timeout or if the connection is lost
+		if isinstance(status, str):
+			status = [status]
+		return self.wait_for(lambda: self.status in status, timeout)
 
+	def wait_while(self, status, timeout = None):
+		if isinstance(status, str):
+			status = [status]
+		return self.wait_for(lambda: self.status is not None and self.status not in status, timeout)
 
+	def wait_for(self, condition, timeout = None):
+		if timeout is not None:
+			end = time.time() + timeout
+		while not condition():
+			if not self.connected and not self.connecting:
+				return False
+			if timeout is None:
+				wait = 1.0
+			else:
+				wait = min(end - time.time(), 1.0)
+				if wait <= 0:
+					return False
+			# select returns as soon as anything arrives
+			asyncore.loop(count=1,timeout=wait)
+		return True
 
+	def subscribe(self, topics = "*", min_interval = 0.0):
+		if not isinstance(topics, str):
+			topics = ",".join(topics) or "-"
+		self.send_msg("SUB %s %.4f" % (topics, min_interval))
+
+	def handle_close(self):
+		#self.logger.debug('handle_close()')
+		self.close()
+		pass
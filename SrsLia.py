@@ -118,8 +118,7 @@ class SrsLia:
 		# set the offsets to zero
 		if "auto" in kwargs.keys():
 			self.Visa.write("OEXP 1,0,0")
-			self.Visa.write("OEXP 2,0,0")
-			time.sleep(1)
+			VisaSubs.Complete(self.Visa,"OEXP 2,0,0")
 
 			# auto set the offsets
 			self.Visa.write("AOFF 1")
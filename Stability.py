@@ -0,0 +1,153 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+Stability of a reading over a window of time
+
+last edited : October 2026
+
+Explanation:
+
+	A StabilityDetector keeps the recent readings of one value in a
+	RingBuffer and works out the mean, the standard deviation and the
+	drift (the slope of a straight line fit) over the last Window seconds.
+	The value is stable at a set point once the window is full and
+		|mean - set point| < Error
+		standard deviation <= Stability
+		|drift| * Window <= Stability
+	so a single noisy reading no longer decides it. Single readings
+	outside Error do not stop it being stable, only through the mean and
+	the standard deviation.
+
+	The buffer starts with Capacity readings and is doubled, up to
+	MaxCapacity, whenever it is full of readings that are all still in
+	the window. MaxWindow gives the longest window that fits in
+	MaxCapacity readings at the present reading rate, a longer window
+	would never fill.
+
+	While it is not stable Check also gives an estimate of the seconds
+	until it will be: if some readings in the window are outside the
+	error band it is the time until they have left the window, if the
+	value is still on its way it is the time to reach the band at the
+	present drift plus a window. It is -1 if the value is moving away
+	from the set point or the estimate is unknown.
+
+Classes:
+	StabilityDetector
+
+"""
+
+import numpy as np
+
+import RingBuffer
+
+class StabilityDetector:
+
+	def __init__(self, Window = 60.0, MinPoints = 10, Capacity = 4096, MaxCapacity = 2**17):
+		self.Window = Window
+		self.MinPoints = MinPoints
+		self.MaxCapacity = MaxCapacity
+		self.Buffer = RingBuffer.RingBuffer(1, Capacity)
+		self.Last = None
+		# The result of the last Check, only worked out again when there
+		# is a new reading or the criteria change
+		self.Key = None
+		self.Result = None
+		return
+
+	def Append(self, Stamp, Value):
+		Buffer = self.Buffer
+		if (Buffer.Count == Buffer.Capacity and Buffer.Capacity < self.MaxCapacity
+				and Buffer.Stamp[Buffer.Head] >= Stamp - self.Window):
+			self.Grow(min(2 * Buffer.Capacity, self.MaxCapacity))
+		self.Buffer.Append(Stamp, [Value])
+		self.Last = Stamp
+		return
+
+	def Grow(self, Capacity):
+		# Move the readings to a buffer of Capacity readings
+		Data = self.Buffer.Latest(self.Buffer.Count)
+		self.Buffer = RingBuffer.RingBuffer(1, Capacity)
+		N = Data.shape[0]
+		self.Buffer.Stamp[:N] = Data[:,0]
+		self.Buffer.Data[:N,:] = Data[:,1:]
+		self.Buffer.Head = N % Capacity
+		self.Buffer.Count = N
+		return
+
+	def MaxWindow(self):
+		# The longest window MaxCapacity readings cover at the rate of the
+		# readings buffered, infinite while there are too few to tell
+		Data = self.Buffer.Latest(self.Buffer.Count)
+		if Data.shape[0] < self.MinPoints:
+			return float("inf")
+		Span = Data[-1,0] - Data[0,0]
+		if not Span > 0:
+			return float("inf")
+		return self.MaxCapacity * Span / (Data.shape[0] - 1)
+
+	def SetWindow(self, Window):
+		self.Window = Window
+		self.Key = None
+		return
+
+	def Readings(self):
+		# The readings in the window, a row of stamp and value for each
+		if self.Last is None:
+			return np.zeros((0, 2))
+		return self.Buffer.Range(self.Last - self.Window, self.Last)
+
+	def Statistics(self, Data = None):
+		# Number of readings, their span in time, mean, standard deviation
+		# and slope (per second) over the window, the slope is 0 if there
+		# are less than two readings
+		if Data is None:
+			Data = self.Readings()
+		N = Data.shape[0]
+		if N == 0:
+			return 0, 0.0, 0.0, 0.0, 0.0
+		t = Data[:,0] - Data[-1,0]
+		y = Data[:,1]
+		Mean = y.mean()
+		Std = y.std()
+		Slope = 0.0
+		if N > 1:
+			dt = t - t.mean()
+			Var = np.dot(dt, dt)
+			if Var > 0:
+				Slope = np.dot(dt, y - Mean) / Var
+		return N, -t[0], Mean, Std, Slope
+
+	def Check(self, Set, Error, Stability):
+		# Returns whether the value is stable at Set and the estimated
+		# seconds until it is (0 if it is, -1 if unknown)
+		Key = (self.Last, Set, Error, Stability)
+		if Key == self.Key:
+			return self.Result
+		Data = self.Readings()
+		N, Span, Mean, Std, Slope = self.Statistics(Data)
+		Stable = False
+		ETA = -1.0
+		if N >= self.MinPoints:
+			Outside = np.nonzero(np.abs(Data[:,1] - Set) >= Error)[0]
+			Stable = (Span >= 0.9 * self.Window and abs(Mean - Set) < Error
+				and Std <= Stability and abs(Slope) * self.Window <= Stability)
+			if Stable:
+				ETA = 0.0
+			elif len(Outside) == 0:
+				# In the band, waiting for the window to fill or the
+				# noise to settle
+				if Span < 0.9 * self.Window:
+					ETA = 0.9 * self.Window - Span
+			elif Outside[-1] < N - 1:
+				# Came into the band, the old readings have to leave the
+				# window
+				ETA = Data[Outside[-1],0] + self.Window - self.Last
+			else:
+				Distance = abs(Data[-1,1] - Set) - Error
+				if Slope * (Set - Data[-1,1]) > 0:
+					ETA = Distance / abs(Slope) + self.Window
+		self.Key = Key
+		self.Result = (Stable, ETA)
+		return self.Result
@@ -46,6 +46,9 @@ if __name__ == '__main__':
 	logging.basicConfig(level=logging.DEBUG,format='%(name)s: %(message)s',)
 
 	client = SocketUtils.SockClient('localhost', 18871)
+	# We only look once a second so there is no need for every reading
+	client.subscribe("TEMP", 0.5)
+	Decoder = SocketUtils.TelemetryDecoder()
 	#handler = server.handler
 	#asyncore.loop()
 	TCurrent = "0"
@@ -53,36 +56,23 @@ if __name__ == '__main__':
 
 	for i in range(10):
 		asyncore.loop(count=1,timeout=0.001)
-		TString = client.received_data
-		if TString:
-			TString = TString.split(",")[-1]
-			TString = TString.split(" ")
-			TCurrent = TString[0]
-			TStatus = TString[1]
-		else:
-			TCurrent = TCurrent
-			TStatus = TStatus
+		for TString in client.read_all():
+			Frame = Decoder.decode(TString.split(" ",1)[1])
+			TCurrent = Frame.value
+			TStatus = Frame.status
 	
 		time.sleep(1)
 
 	time.sleep(1)
-	client.to_send = "SET 1000"
-	asyncore.loop(count=1,timeout=0.001)
-	time.sleep(1)
-	client.to_send = "-"
+	print "SET 1000 reply %d" % client.request("SET 1000")
 
 	for i in range(10):
 		asyncore.loop(count=1,timeout=0.001)
-		TString = client.received_data
-		if TString:
-			TString = TString.split(",")[-1]
-			TString = TString.split(" ")
-			TCurrent = TString[0]
-			TStatus = TString[1]
-		else:
-			TCurrent = TCurrent
-			TStatus = TStatus
-		print TCurrent, TStatus
+		for TString in client.read_all():
+			Frame = Decoder.decode(TString.split(" ",1)[1])
+			TCurrent = Frame.value
+			TStatus = Frame.status
+		print TCurrent, TStatus, Decoder.missed
 		time.sleep(1)
 	
 	client.close()
@@ -13,6 +13,55 @@ last edited : August 2013
 	The daemon listens for commands to change the control loop or setpoint
 	The daemon broadcasts the current temperature
 
+	The daemon runs three threads: Acquire reads the PicoWatt as fast as
+	the bridge converts, Control updates the heater after every reading
+	and the main thread serves the socket, so commands are applied as
+	soon as they arrive. The control state they share is guarded by
+	TControl.Lock, the readings are passed to the main thread on the
+	Readings queue to be published. An error in a worker thread is
+	logged and the worker started again (Supervise). If there has been no
+	reading for StaleReadings seconds the status is published as -1, so
+	clients do not take a stopped acquisition for a fridge at set.
+
+	The temperature is at the set point (status 1) once the mean of a
+	window of readings is within ErrorTemp of it and their standard
+	deviation and drift are within ErrorDeltaTemp (60 s, change it with
+	"WINDOW seconds", a window longer than the readings buffered can
+	cover is refused). While going to set the estimated seconds until
+	then are published on the ETA topic.
+
+	The control thermometer is on PicoWatt channel 3. Other channels can
+	be added to the scan with "SCAN channel:sensor channel:sensor ..."
+	("SCAN -" to read only channel 3), their readings are published on
+	the topics CH1, CH2 etc. PicoScan decides which channel is read when.
+	TCS sources 0 and 1 can regulate a scanned channel with
+	"LOOP source channel set_point [Kp Ki Kd]" ("LOOP source -" to stop),
+	the PIDs of all three sources are updated together (PIDControl.PIDBank).
+
+	"SWP start finish rate FF" sweeps with a feed-forward of the heater
+	current learned from earlier sweeps (see FeedForward), without FF
+	the sweep is PID only but is still learned from. "TRACK" answers with
+	the tracking error of the running or last sweep.
+
+	Every reading used is also written, as the raw resistance with its
+	channel and bridge range, to the append only log of RawLog, so the
+	temperatures can be worked out again with another calibration (see
+	Recalibrate).
+
+	The control state (set point, sweep, loops, scan, calibration and
+	what the feed-forward has learned) is saved to a checkpoint after
+	each command and every 10 s (see DaemonState). A daemon started within an hour of the last
+	checkpoint carries on from it without touching the heaters: the PID
+	integrals are set from the currents the TCS reports, the stability
+	window is filled again from the raw log, the bridge is not switched
+	and left to settle if it is already on channel 3, and a sweep that
+	was running carries on with a minute for its clients to reconnect.
+
+	"python TDaemon.py --sim speed" runs the daemon against the simulated
+	instruments of SimPlant, speed times faster than real time. Its raw
+	log, checkpoint and tuned gains are kept in the temporary directory.
+	TuneSim runs it to compare the settling before and after TUNE.
+
 ToDo:
 	
 	Listen
@@ -26,31 +75,97 @@ ToDo:
 
 import SocketUtils as SocketUtils
 import logging
-import visa as visa
+try:
+	import visa as visa
+except ImportError:
+	# Without visa only the simulated instruments can be used
+	visa = None
 import VisaSubs as VisaSubs
 import string as string
+import sys
 import re as res
 import time
 import numpy as np
 import asyncore
 import PIDControl
+import SharedTelemetry
+import Calibration
+import PicoScan
+import Stability
+import FeedForward
+import threading
+import Queue
+import RingBuffer
+import SimPlant
+import InstrumentCache
+import RawLog
+import DaemonState
+import math
+import os
+import tempfile
+import traceback
 
 class TControl():
 
 	# Initialization call, initialize visas for the TCS, Picowatt and the
-	# Server, server always runs at 18871
-	def __init__(self):
-		self.PicoVisa = visa.instrument("GPIB0::20::INSTR",delay=0.04)
+	# Server, server always runs at 18871. With Sim (a SimPlant.SimFridge)
+	# the simulated instruments and its clock are used instead
+	def __init__(self, Sim = None):
+		if Sim is None:
+			self.PicoVisa = visa.instrument("GPIB0::20::INSTR",delay=0.04)
+			self.TCSVisa = VisaSubs.InitializeSerial("ASRL5",idn="ID?",term_chars="\\n")
+			self.Clock = time
+		else:
+			self.PicoVisa = Sim.Bridge
+			self.TCSVisa = Sim.TCS
+			self.Clock = Sim.Clock
+		# The TCS settings are cached so only changes go over the serial
+		# line, the cache is checked against STATUS? every TCSRefresh s
+		self.TCSVisa = InstrumentCache.CachedInstrument(self.TCSVisa, self.Clock)
+		self.TCSRefresh = 60.0
 		self.PicoVisa.write("HDR0")
 		self.PicoVisa.write("ARN 1")
 		self.PicoVisa.write("REM 1")
-		self.TCSVisa = VisaSubs.InitializeSerial("ASRL5",idn="ID?",term_chars="\\n")
 		address = ('localhost',18871)
 		self.Server = SocketUtils.SockServer(address)
+		self.Encoder = SocketUtils.TelemetryEncoder()
+		self.Shared = SharedTelemetry.TelemetryWriter("TEMP")
+		# Temperature, thermometer resistance and status
+		self.History = RingBuffer.RingBuffer(3)
+		# Raw readings of every channel, kept apart when simulating
+		if Sim is None:
+			self.RawLog = RawLog.RawLogWriter()
+		else:
+			self.RawLog = RawLog.RawLogWriter(os.path.join(tempfile.gettempdir(),"TDaemonSimRawLog"))
+		# The control state is checkpointed for a warm restart
+		if Sim is None:
+			self.Checkpoint = DaemonState.Checkpoint("TDaemon")
+		else:
+			self.Checkpoint = DaemonState.Checkpoint("TDaemonSim",tempfile.gettempdir())
+		# Until then (time.time()) a sweep is not stopped for having no
+		# listeners, so the clients can reconnect after a restart
+		self.ListenerGrace = 0.0
+		# Thermometer calibrations are read from Calibrations/, the
+		# sensor can be changed with the CAL command
+		self.Registry = Calibration.CalibrationRegistry()
+		self.Sensor = "SO703"
+		self.Calibration = self.Registry.Get(self.Sensor)
+		self.ScanSensors = {}
 		self.ResThermometer = 1
 		self.Temperature = 0.0
 		self.PicoChannel = 0
+		self.MuxDelay = 0.5
+		# The longest a conversion takes, and the status byte bit the
+		# bridge sets when a conversion is ready. None waits the whole
+		# PicoConversion: 16 is the IEEE-488 MAV bit, which is also set
+		# by any answer still waiting to be read, so the bit is only to be
+		# set once it has been checked on the bridge
+		self.PicoConversion = 0.4
+		self.PicoReady = None
+		self.Scanner = PicoScan.ScanScheduler(3)
+		self.ChannelEncoders = {}
 		self.PicoRange = 0
+		self.RangeMargin = math.log10(1.15)
 		self.SetTemp = -1
 		self.Status = -1
 		self.TCSHeater = [0,0,0]
@@ -63,34 +178,77 @@ class TControl():
 		self.MaxCurrent = 25000
 		self.ErrorTemp = 10 # The acceptable error in temperature
 		self.ErrorDeltaTemp = 10 # The acceptable stability
+		# At set point is decided over a window of readings, see Stability
+		self.Stability = Stability.StabilityDetector(Window=60.0)
+		self.ETA = -1.0
 		self.Sweep = False
 		self.SweepStart = 0
 		self.SweepFinish = 0
 		self.SweepRate = 0 # rate in mK/s
 		self.SweepTime = 0
 		self.SweepDirection = 1.0
+		self.SweepFeedForward = False
+		self.SweepDone = False
+		self.FeedForward = FeedForward.SweepFeedForward()
+		# PID gains tuned by relay feedback, per set point (see PIDControl)
+		# and interpolated between them, the table can be added to with
+		# "GAINS set_point Kp Ki Kd [I_min I_max]". Tuning gives up after
+		# TuneTime seconds. The simulation keeps its gains apart
+		self.Tuner = None
+		self.TuneTime = 7200.0
+		if Sim is None:
+			self.GainsFile = PIDControl.GAINS_FILE
+		else:
+			self.GainsFile = os.path.join(tempfile.gettempdir(),"TDaemonSimGains.dat")
+		self.Schedule = PIDControl.GainSchedule(PIDControl.loadGains(self.GainsFile))
+		self.GainsChanged = False
+		# A PID for each TCS source, gains per second, the integral terms
+		# are limited to -2000..15000 micro amps. Source 2 heats the mixing
+		# chamber (channel 3) and follows the status, the others are run
+		# on a scanned channel with "LOOP source channel set_point". No
+		# more is integrated than a few times the longest the scan leaves
+		# a channel unread
+		Max_dt = [3*self.Scanner.Revisit, 3*self.Scanner.Revisit, 30.0]
+		self.Bank = PIDControl.PIDBank(3,P=10,I=2.5,D=0,Integrator_max=6000,Integrator_min=-800,Output_min=0,Output_max=self.MaxCurrent,Max_dt=Max_dt)
+		self.LoopChannel = [None,None,self.Scanner.Control]
+		self.LoopValues = np.empty((3,))
+		self.LoopValues.fill(np.nan)
+		self.HeatersOff = []
+		# Shared between the acquisition, control and socket threads
+		self.Lock = threading.Lock()
+		self.Readings = Queue.Queue()
+		self.Measured = threading.Event()
+		self.Running = True
+		# Time (time.time()) of the last reading, the published status is
+		# -1 while there have been none for StaleReadings s
+		self.LastReading = time.time()
+		self.StaleReadings = 30.0
 		return
 
 
 	def SetTCS(self,Source,Current):
+		# Returns whether the current had to be sent
 		if Current < 0:
 			Current = 0
 		elif Current > self.MaxCurrent:
 			Current = self.MaxCurrent
 		# Current in microAmp
 		# print Current
-		Source = Source + 1
-		command = " ".join(("SETDAC","%d" % Source,"0","%d" % Current))
-		
-		NEWPID = pid.update(control.Temperature)
-		NEWPID = int(NEWPID)
-		self.TCSVisa.ask(command)
-		return
+		Current = int(Current)
+		command = " ".join(("SETDAC","%d" % (Source+1),"0","%d" % Current))
+		Sent = self.TCSVisa.Set(("DAC",Source),Current,command,Ask=True)
+		self.TCSCurrent[Source] = Current
+		return Sent
 
 	def ReadPico(self):
-		# Get the resistance of the current channel of the picowatt
+		# Get the resistance of the current channel of the picowatt after
+		# PicoConversion, or as soon as the conversion is ready if there
+		# is a PicoReady bit
 		self.PicoVisa.write("ADC")
-		time.sleep(0.4)
+		if self.PicoReady is None:
+			self.Clock.sleep(self.PicoConversion)
+		else:
+			VisaSubs.WaitStatus(self.PicoVisa,self.PicoReady,self.PicoConversion,self.Clock)
 		Answer = self.PicoVisa.ask("RES ?")
 		Answer = Answer.strip()
 		try:
@@ -107,12 +265,27 @@ class TControl():
 		return
 
 	def SetPicoChannel(self,Channel):
+		# The bridge still has to settle after this, the scanner throws
+		# away the readings until it has
 		self.PicoVisa.write("INP 0")
 		Command = "".join(("MUX ","%d" % Channel))
 		self.PicoVisa.write(Command)
-		time.sleep(3)
+		self.Clock.sleep(self.MuxDelay)
 		self.PicoVisa.write("INP 1")
-		time.sleep(10)
+		self.PicoChannel = Channel
+		return
+
+	def FindPicoChannel(self):
+		# If the bridge is already on the control channel it has settled
+		# there, so it is not switched again
+		try:
+			Channel = int(self.PicoVisa.ask("MUX ?").strip())
+		except ValueError:
+			return
+		if Channel == self.Scanner.Control:
+			self.PicoChannel = Channel
+			with self.Lock:
+				self.Scanner.Resume(Channel, self.Clock.time())
 		return
 
 	def ReadTCS(self):
@@ -125,17 +298,15 @@ class TControl():
 		TMP = [1,10,100,1000]
 		for i in range(3):
 			self.TCSHeater[i] = int(Heaters[i])
+			self.TCSVisa.Update(("HEATER",i),self.TCSHeater[i])
 		for i in range(3):
 			self.TCSCurrent[i] = int(Current[i])*TMP[int(Range[i])-1]
+			self.TCSVisa.Update(("DAC",i),self.TCSCurrent[i])
 		return
 
-	def CalcTemperature(self,Calibration,factor=0):
-		logR = np.log10(self.ResThermometer)-factor
-		RPoly = np.ones((len(Calibration),))
+	def CalcTemperature(self):
 		OldT = self.Temperature
-		for i in range(1,len(RPoly)):
-			RPoly[i] = logR * RPoly[i-1]
-		self.Temperature = np.power(10,(np.sum(np.multiply(RPoly,Calibration))))
+		self.Temperature = self.Calibration.Convert(self.ResThermometer)
 		self.DeltaTemp = abs(self.Temperature - OldT)
 		return
 
@@ -154,21 +325,28 @@ class TControl():
 		elif self.SetTemp <= 0:
 			# There is no set point
 			self.Status = -1
-		elif (abs(self.SetTemp - self.Temperature) < self.ErrorTemp) and abs(self.DeltaTemp) <= self.ErrorDeltaTemp:
-			# We are at the set point
-			self.Status = 1
 		else:
-			# Going to Set
-			self.Status = 0
+			Stable, self.ETA = self.Stability.Check(self.SetTemp, self.ErrorTemp, self.ErrorDeltaTemp)
+			if Stable:
+				# We are at the set point
+				self.Status = 1
+			else:
+				# Going to Set
+				self.Status = 0
+		if self.Status != 0:
+			self.ETA = -1.0
 		return
 
-	# Interpret a message from the socket
+	# Interpret a message from the socket, returns whether there is a new
+	# set point and whether the message was a valid command
 	def ReadMsg(self,Msg):
 		Msg = Msg.split(" ")
 		GotSet = False
+		Valid = False
 		if Msg[0] == "SET":
 			try:
 				NewSet = float(Msg[1])
+				Valid = True
 				if abs(self.SetTemp-NewSet) > 5:
 					if NewSet <= self.MaxTemp:
 						self.SetTemp = NewSet
@@ -179,6 +357,7 @@ class TControl():
 					print "Got set point from socket %.2f" % self.SetTemp
 					self.ConstCurrent = False
 					self.Sweep = False
+					self.Tuner = None
 			except:
 				pass
 		if Msg[0] == "SWP":
@@ -186,10 +365,16 @@ class TControl():
 				self.SweepStart = float(Msg[1])
 				self.SweepFinish = float(Msg[2])
 				self.SweepRate = abs(float(Msg[3]))
+				Valid = True
 				self.Sweep = True
-				self.SweepTime = time.time()
+				self.SweepTime = self.Clock.time()
+				self.SweepFeedForward = len(Msg) > 4 and Msg[4] == "FF"
+				self.SweepDone = False
+				# A sweep that is replaced is not learned from
+				self.FeedForward.Finish(False)
 				self.ConstCurrent = False
-				print "Got temperature sweep from %.2f mK to %.2f mK at %.2f mK/s" % (self.SweepStart, self.SweepFinish, self.SweepRate)
+				self.Tuner = None
+				print "Got temperature sweep from %.2f mK to %.2f mK at %.2f mK/s%s" % (self.SweepStart, self.SweepFinish, self.SweepRate, " with feed-forward" if self.SweepFeedForward else "")
 				if self.SweepFinish >= self.SweepStart:
 					self.SweepDirection = 1.0
 				else:
@@ -199,109 +384,586 @@ class TControl():
 		if Msg[0] == "CST":
 			try:
 				self.CurrentConst = float(Msg[1])
+				Valid = True
 				self.ConstCurrent = True
 				self.Sweep = False
+				self.Tuner = None
 				print "Got constant current point from socket %.2f micro amps" % self.CurrentConst
 			except:
 				pass
 		if Msg[0] == "T_ERROR":
 			try:
 				self.ErrorTemp = float(Msg[1])
+				Valid = True
 			except:
 				pass
 		if Msg[0] == "DT_ERROR":
 			try:
 				self.ErrorDeltaTemp = float(Msg[1])
+				Valid = True
 			except:
 				pass
+		if Msg[0] == "TUNE" and self.SetTemp > 0 and not self.Sweep and not self.ConstCurrent:
+			# Relay feedback about the set point, optionally with the
+			# relay amplitude in micro amps
+			try:
+				Bias = self.TCSCurrent[2]
+				Amplitude = max(Bias/2.0, 500.0)
+				if len(Msg) > 1:
+					Amplitude = float(Msg[1])
+				self.Tuner = PIDControl.RelayTuner(self.SetTemp, Bias, Amplitude, Hysteresis=self.ErrorTemp/5.0, Output_max=self.MaxCurrent, MaxTime=self.TuneTime)
+				Valid = True
+				print "Tuning at %.2f mK with relay %.0f +- %.0f micro amps" % (self.SetTemp, Bias, Amplitude)
+			except:
+				pass
+		if Msg[0] == "GAINS":
+			try:
+				Gains = [float(v) for v in Msg[1:]]
+				if len(Gains) in (4,6) and Gains[0] > 0:
+					PIDControl.saveGains(Gains[0], Gains[1:], self.GainsFile)
+					self.Schedule = PIDControl.GainSchedule(PIDControl.loadGains(self.GainsFile))
+					self.GainsChanged = True
+					Valid = True
+			except:
+				pass
+		if Msg[0] == "LOOP":
+			# LOOP source channel set_point [Kp Ki Kd] or LOOP source -
+			try:
+				Source = int(Msg[1])
+				if Source not in (0,1):
+					raise ValueError("source %d is not free" % Source)
+				if Msg[2] == "-":
+					self.LoopChannel[Source] = None
+					self.HeatersOff.append(Source)
+					Valid = True
+					print "Stopped the loop on source %d" % Source
+				else:
+					Channel = int(Msg[2])
+					if self.Scanner.Get(Channel) is None or Channel == self.Scanner.Control:
+						raise ValueError("channel %d is not scanned" % Channel)
+					Loop = self.Bank.channel(Source)
+					if len(Msg) > 6:
+						Loop.setGains(float(Msg[4]), float(Msg[5]), float(Msg[6]))
+					Loop.setPoint(float(Msg[3]), bumpless=self.LoopChannel[Source] is not None)
+					self.LoopChannel[Source] = Channel
+					Valid = True
+					print "Source %d controls channel %d at %.2f mK" % (Source, Channel, float(Msg[3]))
+			except (IndexError, ValueError) as e:
+				print "Loop not changed: %s" % e
+		if Msg[0] == "WINDOW":
+			try:
+				Window = float(Msg[1])
+				if Window > 0 and Window <= self.Stability.MaxWindow():
+					self.Stability.SetWindow(Window)
+					Valid = True
+			except:
+				pass
+		if Msg[0] == "SCAN":
+			# Set the other channels to scan
+			try:
+				Channels = []
+				for Item in Msg[1:]:
+					if Item == "-":
+						continue
+					Channel, Sensor = Item.split(":")
+					Channel = int(Channel)
+					if Channel == self.Scanner.Control:
+						raise ValueError("channel %d is the control channel" % Channel)
+					Channels.append((Channel, Sensor, self.Registry.Get(Sensor)))
+				self.Scanner.Clear()
+				self.ScanSensors = {}
+				for Channel, Sensor, Cal in Channels:
+					self.Scanner.Add(Channel, Cal)
+					self.ScanSensors[Channel] = Sensor
+				Valid = True
+				print "Scanning channels %s" % ", ".join("%d" % c.Mux for c in self.Scanner.Channels)
+			except (IOError, ValueError) as e:
+				print "Scan not changed: %s" % e
+		if Msg[0] == "CAL":
+			# Change the thermometer calibration
+			try:
+				self.Calibration = self.Registry.Get(Msg[1])
+				self.Sensor = Msg[1]
+				Valid = True
+				print "Using calibration %s" % Msg[1]
+			except (IndexError, IOError, ValueError) as e:
+				print "Calibration not changed: %s" % e
 	
-		return GotSet
+		return GotSet, Valid
+
+	def GetState(self):
+		# The control state for the checkpoint, called with the Lock held
+		b = self.Bank
+		Loops = []
+		for Source in (0,1):
+			if self.LoopChannel[Source] is not None:
+				Loops.append([Source, self.LoopChannel[Source], float(b.set_point[Source]),
+					float(b.Kp[Source]), float(b.Ki[Source]), float(b.Kd[Source])])
+		Scan = []
+		for Channel in self.Scanner.Channels:
+			if Channel.Mux in self.ScanSensors:
+				Scan.append([Channel.Mux, self.ScanSensors[Channel.Mux], Channel.Noise])
+		return {"SetTemp": self.SetTemp, "Status": self.Status,
+			"ConstCurrent": self.ConstCurrent, "CurrentConst": self.CurrentConst,
+			"Sweep": self.Sweep, "SweepStart": self.SweepStart,
+			"SweepFinish": self.SweepFinish, "SweepRate": self.SweepRate,
+			"SweepTime": self.SweepTime, "SweepDirection": self.SweepDirection,
+			"SweepFeedForward": self.SweepFeedForward,
+			"ErrorTemp": self.ErrorTemp, "ErrorDeltaTemp": self.ErrorDeltaTemp,
+			"Window": self.Stability.Window, "Sensor": self.Sensor,
+			"Scan": Scan, "Loops": Loops,
+			"FeedForward": self.FeedForward.GetState()}
+
+	def Restore(self,State,pid):
+		# Carry on from a checkpoint, after ReadTCS so the PIDs pick up
+		# the currents the heaters have now. Everything is read and
+		# checked before anything is changed, a checkpoint with a key
+		# missing or wrong (KeyError, TypeError or ValueError) leaves the
+		# daemon as it started
+		Names = ("SetTemp", "ConstCurrent", "CurrentConst", "Sweep",
+			"SweepStart", "SweepFinish", "SweepRate", "SweepTime",
+			"SweepDirection", "SweepFeedForward", "ErrorTemp", "ErrorDeltaTemp")
+		Values = [State[Name] for Name in Names]
+		Window = float(State["Window"])
+		if not Window > 0:
+			raise ValueError("window %g" % Window)
+		Status = int(State["Status"])
+		Saved = float(State["Saved"])
+		Calibrated = State["Sensor"]
+		Scan = [(int(Channel), Sensor, float(Noise)) for Channel, Sensor, Noise in State["Scan"]]
+		Loops = [(int(Source), int(Channel), float(SetPoint), float(Kp), float(Ki), float(Kd))
+			for Source, Channel, SetPoint, Kp, Ki, Kd in State["Loops"]]
+		for Loop in Loops:
+			if Loop[0] not in (0,1):
+				raise ValueError("source %d is not free" % Loop[0])
+		Learned = FeedForward.SweepFeedForward()
+		Learned.SetState(State["FeedForward"])
+		with self.Lock:
+			for Name, Value in zip(Names, Values):
+				setattr(self, Name, Value)
+			self.Stability.SetWindow(Window)
+			self.FeedForward = Learned
+			try:
+				self.Calibration = self.Registry.Get(Calibrated)
+				self.Sensor = Calibrated
+			except (IOError, ValueError) as e:
+				print "Calibration %s not restored: %s" % (Calibrated, e)
+			for Channel, Sensor, Noise in Scan:
+				try:
+					self.Scanner.Add(Channel, self.Registry.Get(Sensor))
+				except (IOError, ValueError) as e:
+					print "Channel %d not restored: %s" % (Channel, e)
+					continue
+				self.Scanner.Get(Channel).Noise = Noise
+				self.ScanSensors[Channel] = Sensor
+			for Source, Channel, SetPoint, Kp, Ki, Kd in Loops:
+				if self.Scanner.Get(Channel) is None:
+					continue
+				Loop = self.Bank.channel(Source)
+				Loop.setGains(Kp, Ki, Kd)
+				Loop.setPoint(SetPoint)
+				self.LoopChannel[Source] = Channel
+			SetPoint = self.SetTemp
+			if self.Sweep:
+				SetPoint = (self.Clock.time() - self.SweepTime) * self.SweepRate * self.SweepDirection + self.SweepStart
+				if (SetPoint - self.SweepFinish) * self.SweepDirection >= 0:
+					SetPoint = self.SweepFinish
+				self.FeedForward.Start(self.SweepRate, self.SweepDirection)
+				self.ListenerGrace = time.time() + 60.0
+			if SetPoint > 0 and not self.ConstCurrent:
+				self.ScheduleGains(pid, SetPoint)
+				pid.setPoint(SetPoint)
+				Feed = None
+				if self.Sweep and self.SweepFeedForward:
+					Feed = self.FeedForward.Current(SetPoint, self.SweepRate, self.SweepDirection)
+				if Feed is not None:
+					pid.setFeedforward(Feed)
+			# The readings of the last window, so the status is known again
+			# without waiting for the window to fill
+			Now = self.Clock.time()
+			Data = RawLog.ReadRawLog(Now - self.Stability.Window, Now, self.RawLog.Directory, self.Scanner.Control)
+			if len(Data):
+				with np.errstate(invalid="ignore", divide="ignore", over="ignore"):
+					Temperatures = np.asarray(self.Calibration.Convert(Data["Resistance"].astype(np.float64)))
+				for Stamp, Temperature, Resistance in zip(Data["Stamp"], Temperatures, Data["Resistance"]):
+					if np.isfinite(Temperature):
+						self.Stability.Append(float(Stamp), Temperature)
+						self.History.Append(float(Stamp), [Temperature, Resistance, Status])
+				self.Temperature = float(Temperatures[-1])
+			# The PIDs take over the currents the heaters have, at the last
+			# temperatures read, so their first outputs are those currents
+			if SetPoint > 0 and not self.ConstCurrent:
+				pid.setOutput(self.TCSCurrent[2], self.LastLogged(self.Scanner.Control, self.Calibration, Now))
+			for Source in (0,1):
+				Channel = self.LoopChannel[Source]
+				if Channel is not None:
+					Loop = self.Bank.channel(Source)
+					Loop.setOutput(self.TCSCurrent[Source], self.LastLogged(Channel, self.Scanner.Get(Channel).Calibration, Now))
+			# Before the control thread starts, so it does not take the
+			# heaters for unset
+			self.UpdateStatus()
+		print "Restored the state of %.0f s ago, set point %.2f mK%s" % (time.time() - Saved, self.SetTemp, ", sweeping" if self.Sweep else "")
+		return
+
+	def LastLogged(self,Channel,Calibration,Now):
+		# Temperature of the last reading of Channel in the raw log, None
+		# if there is none from the last few revisits
+		Data = RawLog.ReadRawLog(Now - 3*self.Scanner.Revisit, Now, self.RawLog.Directory, Channel)
+		if not len(Data):
+			return None
+		with np.errstate(invalid="ignore", divide="ignore", over="ignore"):
+			Temperature = Calibration.Convert(float(Data["Resistance"][-1]))
+		if not np.isfinite(Temperature):
+			return None
+		return float(Temperature)
+
+	def ScheduleGains(self,pid,SetPoint):
+		# Use the gains scheduled for SetPoint if there are any, the
+		# output carries on from where it was
+		Gains = self.Schedule.gains(SetPoint)
+		if Gains is not None:
+			pid.setGains(Gains[0], Gains[1], Gains[2], Gains[3], Gains[4])
+		return
+
+	def Supervise(self,Target,*Args):
+		# Runs a worker thread, an error (a GPIB or serial transaction
+		# that fails) is logged and the worker started again
+		while self.Running:
+			try:
+				Target(*Args)
+			except Exception:
+				print "%s failed, restarting it:" % Target.__name__
+				traceback.print_exc()
+				time.sleep(1.0)
+		return
+
+	def Acquire(self):
+		# Acquisition thread, reads the bridge and queues each reading for
+		# the socket thread. The bridge autoranges, its range is only
+		# asked for again on a new channel, when the resistance crosses
+		# the end of a range or while it is near one
+		RangeAt = None
+		while self.Running:
+			with self.Lock:
+				Channel = self.Scanner.Next(self.Clock.time(), self.Status >= 0)
+			if Channel != self.Scanner.Current:
+				self.SetPicoChannel(Channel)
+				with self.Lock:
+					self.Scanner.Switched(Channel, self.Clock.time())
+			self.ReadPico()
+			Stamp = self.Clock.time()
+			with self.Lock:
+				if not self.Scanner.Update(Stamp, self.ResThermometer):
+					continue
+				if Channel == self.Scanner.Control:
+					self.CalcTemperature()
+					Temperature = self.Temperature
+					self.Stability.Append(Stamp, Temperature)
+				else:
+					Temperature = self.Scanner.Get(Channel).Calibration.Convert(self.ResThermometer)
+				Controlled = False
+				for Source in range(3):
+					if self.LoopChannel[Source] == Channel:
+						self.LoopValues[Source] = Temperature
+						Controlled = True
+			if Controlled:
+				self.Measured.set()
+			Resistance = self.ResThermometer
+			# The ranges of the AVS-47 end at 2, 20, 200 ... Ohm, within
+			# RangeMargin of an end the range is read every time as the
+			# autoranging has some hysteresis
+			Band = None
+			Near = True
+			if Resistance > 0:
+				x = math.log10(Resistance / 2.0)
+				Band = int(math.floor(x))
+				Near = abs(x - round(x)) < self.RangeMargin
+			if Near or RangeAt != (Channel, Band):
+				self.ReadPicoRange()
+				RangeAt = (Channel, Band)
+			self.Readings.put((Stamp, Channel, Temperature, Resistance, self.PicoRange))
+			self.LastReading = time.time()
+		return
+
+	def Control(self,pid):
+		# Control thread, updates the heaters after every new reading of
+		# their thermometers, pid is the mixing chamber PID of the bank.
+		# The TCS is only talked to from here
+		while self.Running:
+			if not self.Measured.wait(1.0):
+				continue
+			self.Measured.clear()
+			NEWPID = 0
+			with self.Lock:
+				Now = self.Clock.time()
+				if self.Sweep:
+					deltaTime = Now - self.SweepTime
+					self.setTemp = deltaTime * self.SweepRate * self.SweepDirection + self.SweepStart
+					if (self.setTemp - self.SweepFinish)*self.SweepDirection >= 0:
+						# Sweep has finished, hold the last set point
+						self.setTemp = self.SweepFinish
+						self.SetTemp = self.SweepFinish
+						self.Sweep = False
+						self.SweepDone = True
+					self.ScheduleGains(pid, self.setTemp)
+					pid.setPoint(self.setTemp, bumpless=True)
+					Starting = self.FeedForward.Run is None
+					if Starting:
+						self.FeedForward.Start(self.SweepRate, self.SweepDirection)
+					if self.SweepFeedForward:
+						Feed = self.FeedForward.Current(self.setTemp, self.SweepRate, self.SweepDirection)
+						if Feed is not None:
+							if Starting:
+								# The integral term hands over the current
+								# holding the start, the rest steps in
+								Holding = self.FeedForward.Holding(self.setTemp)
+								if Holding is None:
+									Holding = Feed
+								pid.setFeedforward(Holding, bumpless=True)
+							pid.setFeedforward(Feed)
+				elif self.GainsChanged:
+					self.ScheduleGains(pid, pid.getPoint())
+				self.GainsChanged = False
+				Status = self.Status
+				CurrentConst = self.CurrentConst
+				# All the PIDs with a new measurement in one step
+				Values = self.LoopValues.copy()
+				self.LoopValues.fill(np.nan)
+				Active = [Channel is not None for Channel in self.LoopChannel]
+				Active[2] = Status >= 0 and self.Tuner is None
+				Outputs = self.Bank.update(Values, Now, Active)
+				if np.isfinite(Values[2]) and Active[2]:
+					if self.FeedForward.Run is not None:
+						self.FeedForward.Record(pid.getPoint(), Values[2], Outputs[2])
+					elif Status == 1:
+						self.FeedForward.Hold(pid.getPoint(), Outputs[2])
+				if self.FeedForward.Run is not None and not self.Sweep:
+					# The sweep has stopped, the integral term takes over
+					# the current holding the set point and the rest of the
+					# feed-forward stops
+					self.FeedForward.Finish(self.SweepDone)
+					Holding = self.FeedForward.Holding(pid.getPoint())
+					if Holding is not None and pid.getFeedforward() != 0:
+						pid.setFeedforward(Holding)
+					pid.setFeedforward(0.0, bumpless=True)
+					self.SweepDone = False
+				Loops = {}
+				for Source in (0,1):
+					if self.LoopChannel[Source] is not None:
+						Loops[Source] = int(Outputs[Source])
+				HeatersOff = self.HeatersOff
+				self.HeatersOff = []
+				if Status >= 0 and self.Tuner is not None:
+					NEWPID = int(self.Tuner.update(self.Temperature, Now))
+					if self.Tuner.Failed:
+						print "Tuning at %.2f mK gave up after %.0f s with %d crossings, back to the PID" % (self.Tuner.set_point, self.TuneTime, len(self.Tuner.Crossings))
+					elif self.Tuner.Done:
+						print "Tuned at %.2f mK: Ku %.3g, Pu %.1f s, Kp %.3g Ki %.3g Kd %.3g" % ((self.Tuner.set_point, self.Tuner.Ku, self.Tuner.Pu) + self.Tuner.Gains)
+						PIDControl.saveGains(self.Tuner.set_point, self.Tuner.Gains, self.GainsFile)
+						self.Schedule = PIDControl.GainSchedule(PIDControl.loadGains(self.GainsFile))
+					if self.Tuner.Done or self.Tuner.Failed:
+						self.ScheduleGains(pid, self.SetTemp)
+						# Start the integral term at the relay bias
+						pid.setPoint(self.SetTemp)
+						pid.setIntegral(self.Tuner.Bias)
+						self.Tuner = None
+				elif Status >= 0:
+					NEWPID = int(Outputs[2])
+
+			# After a TCS error the heaters are not known until it has
+			# been asked for its state again
+			if self.TCSVisa.Age(("HEATER",2)) == float("inf"):
+				try:
+					self.ReadTCS()
+				except Exception as e:
+					print "TCS not read: %s" % e
+					continue
+
+			# Work out every heater change then send them together
+			Switch = []
+			Currents = {}
+			if Status == -1 and self.TCSHeater[2] == 1:
+				# status is unset and the heater is on turn it off
+				Switch.append(2)
+			elif Status == -2:
+				if self.TCSHeater[2] == 0:
+				# the status is constant current --> Turn heater on to con
+					Switch.append(2)
+				Currents[2] = CurrentConst
+			elif Status >= 0 and self.TCSHeater[2] == 0:
+				# status is go to set and heater is off --> turn it on
+				Switch.append(2)
+			elif Status >= 0 and self.TCSHeater[2] == 1:
+				Currents[2] = NEWPID
+			for Source in HeatersOff:
+				if Source not in Loops and self.TCSHeater[Source] == 1:
+					Switch.append(Source)
+			for Source, Current in Loops.items():
+				if self.TCSHeater[Source] == 0:
+					Switch.append(Source)
+				else:
+					Currents[Source] = Current
+			try:
+				self.SetHeaters(Switch, Currents)
+			except Exception as e:
+				# Not known what went through, the TCS is read next time
+				print "TCS error: %s" % e
+				self.TCSVisa.Invalidate()
+		return
 
-	def TCSSwitchHeater(self,Heater):
+	def SetHeaters(self,Switch,Currents):
+		# The heaters in Switch are switched with one SETUP, the DAC is
+		# only written for the sources whose current has changed (see
+		# InstrumentCache). The TCS is only asked for its status when the
+		# cache is due to be checked
+		if Switch:
+			self.TCSSwitchHeater(Switch)
+		for Source, Current in Currents.items():
+			self.SetTCS(Source,Current)
+		if max(self.TCSVisa.Age(("HEATER",i)) for i in range(3)) > self.TCSRefresh:
+			self.ReadTCS()
+		return
+
+	def TCSSwitchHeater(self,Heaters):
+		# Toggle the heater of each source in Heaters
+		if isinstance(Heaters,int):
+			Heaters = [Heaters]
 		CommandVec = np.zeros((12,))
-		CommandVec[2+Heater*4] = 1
+		for Heater in Heaters:
+			CommandVec[2+Heater*4] = 1
+			print "Heater %d Switched" % Heater
 		CommandStr = ""
-		print "Heater %d Switched" % Heater
 		for i in CommandVec:
 			CommandStr = "".join((CommandStr, "%d," % i))
 		CommandStr = CommandStr[:-1]
-		self.TCSVisa.ask(" ".join(("SETUP",CommandStr)))
+		try:
+			self.TCSVisa.ask(" ".join(("SETUP",CommandStr)))
+		except Exception:
+			# Not known whether the heaters switched
+			for Heater in Heaters:
+				self.TCSVisa.Invalidate(("HEATER",Heater))
+			raise
+		# SETUP toggles, so the new state follows from the cached one
+		for Heater in Heaters:
+			self.TCSHeater[Heater] = 1 - self.TCSHeater[Heater]
+			self.TCSVisa.Update(("HEATER",Heater),self.TCSHeater[Heater])
 		return
 
 
-##################### Calibrations
-SO703 = [7318.782092,-13274.53584,10276.68481,-4398.202411,1123.561007,-171.3095557,14.43456504,-0.518534965]
-SO914 = [5795.148097375,-11068.032226486,9072.821104899,-4133.466851312,1129.955799406,-185.318021359,16.881907269,-0.658939155]
-MATS56 = [19.68045382,-20.19660902,10.13318296,-2.742724207,0.385556989,-0.022178276]
-
 if __name__ == '__main__':
 
-	# Initialize a PID controller
-
-	pid = PIDControl.PID(P=10,I=1,D=0,Derivator=0,Integrator=0,Integrator_max=15000,Integrator_min=-2000)
-
-	control = TControl()
-	control.SetPicoChannel(3)
-
-	# Main loop
+	# python TDaemon.py --sim speed runs against a simulated fridge
+	Sim = None
+	if "--sim" in sys.argv:
+		Speed = 1.0
+		i = sys.argv.index("--sim")
+		if len(sys.argv) > i + 1:
+			Speed = float(sys.argv[i+1])
+		Sim = SimPlant.SimFridge(Speed)
+		print "Simulated fridge at %g times real time" % Speed
+
+	control = TControl(Sim)
 	control.ReadTCS()
+	control.FindPicoChannel()
 
-	while 1:
-		
-		# Read the picowatt and calculate the temperature
-		control.ReadPico()
-		control.CalcTemperature(SO703)
-		# Push the reading to clients
-		for j in control.Server.handlers:
-			j.to_send = ",%.3f %d" % (control.Temperature, control.Status)
-			SocketMsg = j.received_data
-			if SocketMsg:
-				GotSet = control.ReadMsg(SocketMsg)
-				if GotSet:
-					pid.setPoint(control.SetTemp)
-		asyncore.loop(count=1,timeout=0.001)
-		
-		control.UpdateStatus()
-
-		# Now we should do some PID stuff
-		if control.Sweep:
-			deltaTime = time.time() - control.SweepTime
-			control.setTemp = deltaTime * control.SweepRate * control.SweepDirection + control.SweepStart
-			pid.setPoint(control.setTemp)
-			if (control.setTemp - control.SweepFinish)*control.SweepDirection >= 0:
-				# Sweep has finished
-				control.Sweep = False
-			elif not control.Server.handlers:
-				control.Sweep = False
-
-		
-		if control.Status >= 0:
-			NEWPID = pid.update(control.Temperature)
-			NEWPID = int(NEWPID)
-			if NEWPID < 0:
-				NEWPID = 0
-			if NEWPID > control.MaxCurrent:
-				NEWPID = control.MaxCurrent
-
-		if control.Status == -1 and control.TCSHeater[2] == 1:
-			# status is unset and the heater is on turn it off
-			control.TCSSwitchHeater(2)
-			control.ReadTCS()
-		elif control.Status == -2:
-			if control.TCSHeater[2] == 0:
-			# the status is constant current --> Turn heater on to con
-				control.TCSSwitchHeater(2)
-			control.SetTCS(2,control.CurrentConst)
-			control.ReadTCS()
-		elif control.Status >= 0 and control.TCSHeater[2] == 0:
-			# status is go to set and heater is off --> turn it on
-			control.TCSSwitchHeater(2)
-			control.ReadTCS()
-		elif control.Status >= 0 and control.TCSHeater[2] == 1:
-			control.SetTCS(2,NEWPID)
-			control.TCSCurrent[2] = NEWPID
-
-		time.sleep(0.4)
-
-	control.TCSVisa.close()
+	# The mixing chamber PID
+	pid = control.Bank.channel(2)
 
+	# Warm restart from the last checkpoint if it is recent
+	State = control.Checkpoint.Load()
+	if State is not None:
+		try:
+			control.Restore(State, pid)
+		except (KeyError, TypeError, ValueError) as e:
+			print "Checkpoint not restored: %s" % e
+
+	# The bridge and the heater run in their own threads so the socket
+	# is never held up by a GPIB or serial transaction
+	Threads = [threading.Thread(target=control.Supervise,args=(control.Acquire,)),
+		threading.Thread(target=control.Supervise,args=(control.Control,pid))]
+	for Thread in Threads:
+		Thread.daemon = True
+		Thread.start()
+
+	# Main loop, serves the socket
+	try:
+		while 1:
+			asyncore.loop(count=1,timeout=0.01)
+			# Apply the commands from the clients, the answers are held
+			# back until the status is published so a client always sees
+			# the status change before the answer to its command
+			Replies = []
+			Queries = []
+			Commanded = False
+			with control.Lock:
+				for j in control.Server.handlers:
+					for MsgId, SocketMsg in j.read_requests():
+						if SocketMsg.startswith("HIST"):
+							# Answered once the new readings are in the history
+							Queries.append((j, MsgId, SocketMsg))
+							continue
+						if SocketMsg == "TRACK":
+							# Rejected if there has been no sweep
+							Data = control.FeedForward.Report()
+							Replies.append((j, MsgId, bool(Data), Data or None))
+							continue
+						Controlling = control.Status >= 0 and control.Tuner is None
+						GotSet, Valid = control.ReadMsg(SocketMsg)
+						Replies.append((j, MsgId, Valid, None))
+						Commanded = Commanded or Valid
+						if GotSet:
+							# The integral term carries over from the last set
+							# point, as across the gain change, unless the PID
+							# was not running (heater off, constant current or
+							# tuning)
+							control.ScheduleGains(pid, control.SetTemp)
+							pid.setPoint(control.SetTemp, bumpless=Controlling)
+				if control.Sweep and not control.Server.handlers and time.time() > control.ListenerGrace:
+					control.Sweep = False
+				control.UpdateStatus()
+				Status = control.Status
+				ETA = control.ETA
+			if time.time() - control.LastReading > control.StaleReadings:
+				# The bridge is not being read
+				Status = -1
+				ETA = -1.0
+			if not all(Thread.is_alive() for Thread in Threads):
+				raise RuntimeError("a worker thread has stopped")
+
+			# Publish the new readings to subscribers and add them to
+			# the history
+			while 1:
+				try:
+					Stamp, Channel, Temperature, ResThermometer, PicoRange = control.Readings.get_nowait()
+				except Queue.Empty:
+					break
+				control.RawLog.Append(Stamp, Channel, PicoRange, ResThermometer)
+				if Channel != control.Scanner.Control:
+					Encoder = control.ChannelEncoders.setdefault(Channel, SocketUtils.TelemetryEncoder())
+					control.Server.publish("CH%d" % Channel, Encoder.encode(Temperature, Status, ResThermometer, Stamp))
+					continue
+				Frame = control.Encoder.encode(Temperature, Status, ResThermometer, Stamp)
+				control.Shared.Write(Frame)
+				control.History.Append(Stamp, [Temperature, ResThermometer, Status])
+				control.Server.publish("TEMP", Frame)
+			control.Server.publish_state("ETA", "%.0f" % ETA)
+			control.Server.publish_state("STATUS", "%d" % Status)
+			for j, MsgId, Valid, Data in Replies:
+				j.reply(MsgId, Valid, Data)
+			for j, MsgId, Query in Queries:
+				Data = control.History.Query(Query)
+				j.reply(MsgId, Data is not None, Data)
+			# A command is checkpointed straight away, the rest every 10 s
+			if Commanded or control.Checkpoint.Due():
+				with control.Lock:
+					State = control.GetState()
+				control.Checkpoint.Save(State)
+	finally:
+		control.Running = False
+		for Thread in Threads:
+			Thread.join(5.0)
+		control.RawLog.Close()
+		with control.Lock:
+			State = control.GetState()
+		control.Checkpoint.Save(State)
+		control.TCSVisa.close()
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+Settling of TDaemon on the simulated fridge before and after autotuning
+
+last edited : October 2026
+
+Explanation:
+
+	Starts "TDaemon.py --sim speed" with no tuned gains and no checkpoint,
+	sets 100 mK and then times the steps 100 -> 200 mK and 200 -> 100 mK
+	with the default gains. It then tunes at 100 mK with TUNE and times
+	the same two steps again with the tuned gains.
+
+	For each step it prints, in simulated seconds from the SET, when the
+	temperature was last outside ErrorTemp (10 mK) of the set point and
+	when the daemon went to status 1, and the overshoot in mK. The daemon
+	is stopped at the end, the tuned gains are left in the temporary
+	directory (TDaemonSimGains.dat).
+
+	Nothing else may be using the temperature daemon port (18871).
+
+		python TuneSim.py [speed]
+
+	The speed defaults to 100 times real time.
+
+Methods written:
+	Settle
+	Tune
+
+"""
+
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import DaemonClient
+import PIDControl
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SIM_FILES = [os.path.join(tempfile.gettempdir(), Name) for Name in
+	("TDaemonSim.state", "TDaemonSimGains.dat", "TDaemonSimRawLog")]
+GAINS_FILE = SIM_FILES[1]
+ERROR_TEMP = 10.0
+
+def Settle(Session, SetPoint, Timeout):
+	# Set SetPoint and wait (Timeout real seconds) for status 1, returns
+	# the simulated seconds until the temperature stayed in the band and
+	# until status 1, and the overshoot. None if it never got there
+	Start = Session.History(0, 1e12)[-1,0]
+	Session.Write("SET %g" % SetPoint)
+	if not Session.WaitUntil("1", Timeout):
+		print "SET %g: no status 1 after %.0f s" % (SetPoint, Timeout)
+		return None
+	Data = Session.History(Start, 1e12)
+	From = Data[0,1]
+	Outside = np.nonzero(np.abs(Data[:,1] - SetPoint) >= ERROR_TEMP)[0]
+	InBand = 0.0
+	if len(Outside):
+		InBand = Data[min(Outside[-1] + 1, len(Data) - 1),0] - Start
+	if SetPoint > From:
+		Overshoot = max(Data[:,1].max() - SetPoint, 0.0)
+	else:
+		Overshoot = max(SetPoint - Data[:,1].min(), 0.0)
+	Result = (InBand, Data[-1,0] - Start, Overshoot)
+	print "%g -> %g mK: in band after %.0f s, status 1 after %.0f s, overshoot %.1f mK" % ((From, SetPoint) + Result)
+	return Result
+
+def Tune(Session, SetPoint, Timeout):
+	# Tune at SetPoint, returns the gains or None
+	Session.Write("TUNE")
+	End = time.time() + Timeout
+	while time.time() < End:
+		for Gains in PIDControl.loadGains(GAINS_FILE):
+			if Gains[0] == SetPoint:
+				print "Tuned at %g mK: Kp %.3g Ki %.3g Kd %.3g" % Gains[:4]
+				return Gains[1:4]
+		time.sleep(0.5)
+	print "No gains after %.0f s" % Timeout
+	return None
+
+if __name__ == '__main__':
+
+	Speed = 100.0
+	if len(sys.argv) > 1:
+		Speed = float(sys.argv[1])
+	# The longest step is about 1000 s of simulated time
+	Timeout = 3000.0 / Speed + 10.0
+
+	for Path in SIM_FILES:
+		if os.path.isdir(Path):
+			shutil.rmtree(Path)
+		elif os.path.exists(Path):
+			os.remove(Path)
+	Daemon = subprocess.Popen([sys.executable, os.path.join(DIRECTORY, "TDaemon.py"), "--sim", "%g" % Speed],
+		stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+	try:
+		# Wait for the daemon to listen before the session connects
+		End = time.time() + 30.0
+		while True:
+			try:
+				socket.create_connection(("localhost", DaemonClient.TEMP_PORT), 1.0).close()
+				break
+			except socket.error:
+				if time.time() > End or Daemon.poll() is not None:
+					raise RuntimeError("The simulated daemon did not start")
+				time.sleep(0.5)
+		Session = DaemonClient.TempSession()
+		Session.Write("SET 100")
+		Session.WaitUntil("1", Timeout)
+		print "Default gains"
+		Settle(Session, 200.0, Timeout)
+		Settle(Session, 100.0, Timeout)
+		if Tune(Session, 100.0, 7200.0 / Speed + 10.0) is not None:
+			Session.WaitUntil("1", Timeout)
+			print "Tuned gains"
+			Settle(Session, 200.0, Timeout)
+			Settle(Session, 100.0, Timeout)
+		Session.Close()
+	finally:
+		Daemon.terminate()
+		Daemon.wait()
@@ -7,14 +7,36 @@ Sub programs for communication using PyVisa
 
 author : Eoin O'Farrell
 email : phyoec@nus.edu.sg
-last edited : July 2013
+last edited : October 2026
+
+	Instead of sleeping for the worst case after a slow command the
+	drivers wait for the instrument to say it is done. Complete sends a
+	SCPI command followed by *OPC?, which is only answered once the
+	command has finished, and WaitOPC asks *OPC? on its own. WaitStatus
+	polls the status byte (serial poll) until one of the bits in Mask is
+	set, for instruments without *OPC?, and returns after Timeout if the
+	bit never comes or the instrument has no status byte, so it is never
+	slower than the fixed wait it replaces. They work with anything that
+	has write and ask (and stb, timeout), e.g. the simulated instruments.
+
+	If the instrument does not answer *OPC? in time it is cleared (device
+	clear), so a late answer is not read as the answer to the next
+	question, and WaitOPC and Complete raise IOError.
 
 Functions written:
 	InitializeGPIB
 	InitialIzeSerial
+	Complete
+	WaitOPC
+	WaitStatus
 
 """
-import visa as visa
+import time
+try:
+	import visa as visa
+except ImportError:
+	# The completion functions still work with simulated instruments
+	visa = None
 
 # initalize GPIB devices using PyVisa
 
@@ -46,5 +68,50 @@ def InitializeSerial(name,idn="*IDN?", **kwargs):
 		SerialVisa = None
 
 	return SerialVisa
+
+# wait for an instrument to finish
+
+def WaitOPC(Visa, Timeout = 10.0, Command = "*OPC?"):
+	# Returns once the instrument answers, raises IOError if it did not
+	# within Timeout seconds
+	OldTimeout = getattr(Visa, "timeout", None)
+	try:
+		if OldTimeout is not None:
+			Visa.timeout = Timeout
+		try:
+			Answer = Visa.ask(Command).strip()
+		except Exception as e:
+			# Throw away the answer if it still comes
+			Clear = getattr(Visa, "clear", None)
+			if Clear is not None:
+				Clear()
+			raise IOError("No answer to %s in %.1f s: %s" % (Command, Timeout, e))
+	finally:
+		if OldTimeout is not None:
+			Visa.timeout = OldTimeout
+	if Answer != "1":
+		raise IOError("Answer to %s was %s" % (Command, Answer))
+	return True
+
+def Complete(Visa, Command, Timeout = 10.0):
+	# Send Command and return when the instrument has carried it out
+	return WaitOPC(Visa, Timeout, "".join((Command,";*OPC?")))
+
+def WaitStatus(Visa, Mask, Timeout, Clock = time, Poll = 0.005):
+	# Returns True as soon as a bit of Mask is set in the status byte,
+	# False after Timeout seconds
+	End = Clock.time() + Timeout
+	while 1:
+		try:
+			Status = Visa.stb
+		except Exception:
+			# No serial poll, wait the whole time
+			Clock.sleep(max(End - Clock.time(), 0))
+			return False
+		if Status & Mask:
+			return True
+		if Clock.time() >= End:
+			return False
+		Clock.sleep(Poll)
         
 